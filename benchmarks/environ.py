@@ -0,0 +1,79 @@
+"""Measure what the environment costs with pytest-parallel's isolation.
+
+While several tests run in a worker, os.environ is replaced by one that
+keeps PYTEST_CURRENT_TEST per thread. This times the operations tests and
+libraries use on os.environ, for the plain one with the current test set
+like pytest does, and for the replacement with it set in the running
+thread only, the fastest of alternating rounds:
+
+    python benchmarks/environ.py
+"""
+import os
+import sys
+import timeit
+import argparse
+
+from pytest_parallel.isolation import CURRENT_TEST, ThreadLocalEnviron
+
+OPERATIONS = {
+    'getitem': "environ['PATH']",
+    'get missing': "environ.get('PYTEST_PARALLEL_MISSING')",
+    'contains': "'HOME' in environ",
+    'current test': "environ['{}']".format(CURRENT_TEST),
+    'setitem': "environ['PYTEST_PARALLEL_BENCH'] = '1'",
+    'iterate': 'for key in environ: pass',
+    'len': 'len(environ)',
+}
+
+
+def measure(environ, statement, number):
+    timer = timeit.Timer(statement, globals={'environ': environ})
+    return timer.timeit(number) / number
+
+
+def benchmark(number, repeat):
+    plain = os.environ
+    isolated = ThreadLocalEnviron(os.environ)
+    plain.setdefault('PATH', '')
+    plain.setdefault('HOME', '')
+    value = 'test_environ.py::test (call)'
+    previous = plain.pop(CURRENT_TEST, None)
+    try:
+        for name, statement in OPERATIONS.items():
+            plain_times, isolated_times = [], []
+            # the rounds alternate, so both see the same load of the machine
+            for _ in range(repeat):
+                # pytest sets the current test in os.environ, the isolation
+                # in the running thread only
+                plain[CURRENT_TEST] = value
+                plain_times.append(measure(plain, statement, number))
+                del plain[CURRENT_TEST]
+                isolated[CURRENT_TEST] = value
+                isolated_times.append(measure(isolated, statement, number))
+                del isolated[CURRENT_TEST]
+            yield name, min(plain_times), min(isolated_times)
+    finally:
+        plain.pop('PYTEST_PARALLEL_BENCH', None)
+        if previous is not None:
+            plain[CURRENT_TEST] = previous
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--number', type=int, default=100000,
+                        help='operations per measurement (default: %(default)s)')
+    parser.add_argument('--repeat', type=int, default=9,
+                        help='measurements per operation, the fastest is kept')
+    options = parser.parse_args(argv)
+    print('{:<14} {:>10} {:>10} {:>7}'.format(
+        '', 'os.environ', 'isolated', 'ratio'
+    ))
+    for name, plain, isolated in benchmark(options.number, options.repeat):
+        print('{:<14} {:>8.0f}ns {:>8.0f}ns {:>6.2f}x'.format(
+            name, plain * 1e9, isolated * 1e9, isolated / plain
+        ))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
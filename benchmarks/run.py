@@ -0,0 +1,273 @@
+"""Measure the overhead pytest-parallel adds to a run.
+
+Synthetic suites are generated in a temporary directory and run under a
+matrix of --workers and --tests-per-worker, next to a plain pytest run
+of the same suite. Every run is profiled with --parallel-profile, which
+yields:
+
+* wall: seconds from starting pytest until it exited
+* startup: seconds from starting pytest until the first test started
+* dispatch_latency: seconds per test the worker threads spent waiting
+  for work, leaving out the wait for their first and after their last unit
+* report_throughput: reports per second of master time spent on them
+* peak_rss: bytes of the largest process of the run
+
+Results are written as JSON, and two result files can be compared:
+
+    python benchmarks/run.py --output before.json
+    python benchmarks/run.py --output after.json
+    python benchmarks/run.py --compare before.json after.json
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import platform
+import statistics
+import subprocess
+import tempfile
+
+import pytest_parallel
+
+METRICS = ('wall', 'startup', 'dispatch_latency', 'report_throughput',
+           'peak_rss')
+TESTS_PER_FILE = 100
+
+SUITES = {
+    # name: (tests at scale 1, module header, test arguments, test body)
+    'noop': (10000, '', '', 'pass'),
+    'sleep': (400, 'import time', '', 'time.sleep(.05)'),
+    'cpu': (200, '', '', 'sum(i * i for i in range(100000))'),
+    'fixtures': (400, '''import time
+import pytest
+
+
+@pytest.fixture(scope='module')
+def dataset():
+    time.sleep(.2)
+    return list(range(1000000))
+
+
+@pytest.fixture
+def scratch(dataset):
+    buffer = bytearray(8 << 20)
+    time.sleep(.01)
+    yield buffer
+    time.sleep(.005)
+''', 'scratch', 'assert len(scratch)'),
+    'output': (2000, '''import logging
+
+log = logging.getLogger(__name__)
+''', '', '''for _ in range(20):
+        print('output ' * 10)
+        log.warning('log ' * 10)'''),
+}
+
+
+def generate(directory, suite, scale):
+    count, header, arguments, body = SUITES[suite]
+    count = max(1, int(count * scale))
+    os.makedirs(directory)
+    for start in range(0, count, TESTS_PER_FILE):
+        tests = [
+            'def test_{}({}):\n    {}\n'.format(index, arguments, body)
+            for index in range(start, min(start + TESTS_PER_FILE, count))
+        ]
+        path = os.path.join(directory, 'test_{}.py'.format(start))
+        with open(path, 'w') as f:
+            f.write(header + '\n\n' + '\n\n'.join(tests))
+    return count
+
+
+def run(directory, workers, tests_per_worker):
+    trace = os.path.join(directory, 'trace.json')
+    log = os.path.join(directory, 'output.log')
+    args = [sys.executable, '-m', 'pytest', '-q', '-p', 'no:cacheprovider',
+            directory]
+    if workers:
+        args += ['--workers', str(workers),
+                 '--tests-per-worker', str(tests_per_worker),
+                 '--parallel-profile', trace, '--parallel-progress', '0']
+    with open(log, 'w') as output:
+        launched = time.time()
+        process = subprocess.Popen(args, stdout=output,
+                                   stderr=subprocess.STDOUT)
+        if hasattr(os, 'wait4'):
+            # the usage of the child covers the workers it waited for
+            _, status, usage = os.wait4(process.pid, 0)
+            process.returncode = (os.WEXITSTATUS(status) if os.WIFEXITED(status)
+                                  else -os.WTERMSIG(status))
+            peak_rss = usage.ru_maxrss * (1 if sys.platform == 'darwin' else 1024)
+        else:
+            process.wait()
+            peak_rss = None
+        wall = time.time() - launched
+    if process.returncode != 0:
+        with open(log) as f:
+            raise RuntimeError('pytest exited with {}:\n{}'.format(
+                process.returncode, f.read()[-2000:]
+            ))
+    result = dict.fromkeys(METRICS)
+    result.update(wall=wall, peak_rss=peak_rss)
+    if workers:
+        result.update(trace_metrics(trace, launched))
+        os.remove(trace)
+    return result
+
+
+def trace_metrics(path, launched):
+    with open(path) as f:
+        trace = json.load(f)
+    started = trace['otherData']['started']
+    names = {event['pid']: event['args']['name']
+             for event in trace['traceEvents'] if event['name'] == 'process_name'}
+    spans = [event for event in trace['traceEvents'] if event['ph'] == 'X']
+    master = [span for span in spans if names[span['pid']] == 'master']
+    phases = [span for span in spans
+              if names[span['pid']] != 'master' and span['cat'] != 'idle']
+    waits = {}
+    for span in spans:
+        if span['cat'] == 'idle':
+            waits.setdefault((span['pid'], span['tid']), []).append(span)
+    waiting = sum(
+        span['dur'] for thread in waits.values()
+        for span in sorted(thread, key=lambda span: span['ts'])[1:-1]
+    ) / 1e6
+    reporting = sum(span['dur'] for span in master
+                    if span['name'] == 'reports') / 1e6
+    tests = sum(span['cat'] == 'teardown' for span in phases)
+    return {
+        'startup': started + min(span['ts'] for span in phases) / 1e6 - launched,
+        'dispatch_latency': waiting / max(tests, 1),
+        'report_throughput': len(phases) / reporting if reporting else None,
+    }
+
+
+def median(runs, metric):
+    values = [run[metric] for run in runs if run[metric] is not None]
+    return statistics.median(values) if values else None
+
+
+def benchmark(options):
+    results = []
+    configurations = [(None, None)] + [
+        (workers, tests_per_worker)
+        for workers in options.workers
+        for tests_per_worker in options.tests_per_worker
+    ]
+    root = tempfile.mkdtemp(prefix='pytest-parallel-bench-')
+    try:
+        for suite in options.suites:
+            directory = os.path.join(root, suite)
+            tests = generate(directory, suite, options.scale)
+            for workers, tests_per_worker in configurations:
+                runs = [run(directory, workers, tests_per_worker)
+                        for _ in range(options.repeat)]
+                result = {'suite': suite, 'tests': tests, 'workers': workers,
+                          'tests_per_worker': tests_per_worker}
+                result.update(
+                    (metric, median(runs, metric)) for metric in METRICS
+                )
+                result['tests_per_second'] = tests / result['wall']
+                print(describe(result))
+                sys.stdout.flush()
+                results.append(result)
+    finally:
+        shutil.rmtree(root, ignore_errors=True)
+    return {
+        'version': pytest_parallel.__version__,
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpus': os.cpu_count(),
+        'date': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'scale': options.scale,
+        'results': results,
+    }
+
+
+def label(result):
+    if result['workers'] is None:
+        return '{:<9} plain pytest'.format(result['suite'])
+    return '{:<9} {} workers x {} tests'.format(
+        result['suite'], result['workers'], result['tests_per_worker']
+    )
+
+
+def describe(result):
+    parts = ['wall {:.2f}s'.format(result['wall'])]
+    if result['startup'] is not None:
+        parts.append('startup {:.2f}s'.format(result['startup']))
+    if result['dispatch_latency'] is not None:
+        parts.append('dispatch {:.2f}ms/test'.format(
+            result['dispatch_latency'] * 1e3
+        ))
+    if result['report_throughput'] is not None:
+        parts.append('reports {:.0f}/s'.format(result['report_throughput']))
+    if result['peak_rss'] is not None:
+        parts.append('rss {:.0f}M'.format(result['peak_rss'] / (1 << 20)))
+    return '{:<32} {}'.format(label(result), ', '.join(parts))
+
+
+def compare(old_path, new_path):
+    with open(old_path) as f:
+        old = json.load(f)
+    with open(new_path) as f:
+        new = json.load(f)
+
+    def key(result):
+        return result['suite'], result['workers'], result['tests_per_worker']
+
+    before = {key(result): result for result in old['results']}
+    print('{} -> {}'.format(old['version'], new['version']))
+    for result in new['results']:
+        previous = before.get(key(result))
+        if previous is None:
+            continue
+        changes = []
+        for metric in METRICS:
+            if result[metric] is None or not previous[metric]:
+                continue
+            changes.append('{} {:+.0%}'.format(
+                metric, result[metric] / previous[metric] - 1
+            ))
+        print('{:<32} {}'.format(label(result), ', '.join(changes)))
+
+
+def parse_list(value, type=str):
+    return [type(part) for part in value.split(',') if part.strip()]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--output', default='benchmark.json',
+                        help='where to write the results (default: %(default)s)')
+    parser.add_argument('--suites', type=parse_list, default=list(SUITES),
+                        help='comma separated suites, out of ' + ', '.join(SUITES))
+    parser.add_argument('--workers', type=lambda value: parse_list(value, int),
+                        default=[1, 2, 4])
+    parser.add_argument('--tests-per-worker',
+                        type=lambda value: parse_list(value, int), default=[1, 4])
+    parser.add_argument('--scale', type=float, default=1.,
+                        help='multiplies the number of tests of every suite')
+    parser.add_argument('--repeat', type=int, default=1,
+                        help='runs per configuration, the median is kept')
+    parser.add_argument('--compare', nargs=2, metavar=('OLD', 'NEW'),
+                        help='compare two result files instead of running')
+    options = parser.parse_args(argv)
+    if options.compare:
+        compare(*options.compare)
+        return 0
+    unknown = set(options.suites) - set(SUITES)
+    if unknown:
+        parser.error('unknown suites: ' + ', '.join(sorted(unknown)))
+    results = benchmark(options)
+    with open(options.output, 'w') as f:
+        json.dump(results, f, indent=2)
+    print('results written to ' + options.output)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,38 +1,135 @@
 import os
 import py
 import sys
-import time
 import math
+import signal
+import time
+import pickle
+import marshal
+import shutil
 import pytest
 import _pytest
-import platform
+import inspect
+import tempfile
+import traceback
+import contextlib
 import threading
+import statistics
+import collections
 import multiprocessing
 from tblib import pickling_support
-from multiprocessing import Manager, Process
-
-# In Python 3.8 and later, the default on macOS is spawn.
-# We force forking behavior at the expense of safety.
-#
-# "On macOS, the spawn start method is now the default. The fork start method should be
-#  considered unsafe as it can lead to crashes of the subprocess. See bpo-33725."
-#
-# https://docs.python.org/3/library/multiprocessing.html#contexts-and-start-methods
-if sys.platform.startswith('darwin'):
-    multiprocessing.set_start_method('fork')
+from multiprocessing.connection import wait
+
+try:
+    import contextvars
+except ImportError:  # Python 3.6
+    contextvars = None
+
+from .capture import capture_per_thread
+from .collection import (
+    PARTITIONS_SUPPORTED, CollectedItem, PartitionCollector, assign,
+    collection_roots, describe, partition
+)
+from .eventloop import EventLoopThread
+from .impact import FileTracer, ImpactMap, environment
+from .isolation import (  # noqa: F401
+    ContextLocalSetupState, ThreadIsolation, ThreadLocalEnviron
+)
+from .profile import IDLE, Profile
+from .progress import Progress
+from .remote import Coordinator, authkey_from
+from .resources import (
+    AdaptiveConcurrency, DYNAMIC_MAX_THREADS, ResourcePool, auto_workers,
+    parse_resources, parse_size, resource_needs
+)
+from .scheduler import Scheduler, group_units, split_isolated
+from .shared import (  # noqa: F401
+    dump_values, parallel_shared_fixture, shared_fixtures
+)
+from .watchdog import Timeout, Watchdog, item_timeout
 
 __version__ = '0.1.1'
 
+DURATIONS_KEY = 'pytest-parallel/durations'
+
+# Workers forward reports in batches of this size, or after this many
+# seconds, whichever comes first.
+REPORT_BATCH_SIZE = 64
+REPORT_FLUSH_INTERVAL = .05
+
+# Exit code of a worker process that retired, so agents connect again.
+RETIRED_EXIT_CODE = 75
+
+
+def encode(message):
+    # Messages and serialized reports are plain builtins, which marshal
+    # encodes faster and smaller than pickle. Anything exotic a plugin
+    # stored in a report still goes through pickle.
+    try:
+        return b'm' + marshal.dumps(message)
+    except ValueError:
+        return b'p' + pickle.dumps(message, pickle.HIGHEST_PROTOCOL)
+
+
+def decode(data):
+    if data[:1] == b'm':
+        return marshal.loads(data[1:])
+    return pickle.loads(data[1:])
+
 
 def parse_config(config, name):
-    return getattr(config.option, name, config.getini(name))
+    value = getattr(config.option, name, None)
+    return config.getini(name) if value is None else value
 
 
 def pytest_addoption(parser):
     workers_help = ('Set the max num of workers (aka processes) to start '
-                    '(int or "auto" - one per core)')
+                    '(int or "auto" - one per available core, within the '
+                    'cgroup CPU and memory limits)')
     tests_per_worker_help = ('Set the max num of concurrent tests for each '
-                             'worker (int or "auto" - split evenly)')
+                             'worker (int, "auto" - split evenly, or '
+                             '"dynamic" - adjusted to the CPU load)')
+    order_help = ('Set the dispatch order ("duration" - longest recorded '
+                  'duration first, or "collection")')
+    asyncio_help = ('Run "async def" tests and fixtures as tasks on one event '
+                    'loop per worker, at most this many at a time (int)')
+    start_method_help = ('Set how worker processes are started ("fork", '
+                         '"forkserver" or "spawn"; defaults to "fork" where '
+                         'available)')
+    preload_help = ('Comma separated modules the forkserver imports once '
+                    'before starting workers')
+    max_tests_help = ('Retire a worker and start a fresh one after it ran '
+                      'this many tests (int)')
+    max_rss_help = ('Retire a worker and start a fresh one once its resident '
+                    'memory exceeds this size (megabytes, or with a K, M or G '
+                    'suffix)')
+    reruns_help = ('Run a test whose call failed again, preferably in another '
+                   'worker, up to this many times (int)')
+    capture_help = ('Capture the output and logs of every test on its own '
+                    '("thread"), or as pytest does for the whole worker '
+                    '("process"; defaults to "thread" with more than one test '
+                    'per worker)')
+    timeout_help = ('Fail a test that runs longer than this many seconds, and '
+                    'retire its worker when the test cannot be stopped')
+    profile_help = ('Write a Chrome trace of the scheduling timeline to this '
+                    'path and print a utilization summary')
+    progress_help = ('Print a progress line with the tests done and an ETA at '
+                     'most every this many seconds (0 disables it)')
+    listen_help = ('Also accept workers of "pytest-parallel worker --connect" '
+                   'agents on this HOST:PORT')
+    authkey_help = ('Key agents authenticate with (defaults to the '
+                    'PYTEST_PARALLEL_AUTHKEY variable, or a generated key)')
+    resources_help = ('Capacities of the resources tests ask for with the '
+                      'parallel_resources marker, like "db=8,memory=16G" ("cpu" '
+                      'defaults to the cores, "memory" to the RAM, others to 1)')
+    impact_help = ('Record the project files every test executes ("record"), '
+                   'and only run the tests affected by changes since ("select")')
+    collect_help = ('Collect the tests in the worker processes, each one a '
+                    'share of the directories, and run them where they were '
+                    'collected (needs the "fork" start method)')
+    dist_help = ('Set how tests are kept together on one worker thread '
+                 '("load" - not at all, "loadfile" - by module, "loadscope" - '
+                 'by class or module, "loadgroup" - by parallel_group marker)')
 
     group = parser.getgroup('pytest-parallel')
     group.addoption(
@@ -45,9 +142,144 @@ def pytest_addoption(parser):
         dest='tests_per_worker',
         help=tests_per_worker_help
     )
+    group.addoption(
+        '--parallel-asyncio',
+        dest='parallel_asyncio',
+        help=asyncio_help
+    )
+    group.addoption(
+        '--parallel-start-method',
+        dest='parallel_start_method',
+        choices=('fork', 'forkserver', 'spawn'),
+        help=start_method_help
+    )
+    group.addoption(
+        '--parallel-preload',
+        dest='parallel_preload',
+        help=preload_help
+    )
+    group.addoption(
+        '--max-tests-per-worker',
+        dest='max_tests_per_worker',
+        help=max_tests_help
+    )
+    group.addoption(
+        '--max-worker-rss',
+        dest='max_worker_rss',
+        help=max_rss_help
+    )
+    group.addoption(
+        '--parallel-reruns',
+        dest='parallel_reruns',
+        metavar='N',
+        help=reruns_help
+    )
+    group.addoption(
+        '--parallel-capture',
+        dest='parallel_capture',
+        choices=('thread', 'process'),
+        help=capture_help
+    )
+    group.addoption(
+        '--parallel-timeout',
+        dest='parallel_timeout',
+        metavar='SECONDS',
+        help=timeout_help
+    )
+    group.addoption(
+        '--parallel-collect',
+        dest='parallel_collect',
+        action='store_true',
+        default=None,
+        help=collect_help
+    )
+    group.addoption(
+        '--parallel-order',
+        dest='parallel_order',
+        choices=('duration', 'collection'),
+        help=order_help
+    )
+    group.addoption(
+        '--parallel-dist',
+        dest='parallel_dist',
+        choices=('load', 'loadfile', 'loadscope', 'loadgroup'),
+        help=dist_help
+    )
+    group.addoption(
+        '--parallel-resources',
+        dest='parallel_resources',
+        metavar='NAME=AMOUNT,...',
+        help=resources_help
+    )
+    group.addoption(
+        '--parallel-impact',
+        dest='parallel_impact',
+        choices=('record', 'select'),
+        help=impact_help
+    )
+    group.addoption(
+        '--parallel-listen',
+        dest='parallel_listen',
+        metavar='HOST:PORT',
+        help=listen_help
+    )
+    group.addoption(
+        '--parallel-authkey',
+        dest='parallel_authkey',
+        help=authkey_help
+    )
+    group.addoption(
+        '--parallel-progress',
+        dest='parallel_progress',
+        metavar='SECONDS',
+        help=progress_help
+    )
+    group.addoption(
+        '--parallel-profile',
+        dest='parallel_profile',
+        metavar='PATH',
+        help=profile_help
+    )
 
     parser.addini('workers', workers_help)
     parser.addini('tests_per_worker', tests_per_worker_help)
+    parser.addini('parallel_asyncio', asyncio_help)
+    parser.addini('parallel_start_method', start_method_help)
+    parser.addini('parallel_preload', preload_help)
+    parser.addini('max_tests_per_worker', max_tests_help)
+    parser.addini('max_worker_rss', max_rss_help)
+    parser.addini('parallel_reruns', reruns_help)
+    parser.addini('parallel_capture', capture_help)
+    parser.addini('parallel_timeout', timeout_help)
+    parser.addini('parallel_collect', collect_help, type='bool', default=False)
+    parser.addini('parallel_order', order_help, default='duration')
+    parser.addini('parallel_dist', dist_help, default='load')
+    parser.addini('parallel_resources', resources_help)
+    parser.addini('parallel_impact', impact_help)
+    parser.addini('parallel_listen', listen_help)
+    parser.addini('parallel_authkey', authkey_help)
+    parser.addini('parallel_progress', progress_help, default='10')
+    parser.addini('parallel_profile', profile_help)
+
+
+def current_rss():
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, IndexError):
+        pass
+    try:
+        import resource
+    except ImportError:
+        return 0
+    # only the peak is available here, which is a safe upper bound
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss if sys.platform == 'darwin' else rss * 1024
+
+
+def root_dir(config):
+    rootpath = getattr(config, 'rootpath', None)
+    return str(rootpath if rootpath is not None else config.rootdir)
 
 
 def run_test(session, item, nextitem):
@@ -56,143 +288,815 @@ def run_test(session, item, nextitem):
         raise session.Interrupted(session.shouldstop)
 
 
-def process_with_threads(config, queue, session, tests_per_worker, errors):
+def mute_reporter(config):
+    # A forked worker inherits the master's reporter. The master owns the
+    # terminal and renders every report, so the copy writes nowhere.
+    reporter = config.pluginmanager.getplugin('terminalreporter')
+    if reporter is not None:
+        reporter._tw = _pytest.config.create_terminal_writer(
+            config, open(os.devnull, 'w')
+        )
+
+
+def process_with_threads(config, conn, session, settings):
     # This function will be called from subprocesses, forked from the main
     # pytest process. First thing we need to do is to change config's value
     # so we know we are running as a worker.
     config.parallel_worker = True
-
+    config.parallel_shared = settings['shared']
+    if settings['impact']:
+        config.parallel_tracer = FileTracer(root_dir(config))
+    if settings['capture'] == 'thread':
+        capture_per_thread(config)
+    mute_reporter(config)
+    if settings['collect']:
+        collect = settings['collect']
+        collector = config.pluginmanager.getplugin('parallelcollector')
+        if collector is None:
+            collector = PartitionCollector(collect['partitions'],
+                                           collect['split'])
+            config.pluginmanager.register(collector, 'parallelcollector')
+        collector.attach(session, collect['nodeids'], collect['owners'])
+        config.parallel_collector = collector
+
+    if settings['asyncio_concurrency']:
+        config.parallel_event_loop = EventLoopThread(
+            settings['asyncio_concurrency'],
+            getattr(config, 'parallel_tracer', None)
+        )
+        config.parallel_event_loop.start()
+
+    channel = WorkerChannel(conn, max(settings['tests_per_worker'],
+                                      settings['asyncio_concurrency']),
+                            settings['max_tests'], settings['max_rss'],
+                            settings['profile'])
+    if settings['units']:
+        channel.assign(settings['units'])
+    channel.start()
+    config.parallel_channel = channel
+    if settings['dynamic']:
+        concurrency = AdaptiveConcurrency(channel.set_limit,
+                                          settings['tests_per_worker'], start=2)
+        concurrency.start()
+
+    runner = None
+
+    def abandon(thread, index, timeout, stack):
+        channel.abandon(thread, index, timeout, stack)
+        if runner is not None:
+            runner.abandoned(thread)
+
+    watchdog = config.parallel_watchdog = Watchdog(abandon)
+    watchdog.start()
     threads = []
-    for _ in range(tests_per_worker):
-        thread = ThreadWorker(queue, session, errors)
+    lane = SerialLane()
+    if settings['asyncio_concurrency'] and contextvars is not None:
+        runner = CoroutineRunner(channel, session, lane, watchdog,
+                                 config.parallel_event_loop,
+                                 settings['asyncio_concurrency'],
+                                 settings['timeout'])
+        runner.start()
+    for _ in range(settings['tests_per_worker']):
+        thread = ThreadWorker(channel, session, lane, watchdog,
+                              settings['timeout'], runner)
         thread.start()
         threads.append(thread)
-    [t.join() for t in threads]
+    # an abandoned thread leaves without finishing, and being a daemon
+    # thread, it does not keep the process alive
+    [t.left.wait() for t in threads]
+    if runner is not None:
+        runner.join()
+    if settings['dynamic']:
+        concurrency.stop()
+    if settings['asyncio_concurrency']:
+        config.parallel_event_loop.stop()
+    channel.close()
+    return channel.retired
+
+
+def collect_with_threads(config, conn, session, collector, partitions):
+    # Entry point of the workers forked while the master collects. They
+    # collect their share of the tests, send it to the master and run tests
+    # once the master settled how, starting with the ones they collected.
+    config.parallel_worker = True
+    mute_reporter(config)
+    config.pluginmanager.register(collector, 'parallelcollector')
+    collected = {'items': [], 'deselected': [], 'reports': [], 'shared': [],
+                 'error': None}
+    try:
+        session.items = collector.collect(session, partitions)
+        collected['items'] = [
+            describe(item) + (collector.partition_of(item),)
+            for item in session.items
+        ]
+        collected['shared'] = list(shared_fixtures(session.items))
+        collected['deselected'] = [describe(item)
+                                   for item in collector.deselected]
+        collected['reports'] = [
+            config.hook.pytest_report_to_serializable(config=config,
+                                                      report=report)
+            for report in collector.reports
+        ]
+    except BaseException:
+        collected['error'] = traceback.format_exc()
+    conn.send_bytes(encode(('collected', collected)))
+    if collected['error']:
+        return
+    while True:
+        try:
+            event_name, kwargs = decode(conn.recv_bytes())
+        except (EOFError, OSError):
+            event_name = 'stop'
+        if event_name != 'share':
+            break
+        # the master imported none of the tests, so the shared fixtures
+        # they use are computed here
+        paths = dump_values(shared_fixtures(session.items), kwargs['paths'])
+        conn.send_bytes(encode(('shared', {'paths': paths})))
+    if event_name == 'start':
+        process_with_threads(config, conn, session, kwargs['settings'])
+
+
+def remote_worker(conn, args, invocation_dir, nodeids, settings):
+    # Entry point of workers started with spawn or forkserver. They do not
+    # inherit the master's session, so they run their own collection with
+    # the master's arguments and pick the items by node ID.
+    os.chdir(invocation_dir)
+    pytest.main(list(args), plugins=[WorkerSession(conn, nodeids, settings)])
+    # only reached when the worker failed before its test loop
+    conn.close()
+
+
+class WorkerSession(object):
+    """Plugin that turns a spawned pytest run into a worker of the master."""
+
+    def __init__(self, conn, nodeids, settings):
+        self.conn = conn
+        self.nodeids = nodeids
+        self.settings = settings
+
+    @pytest.mark.tryfirst
+    def pytest_configure(self, config):
+        config.parallel_worker = True
+        config.parallel_worker_session = self
+
+    def run(self, session):
+        pickling_support.install()
+        exitcode = 0
+        collected = {item.nodeid: item for item in session.items}
+        try:
+            session.items[:] = [collected[nodeid] for nodeid in self.nodeids]
+        except KeyError as e:
+            try:
+                raise RuntimeError('worker did not collect {}, tests must be '
+                                   'collected in the same way by every '
+                                   'process'.format(e.args[0]))
+            except RuntimeError:
+                self.conn.send_bytes(encode(('error', {
+                    'thread_name': 'collection',
+                    'errinfo': pickle.dumps(sys.exc_info()),
+                })))
+        else:
+            if process_with_threads(session.config, self.conn, session,
+                                    self.settings):
+                exitcode = RETIRED_EXIT_CODE
+        # Like a forked worker, leave without running the session finish
+        # hooks: the master owns the terminal, the cache and report files.
+        sys.stdout.flush()
+        sys.stderr.flush()
+        os._exit(exitcode)
+
+
+class WorkerChannel(object):
+    """Worker side of the dispatch pipe shared by all threads of a process.
+
+    Units arrive from the master in batches and are kept in a local deque.
+    A receiver thread wakes up waiting threads as soon as a batch (or the
+    stop message) lands, and the next batch is requested while the last
+    local indices are still running, so nothing ever polls the master.
+    The receiver also gives unstarted units back when the master steals
+    them for an idle worker, and drops them all when the master cancels
+    the run.
+
+    Reports travel the other way in batches: they are buffered and sent
+    once enough of them piled up or shortly after the first one arrived.
+    When profiling, the timeline spans of the threads ride along.
+
+    With a concurrency limit set, only that many threads run a unit at a
+    time and the others wait for a slot.
+
+    A worker that ran ``max_tests`` tests or grew beyond ``max_rss`` bytes
+    retires: it hands its unstarted units back, lets the running ones
+    finish and exits, and the master starts a fresh worker instead. So
+    does a worker with a thread stuck in a test past its timeout, once
+    the thread is abandoned.
+    """
+
+    def __init__(self, conn, batch_size, max_tests=None, max_rss=None,
+                 profile=False):
+        self._conn = conn
+        self._profile = profile
+        self._spans = []
+        self._batch_size = batch_size
+        self._max_tests = max_tests
+        self._max_rss = max_rss
+        self._tests_run = 0
+        self._limit = None
+        self._active = 0
+        self._retiring = False
+        self.cancelled = False
+        self._send_lock = threading.Lock()
+        self._cond = threading.Condition()
+        self._items = collections.deque()
+        self._done = []
+        self._requested = False
+        self._stopped = False
+        self._reports_cond = threading.Condition()
+        self._reports = []
+        self._closed = False
+
+    def start(self):
+        for target in (self._receive, self._flush_reports):
+            thread = threading.Thread(target=target)
+            thread.daemon = True
+            thread.start()
+
+    def send(self, event_name, **arguments):
+        data = encode((event_name, arguments))
+        with self._send_lock:
+            self._conn.send_bytes(data)
+
+    def report(self, data):
+        with self._reports_cond:
+            self._reports.append(data)
+            if len(self._reports) >= REPORT_BATCH_SIZE:
+                self._send_reports()
+            elif len(self._reports) == 1:
+                self._reports_cond.notify()
+
+    def record(self, name, category, start, stop):
+        if self._profile:
+            span = (threading.current_thread().name, name, category,
+                    start, stop)
+            with self._reports_cond:
+                self._spans.append(span)
+
+    def _send_reports(self):
+        if self._reports or self._spans:
+            reports, self._reports = self._reports, []
+            spans, self._spans = self._spans, []
+            self.send('reports', reports=reports, spans=spans)
+
+    def _flush_reports(self):
+        with self._reports_cond:
+            while not self._closed:
+                if not (self._reports or self._spans):
+                    self._reports_cond.wait()
+                    continue
+                # give the batch a moment to fill up
+                self._reports_cond.wait(REPORT_FLUSH_INTERVAL)
+                self._send_reports()
+
+    def close(self):
+        with self._reports_cond:
+            self._closed = True
+            self._send_reports()
+            self._reports_cond.notify()
+        with self._cond:
+            self.send('bye', done=self._finished())
+        self._conn.close()
+
+    def assign(self, units):
+        # a worker started for given units runs them and nothing else
+        self._items.extend(units)
+        self._stopped = True
+
+    @property
+    def retired(self):
+        return self._retiring
+
+    def _finished(self):
+        done, self._done = self._done, []
+        self._reports_ahead_of(done)
+        return done
+
+    def _reports_ahead_of(self, units):
+        # The master hears of finished units only after their reports, so
+        # a worker dying in between leaves no test unaccounted for.
+        if units:
+            with self._reports_cond:
+                self._send_reports()
+
+    def _request(self):
+        if not (self._requested or self._stopped or self._retiring):
+            self._requested = True
+            self.send('request', size=self._batch_size, done=self._finished())
+
+    def _give_back(self):
+        count = (len(self._items) + 1) // 2
+        units = [self._items.pop() for _ in range(count)][::-1]
+        self.send('returned', units=units, done=self._finished())
+
+    def _receive(self):
+        while True:
+            try:
+                event_name, kwargs = decode(self._conn.recv_bytes())
+            except (EOFError, OSError):
+                event_name, kwargs = 'closed', {}
+            with self._cond:
+                if event_name == 'units' and self._retiring:
+                    self.send('returned', units=kwargs['units'], done=[])
+                elif event_name == 'units':
+                    self._items.extend(kwargs['units'])
+                    self._requested = False
+                elif event_name == 'steal':
+                    self._give_back()
+                elif event_name in ('stop', 'closed'):
+                    self._stopped = True
+                elif event_name == 'cancel':
+                    self._items.clear()
+                    self._stopped = self.cancelled = True
+                self._cond.notify_all()
+            if event_name == 'closed':
+                break
+
+    def set_limit(self, limit):
+        with self._cond:
+            self._limit = limit
+            self._cond.notify_all()
+
+    def next_unit(self):
+        with self._cond:
+            while True:
+                if self._limit and self._active >= self._limit:
+                    self._cond.wait()
+                elif self._items:
+                    break
+                elif self._stopped or self._retiring:
+                    return None
+                else:
+                    self._request()
+                    self._cond.wait()
+            unit = self._items.popleft()
+            self._active += 1
+            if len(self._items) < self._batch_size:
+                # prefetch the next batch while the local ones run
+                self._request()
+            return unit
+
+    def task_done(self, unit, release=False):
+        with self._cond:
+            if release:
+                # the master waits for the unit's resources right away
+                self._reports_ahead_of([unit])
+                self.send('released', units=[unit])
+            else:
+                self._done.append(unit)
+            self._tests_run += len(unit)
+            self._active -= 1
+            if self._limit:
+                # wake up a thread waiting for the freed slot
+                self._cond.notify_all()
+            if not self._retiring and self._exhausted():
+                self._retire()
+
+    def abandon(self, thread, index, timeout, stack):
+        with self._cond:
+            unit = thread.unit
+            # the tests of the unit that finished before are reported first
+            self._reports_ahead_of([unit])
+            self.send('timeout', unit=unit, index=index, timeout=timeout,
+                      thread_name=thread.name, stack=stack)
+            self._active -= 1
+            if not self._retiring:
+                self._retire()
+            self._cond.notify_all()
+        thread.left.set()
+
+    def _exhausted(self):
+        if self._max_tests and self._tests_run >= self._max_tests:
+            return True
+        return bool(self._max_rss) and current_rss() > self._max_rss
+
+    def _retire(self):
+        self._retiring = True
+        units = list(self._items)
+        self._items.clear()
+        self.send('retire', units=units, done=self._finished())
+        self._cond.notify_all()
+
+
+class SerialLane(object):
+    """Lets units marked parallel_serial run alone in their worker.
+
+    Regular units share the lane, a serial unit waits until the running
+    ones finished and keeps every other thread out while it runs. Waiting
+    serial units go first, so a steady flow of regular units cannot
+    starve them. A unit handed to another thread while it runs acquires
+    the lane and releases it when done, the others ``enter`` it.
+    """
+
+    def __init__(self):
+        self._cond = threading.Condition()
+        self._shared = 0
+        self._serial = False
+        self._waiting = 0
+
+    @contextlib.contextmanager
+    def enter(self, serial):
+        self.acquire(serial)
+        try:
+            yield
+        finally:
+            self.release(serial)
+
+    def acquire(self, serial):
+        with self._cond:
+            if serial:
+                self._waiting += 1
+                while self._serial or self._shared:
+                    self._cond.wait()
+                self._waiting -= 1
+                self._serial = True
+            else:
+                while self._serial or self._waiting:
+                    self._cond.wait()
+                self._shared += 1
+
+    def release(self, serial):
+        with self._cond:
+            if serial:
+                self._serial = False
+            else:
+                self._shared -= 1
+            self._cond.notify_all()
 
 
 class ThreadWorker(threading.Thread):
-    def __init__(self, queue, session, errors):
+    def __init__(self, channel, session, lane, watchdog, timeout=None,
+                 runner=None):
         threading.Thread.__init__(self)
-        self.queue = queue
+        self.daemon = True
+        self.channel = channel
         self.session = session
-        self.errors = errors
+        self.lane = lane
+        self.runner = runner
+        self.watchdog = watchdog
+        self.timeout = timeout
+        self.unit = None
+        self.left = threading.Event()
 
     def run(self):
         pickling_support.install()
+        try:
+            self.run_units()
+        finally:
+            self.left.set()
+
+    def run_units(self):
         while True:
+            started = time.time()
+            unit = self.unit = self.channel.next_unit()
+            self.channel.record('waiting for work', IDLE, started, time.time())
+            if unit is None:
+                break
             try:
-                index = self.queue.get()
-                if index == 'stop':
-                    self.queue.task_done()
-                    break
-            except ConnectionRefusedError:
-                time.sleep(.1)
+                items = self.items(unit)
+            except BaseException:
+                self.channel.send('error', thread_name=self.name,
+                                  errinfo=pickle.dumps(sys.exc_info()))
+                self.channel.task_done(unit)
+                continue
+            serial = any(item.get_closest_marker('parallel_serial')
+                         for item in items)
+            if not serial and self.runner is not None and self.runner.takes(
+                items
+            ):
+                self.runner.submit(unit, items)
                 continue
-            item = self.session.items[index]
+            with self.lane.enter(serial):
+                self.run_unit(unit, items)
+            self.channel.task_done(unit, release=any(
+                item.get_closest_marker('parallel_resources') for item in items
+            ))
+
+    def items(self, unit):
+        collector = getattr(self.session.config, 'parallel_collector', None)
+        if collector is None:
+            return [self.session.items[index] for index in unit]
+        if collector.lacks(unit):
+            # collecting imports and changes the fixtures, which the other
+            # threads may not be in the middle of using
+            with self.lane.enter(True):
+                collector.complete(self.session, unit)
+        return [collector.items[index] for index in unit]
+
+    def run_unit(self, unit, items):
+        for index, item in enumerate(items, 1):
+            # chaining nextitem keeps the fixtures the unit shares alive,
+            # a cancelled run tears them down after this test
+            nextitem = None
+            if index < len(items) and not self.channel.cancelled:
+                nextitem = items[index]
             try:
-                run_test(self.session, item, None)
+                with self.watchdog.watch(unit[index - 1],
+                                         item_timeout(item, self.timeout)):
+                    run_test(self.session, item, nextitem)
+            except Timeout as error:
+                # interrupted outside of its call, the test must not vanish
+                # with its fixtures still set up
+                self.fail_and_tear_down(item, error)
             except BaseException:
-                import pickle
-                import sys
+                self.channel.send('error', thread_name=self.name,
+                                  errinfo=pickle.dumps(sys.exc_info()))
+            if nextitem is None:
+                break
+
+    def fail_and_tear_down(self, item, error):
+        def tear_down():
+            item.ihook.pytest_runtest_teardown(item=item, nextitem=None)
+            raise error
+        call = _pytest.runner.CallInfo.from_call(tear_down, 'teardown')
+        report = item.ihook.pytest_runtest_makereport(item=item, call=call)
+        item.ihook.pytest_runtest_logreport(report=report)
+
+
+# At most this many threads of a worker drive its coroutine tests, however
+# many of them run at a time.
+COROUTINE_THREADS = 4
+
+
+class RunnerThread(threading.Thread):
+    def __init__(self, target, name):
+        threading.Thread.__init__(self, target=target, name=name)
+        self.daemon = True
+        # what the watchdog and the channel know of a ThreadWorker
+        self.unit = None
+        self.left = threading.Event()
+        self.state = None
+
+
+class CoroutineUnit(object):
+    # a unit in flight in the runner, and the context its tests run in
+
+    def __init__(self, unit, items):
+        self.unit = unit
+        self.items = items
+        self.index = 0
+        self.deadline = None
+        self.future = None
+        self.done = False
+        self.context = contextvars.Context()
+
+
+class CoroutineRunner(object):
+    """Runs the units of ``async def`` tests of a worker without a thread
+    waiting for each test in flight.
+
+    A thread worker hands such a unit over and goes on with its next one,
+    as soon as fewer than ``concurrency`` units are in flight. A few
+    threads of the runner take pytest's runtest protocol step by step:
+    they set a test up, start its coroutine on the event loop and go on
+    with other steps, and once the coroutine is done, they report the
+    call and tear the test down. Every unit runs in a context of its own,
+    which holds what is otherwise kept per thread, the setup state,
+    fixtures, output and traced files, and moves with the unit from one
+    thread to the next.
+
+    Plugins wrapping pytest_runtest_protocol do not see these tests, the
+    hooks of their setup, call and teardown all run.
+    """
+
+    def __init__(self, channel, session, lane, watchdog, event_loop,
+                 concurrency, timeout=None):
+        self.channel = channel
+        self.session = session
+        self.lane = lane
+        self.watchdog = watchdog
+        self.event_loop = event_loop
+        self.timeout = timeout
+        self._slots = threading.BoundedSemaphore(concurrency)
+        self._cond = threading.Condition()
+        self._steps = collections.deque()
+        self._in_flight = 0
+        self._closing = False
+        self.threads = [
+            RunnerThread(self._run, 'coroutines-{}'.format(number))
+            for number in range(min(concurrency, COROUTINE_THREADS))
+        ]
+
+    def start(self):
+        for thread in self.threads:
+            thread.start()
+
+    def join(self):
+        with self._cond:
+            self._closing = True
+            self._cond.notify_all()
+        # an abandoned thread left already
+        for thread in self.threads:
+            thread.left.wait()
+
+    def takes(self, items):
+        return all(inspect.iscoroutinefunction(getattr(item, 'obj', None))
+                   for item in items)
+
+    def submit(self, unit, items):
+        self._slots.acquire()
+        self.lane.acquire(False)
+        with self._cond:
+            self._in_flight += 1
+        self._schedule(CoroutineUnit(unit, items), self._begin)
+
+    def abandoned(self, thread):
+        # the watchdog gave up on the thread, the channel on its unit
+        if thread in self.threads and thread.state is not None:
+            self._finish(thread.state, abandoned=True)
+
+    def _schedule(self, state, step):
+        with self._cond:
+            self._steps.append((state, step))
+            self._cond.notify()
+
+    def _run(self):
+        thread = threading.current_thread()
+        tracer = getattr(self.session.config, 'parallel_tracer', None)
+        if tracer is not None:
+            tracer.follow()
+        try:
+            while True:
+                with self._cond:
+                    while not self._steps and not (
+                        self._closing and self._in_flight <= 0
+                    ):
+                        self._cond.wait()
+                    if not self._steps:
+                        break
+                    state, step = self._steps.popleft()
+                thread.unit, thread.state = state.unit, state
+                state.context.run(self._step, state, step)
+        finally:
+            thread.left.set()
+
+    def _step(self, state, step):
+        try:
+            step(state)
+        except BaseException:
+            self.channel.send('error',
+                              thread_name=threading.current_thread().name,
+                              errinfo=pickle.dumps(sys.exc_info()))
+            self._finish(state)
+
+    def _begin(self, state):
+        while not self._setup(state):
+            if not self._teardown(state):
+                self._finish(state)
+                return
+
+    def _call(self, state):
+        item = state.items[state.index]
+        # pytest_pyfunc_call hands on the coroutine's outcome
+        item.parallel_outcome = state.future
+        try:
+            _pytest.runner.call_and_report(item, 'call', log=True)
+        finally:
+            del item.parallel_outcome
+        if self._teardown(state):
+            self._begin(state)
+        else:
+            self._finish(state)
+
+    def _setup(self, state):
+        # returns whether the test's coroutine started
+        item = state.items[state.index]
+        timeout = item_timeout(item, self.timeout)
+        state.deadline = time.time() + timeout if timeout else None
+        tracer = getattr(item.config, 'parallel_tracer', None)
+        if tracer is not None:
+            tracer.start()
+        item.ihook.pytest_runtest_logstart(nodeid=item.nodeid,
+                                           location=item.location)
+        if hasattr(item, '_request') and not item._request:
+            item._initrequest()
+        with self._watch(state):
+            report = _pytest.runner.call_and_report(item, 'setup', log=True)
+        if not report.passed or item.config.getoption('setuponly', False):
+            return False
+        if item.config.getoption('setupshow', False):
+            _pytest.runner.show_test_item(item)
+        start_call = getattr(item.config, 'parallel_start_call', None)
+        if start_call is not None:
+            start_call(item)
+        testargs = {arg: item.funcargs[arg]
+                    for arg in item._fixtureinfo.argnames}
+
+        async def call():
+            return await item.obj(**testargs)
+
+        remaining = self._remaining(state)
+        state.future = self.event_loop.submit(
+            call(), None if remaining is None else max(remaining, 0)
+        )
+        state.future.add_done_callback(
+            lambda future: self._schedule(state, self._call)
+        )
+        return True
 
-                self.errors.put((self.name, pickle.dumps(sys.exc_info())))
-            finally:
-                try:
-                    self.queue.task_done()
-                except ConnectionRefusedError:
-                    pass
+    def _teardown(self, state):
+        # returns whether the unit has another test to run
+        item = state.items[state.index]
+        nextitem = None
+        if state.index + 1 < len(state.items) and not (
+            self.channel.cancelled or self.session.shouldfail
+            or self.session.shouldstop
+        ):
+            nextitem = state.items[state.index + 1]
+        with self._watch(state):
+            _pytest.runner.call_and_report(item, 'teardown', log=True,
+                                           nextitem=nextitem)
+        if hasattr(item, '_request'):
+            item._request = False
+            item.funcargs = None
+        item.ihook.pytest_runtest_logfinish(nodeid=item.nodeid,
+                                            location=item.location)
+        tracer = getattr(item.config, 'parallel_tracer', None)
+        if tracer is not None:
+            tracer.stop()
+        if self.session.shouldstop:
+            raise self.session.Interrupted(self.session.shouldstop)
+        state.index += 1
+        return nextitem is not None
+
+    def _remaining(self, state):
+        if state.deadline is None:
+            return None
+        return state.deadline - time.time()
+
+    def _watch(self, state):
+        remaining = self._remaining(state)
+        # past its deadline, the test gets the watchdog's grace period
+        return self.watchdog.watch(
+            state.unit[state.index],
+            None if remaining is None else max(remaining, 1e-3)
+        )
+
+    def _finish(self, state, abandoned=False):
+        with self._cond:
+            if state.done:
+                return
+            state.done = True
+        if not abandoned:
+            self.channel.task_done(state.unit, release=any(
+                item.get_closest_marker('parallel_resources')
+                for item in state.items
+            ))
+        self.lane.release(False)
+        self._slots.release()
+        with self._cond:
+            self._in_flight -= 1
+            self._cond.notify_all()
 
 
 @pytest.mark.trylast
 def pytest_configure(config):
+    config.addinivalue_line(
+        'markers',
+        'parallel_group(name): with --parallel-dist=loadgroup, run all tests '
+        'of the group on the same worker thread'
+    )
+    config.addinivalue_line(
+        'markers',
+        'parallel_serial: run the test while no other test runs in its worker '
+        'process'
+    )
+    config.addinivalue_line(
+        'markers',
+        'parallel_process_isolated: run the test alone in a fresh worker '
+        'process'
+    )
+    config.addinivalue_line(
+        'markers',
+        'parallel_resources(*names, **amounts): only start the test while '
+        'these resources are free across all workers, see --parallel-resources'
+    )
+    config.addinivalue_line(
+        'markers',
+        'parallel_timeout(seconds): fail the test once it ran this many '
+        'seconds, 0 for no limit, see --parallel-timeout'
+    )
     workers = parse_config(config, 'workers')
     tests_per_worker = parse_config(config, 'tests_per_worker')
-    if not config.option.collectonly and (workers or tests_per_worker):
+    asyncio_concurrency = parse_config(config, 'parallel_asyncio')
+    listen = parse_config(config, 'parallel_listen')
+    if not config.option.collectonly and (
+        workers or tests_per_worker or asyncio_concurrency or listen
+    ):
         config.pluginmanager.register(ParallelRunner(config), 'parallelrunner')
 
 
-class ThreadLocalEnviron(os._Environ):
-    def __init__(self, env):
-        if sys.version_info >= (3, 9):
-            super().__init__(
-                env._data,
-                env.encodekey,
-                env.decodekey,
-                env.encodevalue,
-                env.decodevalue,
-            )
-            self.putenv = os.putenv
-            self.unsetenv = os.unsetenv
-        else:
-            super().__init__(
-                env._data,
-                env.encodekey,
-                env.decodekey,
-                env.encodevalue,
-                env.decodevalue,
-                env.putenv,
-                env.unsetenv
-            )
-        if hasattr(env, 'thread_store'):
-            self.thread_store = env.thread_store
-        else:
-            self.thread_store = threading.local()
-
-    def __getitem__(self, key):
-        if key == 'PYTEST_CURRENT_TEST':
-            if hasattr(self.thread_store, key):
-                value = getattr(self.thread_store, key)
-                return self.decodevalue(value)
-            else:
-                raise KeyError(key) from None
-        return super().__getitem__(key)
-
-    def __setitem__(self, key, value):
-        if key == 'PYTEST_CURRENT_TEST':
-            value = self.encodevalue(value)
-            self.putenv(self.encodekey(key), value)
-            setattr(self.thread_store, key, value)
-        else:
-            super().__setitem__(key, value)
-
-    def __delitem__(self, key):
-        if key == 'PYTEST_CURRENT_TEST':
-            self.unsetenv(self.encodekey(key))
-            if hasattr(self.thread_store, key):
-                delattr(self.thread_store, key)
-            else:
-                raise KeyError(key) from None
-        else:
-            super().__delitem__(key)
-
-    def __iter__(self):
-        if hasattr(self.thread_store, 'PYTEST_CURRENT_TEST'):
-            yield 'PYTEST_CURRENT_TEST'
-        keys = list(self._data)
-        for key in keys:
-            yield self.decodekey(key)
-
-    def __len__(self):
-        return len(self.thread_store.__dict__) + len(self._data)
-
-    def copy(self):
-        return type(self)(self)
-
-
-class ThreadLocalSetupState(threading.local, _pytest.runner.SetupState):
-    def __init__(self):
-        super(ThreadLocalSetupState, self).__init__()
-
-
-class ThreadLocalFixtureDef(threading.local, _pytest.fixtures.FixtureDef):
-    def __init__(self, *args, **kwargs):
-        super(ThreadLocalFixtureDef, self).__init__(*args, **kwargs)
-
-
 class ParallelRunner(object):
     def __init__(self, config):
         self._config = config
-        self._manager = Manager()
         self._log = py.log.Producer('pytest-parallel')
 
         reporter = config.pluginmanager.getplugin('terminalreporter')
@@ -201,35 +1105,202 @@ class ParallelRunner(object):
         reporter.showfspath = False
         reporter._show_progress_info = False
 
+        if getattr(config, 'parallel_worker', False):
+            # a spawned worker reports through the master only
+            config.pluginmanager.unregister(reporter)
+            config.pluginmanager.register(
+                _pytest.terminal.TerminalReporter(config, open(os.devnull, 'w')),
+                'terminalreporter'
+            )
+
+        start_method = parse_config(config, 'parallel_start_method')
+        if not start_method:
+            available = multiprocessing.get_all_start_methods()
+            start_method = 'fork' if 'fork' in available else 'spawn'
+        self.start_method = start_method
+        self.context = multiprocessing.get_context(start_method)
+        if start_method == 'forkserver':
+            preload = parse_config(config, 'parallel_preload') or ''
+            self.context.set_forkserver_preload(
+                ['pytest', 'pytest_parallel'] +
+                [name.strip() for name in preload.split(',') if name.strip()]
+            )
+
+        try:
+            max_tests = parse_config(config, 'max_tests_per_worker')
+            self.max_tests = int(max_tests) if max_tests else None
+        except ValueError:
+            raise ValueError('max_tests_per_worker can only be an integer')
+        try:
+            max_rss = parse_config(config, 'max_worker_rss')
+            self.max_rss = parse_size(max_rss) if max_rss else None
+        except ValueError:
+            raise ValueError('max_worker_rss can only be a size like 512M or 2G')
+        try:
+            self.max_reruns = int(parse_config(config, 'parallel_reruns') or 0)
+        except ValueError:
+            raise ValueError('parallel_reruns can only be an integer')
+        self.reruns = collections.Counter()
+        self.held = collections.defaultdict(list)
+        try:
+            self.timeout = float(parse_config(config, 'parallel_timeout') or 0)
+        except ValueError:
+            raise ValueError('parallel_timeout can only be a number of seconds')
+
         # get the number of workers
         workers = parse_config(config, 'workers')
         try:
             if workers == 'auto':
-                workers = os.cpu_count() or 1
+                # a worker starts out as big as the master, or as big as
+                # it is allowed to grow
+                workers = auto_workers(self.max_rss or current_rss())
             elif workers:
                 workers = int(workers)
             else:
                 workers = 1
-            if workers > 1 and platform.system() == 'Windows':
-                workers = 1
-                print('INFO: pytest-parallel forces 1 worker on Windows')
         except ValueError:
             raise ValueError('workers can only be an integer or "auto"')
+        if workers < 0 or (
+            workers == 0 and not parse_config(config, 'parallel_listen')
+        ):
+            # without agents to run them, no test would run at all
+            raise ValueError('workers can only be 0 with parallel_listen')
 
         self.workers = workers
-
-    @pytest.mark.tryfirst
+        self.durations = collections.defaultdict(float)
+
+        profile = parse_config(config, 'parallel_profile')
+        self.profile = Profile(profile) if profile else None
+        self.shared_dir = None
+        self.impact = None
+        self.isolation = ThreadIsolation()
+        self.collectors = {}
+        self.collected = None
+        self.collected_by = None
+        self.shared_by = {}
+
+    @pytest.mark.trylast
     def pytest_sessionstart(self, session):
-        # make the session threadsafe
-        _pytest.runner.SetupState = ThreadLocalSetupState
+        # make the session, the fixtures and the environment threadsafe,
+        # after the runner gave the session its setup state
+        self.isolation.install(session)
 
-        # ensure that the fixtures (specifically finalizers) are threadsafe
-        _pytest.fixtures.FixtureDef = ThreadLocalFixtureDef
+    def pytest_unconfigure(self, config):
+        self.isolation.uninstall()
 
-        # make the environment threadsafe
-        os.environ = ThreadLocalEnviron(os.environ)
+    def pytest_collection(self, session):
+        if (
+            not parse_config(self._config, 'parallel_collect')
+            or not PARTITIONS_SUPPORTED
+            or getattr(self._config, 'parallel_worker', False)
+            or self.start_method != 'fork' or self.workers < 2
+        ):
+            return None
+        roots = collection_roots(self._config, self.invocation_dir())
+        if roots is None:
+            return None
+        partitions, weights, split = partition(self._config, roots,
+                                               self.workers)
+        shares = assign(weights, self.workers)
+        if len(shares) < 2:
+            return None
+        for share in shares:
+            conn, worker_conn = self.context.Pipe()
+            collector = PartitionCollector(partitions, split)
+            process = self.context.Process(
+                target=collect_with_threads,
+                args=(self._config, worker_conn, session, collector, share)
+            )
+            process.start()
+            worker_conn.close()
+            self.collectors[conn] = process, share
+        self.merge_collected(session, partitions, sorted(split))
+        return True
+
+    def merge_collected(self, session, partitions, split):
+        """Take the items the workers collected as the items of the run,
+        in the order a single process collects them."""
+        config = self._config
+        described, deselected, reports = [], [], []
+        pending = dict(self.collectors)
+        while pending:
+            for conn in wait(list(pending)):
+                process, share = pending.pop(conn)
+                try:
+                    _, collected = decode(conn.recv_bytes())
+                except (EOFError, OSError):
+                    process.join()
+                    collected = {'error': 'the worker collecting them exited '
+                                          'with {}'.format(process.exitcode)}
+                if collected['error']:
+                    # the worker left, its partitions fail to collect
+                    conn.close()
+                    process.join()
+                    del self.collectors[conn]
+                    for index in share:
+                        nodeid = os.path.relpath(
+                            partitions[index], root_dir(config)
+                        ).replace(os.sep, '/')
+                        reports.append(_pytest.reports.CollectReport(
+                            nodeid, 'failed', collected['error'], []
+                        ))
+                    continue
+                described.extend(
+                    ((-1 if owner is None else owner, position), conn,
+                     description, owner)
+                    for position, (*description, owner)
+                    in enumerate(collected['items'])
+                )
+                for key in collected['shared']:
+                    self.shared_by.setdefault(key, conn)
+                deselected.extend(collected['deselected'])
+                reports.extend(
+                    config.hook.pytest_report_from_serializable(config=config,
+                                                                data=data)
+                    for data in collected['reports']
+                )
+        items, owners = [], {}
+        # items collected outside of the partitions come from every worker
+        for _, conn, description, owner in sorted(described,
+                                                  key=lambda item: item[0]):
+            if description[0] not in owners:
+                owners[description[0]] = owner, conn
+                items.append(CollectedItem.from_description(session, description))
+        deselected = [CollectedItem.from_description(session, description)
+                      for description in deselected]
+        for report in reports:
+            config.hook.pytest_collectreport(report=report)
+        config.hook.pytest_collectreport(report=_pytest.reports.CollectReport(
+            '', 'passed', None, items + deselected
+        ))
+        if deselected:
+            config.hook.pytest_deselected(items=deselected)
+        self.pytest_collection_modifyitems(session, config, items)
+        session.items = items
+        session.testscollected = len(items)
+        self.collected = {
+            'partitions': partitions,
+            'split': split,
+            'nodeids': [item.nodeid for item in items],
+            'owners': [owners[item.nodeid][0] for item in items],
+        }
+        self.collected_by = [owners[item.nodeid][1] for item in items]
+        config.hook.pytest_collection_finish(session=session)
+
+    def stop_collectors(self):
+        # workers still waiting for the tests after the collection failed
+        for conn, (process, _) in self.collectors.items():
+            # workers forked later hold this pipe as well, it never reads
+            # as closed
+            self.send_to(conn, 'stop')
+            conn.close()
+            process.join()
+        self.collectors = {}
 
     def pytest_runtestloop(self, session):
+        if getattr(self._config, 'parallel_worker', False):
+            return self._config.parallel_worker_session.run(session)
+
         if (
             session.testsfailed
             and not session.config.option.continue_on_collection_errors
@@ -242,20 +1313,30 @@ class ParallelRunner(object):
         if session.config.option.collectonly:
             return True
 
+        try:
+            asyncio_concurrency = int(
+                parse_config(session.config, 'parallel_asyncio') or 0
+            )
+        except ValueError:
+            raise ValueError('parallel_asyncio can only be an integer')
+
         # get the number of tests per worker
         tests_per_worker = parse_config(session.config, 'tests_per_worker')
+        dynamic = tests_per_worker == 'dynamic'
         try:
-            if tests_per_worker == 'auto':
-                tests_per_worker = 50
+            if tests_per_worker in ('auto', 'dynamic'):
+                tests_per_worker = DYNAMIC_MAX_THREADS
             if tests_per_worker:
                 tests_per_worker = int(tests_per_worker)
-                evenly_divided = math.ceil(len(session.items)/self.workers)
+                evenly_divided = math.ceil(
+                    len(session.items) / max(self.workers, 1)
+                )
                 tests_per_worker = min(tests_per_worker, evenly_divided)
             else:
                 tests_per_worker = 1
         except ValueError:
             raise ValueError(('tests_per_worker can only be '
-                              'an integer or "auto"'))
+                              'an integer, "auto" or "dynamic"'))
 
         if self.workers > 1:
             worker_noun, process_noun = ('workers', 'processes')
@@ -267,110 +1348,620 @@ class ParallelRunner(object):
         else:
             test_noun, thread_noun = ('test', 'thread')
 
-        print('pytest-parallel: {} {} ({}), {} {} per worker ({})'
+        coroutines = ''
+        if asyncio_concurrency:
+            coroutines = ', up to {} coroutine test{} at a time'.format(
+                asyncio_concurrency, 's' if asyncio_concurrency > 1 else ''
+            )
+        print('pytest-parallel: {} {} ({}), {}{} {} per worker ({}){}'
               .format(self.workers, worker_noun, process_noun,
-                      tests_per_worker, test_noun, thread_noun))
-
-        queue_cls = self._manager.Queue
-        queue = queue_cls()
-        errors = queue_cls()
-
-        # Reports about tests will be gathered from workerss
-        # using this queue. Workers will push reports to the queue,
-        # and a separate thread will rerun pytest_runtest_logreport
-        # for them.
-        # This way, report generators like JUnitXML will work as expected.
-        self.responses_queue = queue_cls()
-
-        for i in range(len(session.items)):
-            queue.put(i)
-
-        # Now we need to put stopping sentinels, so that worker
-        # processes will know, there is time to finish the work.
-        for i in range(self.workers * tests_per_worker):
-            queue.put('stop')
-
-        responses_processor = threading.Thread(
-            target=self.process_responses,
-            args=(self.responses_queue,),
-        )
-        responses_processor.daemon = True
-        responses_processor.start()
+                      'up to ' if dynamic else '', tests_per_worker,
+                      test_noun, thread_noun, coroutines))
 
-        def wait_for_responses_processor():
-            self.responses_queue.put(('quit', {}))
-            responses_processor.join()
+        if self.impact is not None and self.impact.stale and (
+            parse_config(self._config, 'parallel_impact') == 'select'
+        ):
+            print('pytest-parallel: no valid test impact map, running all '
+                  'tests to record it')
+
+        self.errors = []
+        self.session = session
+        self.indices = {item.nodeid: index
+                        for index, item in enumerate(session.items)}
+        self.running = collections.defaultdict(set)
+        self.finished = set()
+        self.crashes = collections.Counter()
+        self.suspects = set()
+        self.timed_out = set()
 
-        processes = []
+        try:
+            self.progress_interval = float(
+                parse_config(self._config, 'parallel_progress') or 0
+            )
+        except ValueError:
+            raise ValueError('parallel_progress can only be a number of seconds')
+
+        # Test units are handed out and reports come back over one pipe per
+        # worker. The scheduler and the report processing both live in the
+        # master's main thread, so report generators like JUnitXML work
+        # as expected without going through a proxy server.
+        durations = self.estimates = self.estimated_durations(session.items)
+        units = group_units(
+            session.items, parse_config(self._config, 'parallel_dist')
+        )
+        units, isolated = split_isolated(units, [
+            index for index, item in enumerate(session.items)
+            if item.get_closest_marker('parallel_process_isolated')
+        ])
+        costs = {unit: sum(durations[i] for i in unit)
+                 for unit in units + isolated}
+        self.progress = Progress({
+            item.nodeid: duration
+            for item, duration in zip(session.items, durations)
+        })
+        self.progress_shown = time.time()
+        if parse_config(self._config, 'parallel_order') != 'collection':
+            # Longest processing time first: the slowest tests start early
+            # instead of holding the run open at the end.
+            units.sort(key=lambda unit: -costs[unit])
+            isolated.sort(key=lambda unit: -costs[unit])
+        needs, pool = self.resource_needs(session.items, units)
+        affinity = None
+        if self.collectors:
+            # workers start with the tests they collected
+            affinity = {unit: self.collected_by[unit[0]] for unit in units}
+        self.scheduler = Scheduler(units, costs, self.send_to,
+                                   max(self.workers, 1), needs, pool, affinity)
 
         # Current process is not a worker.
         # This flag will be changed after the worker's fork.
         self._config.parallel_worker = False
 
-        args = (self._config, queue, session, tests_per_worker, errors)
-        for _ in range(self.workers):
-            process = Process(target=process_with_threads, args=args)
-            process.start()
-            processes.append(process)
-
-        [p.join() for p in processes]
+        settings = {
+            'tests_per_worker': tests_per_worker,
+            'dynamic': dynamic and tests_per_worker > 1,
+            'asyncio_concurrency': asyncio_concurrency,
+            'max_tests': self.max_tests,
+            'max_rss': self.max_rss,
+            'timeout': self.timeout or None,
+            'capture': parse_config(self._config, 'parallel_capture') or (
+                'thread' if max(tests_per_worker, asyncio_concurrency) > 1
+                else 'process'
+            ),
+            'profile': self.profile is not None,
+            'units': None,
+            'shared': self.share_fixtures(session.items),
+            'impact': self.impact is not None,
+            'collect': self.collected,
+        }
+        if self.start_method == 'fork':
+            self.worker_target = process_with_threads
+            self.worker_args = (self._config, session, settings)
+        else:
+            self.worker_target = remote_worker
+            self.worker_args = (self.invocation_args(), self.invocation_dir(),
+                                [item.nodeid for item in session.items],
+                                settings)
+
+        if self.profile is not None:
+            self.profile.start()
+        self.coordinator = None
+        listen = parse_config(self._config, 'parallel_listen')
+        if listen:
+            self.coordinator = Coordinator(
+                listen,
+                authkey_from(parse_config(self._config, 'parallel_authkey')),
+                encode(('setup', {
+                    'args': self.invocation_args(),
+                    'nodeids': [item.nodeid for item in session.items],
+                    'settings': settings,
+                }))
+            )
+            self.coordinator.start()
+            print('pytest-parallel: accepting agents on {}'.format(
+                self.coordinator.address
+            ))
+            if self.coordinator.generated:
+                print('pytest-parallel: connect with "pytest-parallel worker '
+                      '--connect {} --authkey {}"'.format(
+                          self.coordinator.address,
+                          self.coordinator.authkey.decode('utf-8')))
+
+        self.processes = {}
+        self.retired = set()
+        self.exited = set()
+        for conn, (process, _) in self.collectors.items():
+            self.processes[conn] = process
+            self.send_to(conn, 'start', settings=settings)
+        self.collectors = {}
+        while len(self.processes) < self.workers:
+            self.start_worker()
+        # process isolated tests run one after the other, each in a fresh
+        # single threaded worker next to the regular ones
+        self.isolated = collections.deque(isolated)
+        self.isolated_workers = {}
+        self.start_isolated()
 
-        queue.join()
-        wait_for_responses_processor()
+        try:
+            self.dispatch()
+        finally:
+            if self.coordinator is not None:
+                self.coordinator.close()
 
-        if not errors.empty():
+        if self.errors:
             import six
-            import pickle
 
-            thread_name, errinfo = errors.get()
+            thread_name, errinfo = self.errors[0]
             err = pickle.loads(errinfo)
             err[1].__traceback__ = err[2]
 
             exc = RuntimeError(
                 "pytest-parallel got {} errors, raising the first from {}."
-                .format(errors.qsize() + 1, thread_name)
+                .format(len(self.errors), thread_name)
             )
 
             six.raise_from(exc, err[1])
 
         return True
 
-    def send_response(self, event_name, **arguments):
-        self.responses_queue.put((event_name, arguments))
+    def resource_needs(self, items, units):
+        needs = {}
+        for unit in units:
+            unit_needs = {}
+            for index in unit:
+                # the items of a unit run one after the other
+                for name, amount in resource_needs(items[index]).items():
+                    unit_needs[name] = max(unit_needs.get(name, 0), amount)
+            if unit_needs:
+                needs[unit] = unit_needs
+        if not needs:
+            return needs, None
+        try:
+            capacities = parse_resources(
+                parse_config(self._config, 'parallel_resources')
+            )
+        except ValueError:
+            raise ValueError('parallel_resources can only be NAME=AMOUNT pairs '
+                             'like "db=8,memory=16G"')
+        pool = ResourcePool(capacities)
+        for unit, unit_needs in needs.items():
+            pool.check(items[unit[0]].nodeid, unit_needs)
+        return needs, pool
+
+    @pytest.mark.trylast
+    def pytest_collection_modifyitems(self, session, config, items):
+        mode = parse_config(config, 'parallel_impact')
+        if not mode or getattr(config, 'parallel_worker', False):
+            return
+        self.impact = ImpactMap(getattr(config, 'cache', None),
+                                root_dir(config), environment(config))
+        if mode == 'select':
+            items[:], deselected = self.impact.select(items)
+            if deselected:
+                config.hook.pytest_deselected(items=deselected)
+
+    def share_fixtures(self, items):
+        functions = shared_fixtures(items)
+        keys = set(functions) | set(self.shared_by)
+        if not keys:
+            return {}
+        self.shared_dir = tempfile.mkdtemp(prefix='pytest-parallel-')
+        paths = {
+            key: os.path.join(self.shared_dir, '{}.pickle'.format(number))
+            for number, key in enumerate(sorted(keys))
+        }
+        shared = dump_values(functions, paths)
+        # a worker that collected a test using a fixture computes it for
+        # all, they compute theirs side by side
+        requested = collections.defaultdict(dict)
+        for key, conn in self.shared_by.items():
+            requested[conn][key] = paths[key]
+        for conn, conn_paths in requested.items():
+            self.send_to(conn, 'share', paths=conn_paths)
+        for conn in requested:
+            try:
+                _, kwargs = decode(conn.recv_bytes())
+            except (EOFError, OSError):
+                # the workers compute the values the crashed one did not
+                continue
+            shared.update(kwargs['paths'])
+        return shared
+
+    def invocation_args(self):
+        invocation_params = getattr(self._config, 'invocation_params', None)
+        if invocation_params is not None:
+            return invocation_params.args
+        return sys.argv[1:]
+
+    def invocation_dir(self):
+        invocation_params = getattr(self._config, 'invocation_params', None)
+        if invocation_params is not None:
+            return str(invocation_params.dir)
+        return str(self._config.invocation_dir)
+
+    def estimated_durations(self, items):
+        # Tests without a recorded duration are assumed to be typical ones.
+        cache = getattr(self._config, 'cache', None)
+        recorded = cache.get(DURATIONS_KEY, {}) if cache else {}
+        known = [recorded[item.nodeid] for item in items
+                 if item.nodeid in recorded]
+        default = statistics.median(known) if known else 1.0
+        return [recorded.get(item.nodeid, default) for item in items]
+
+    def profiling(self):
+        return (self.profile is not None
+                and not getattr(self._config, 'parallel_worker', False))
+
+    def pytest_terminal_summary(self, terminalreporter):
+        if self.reruns:
+            terminalreporter.write_sep('-', 'pytest-parallel reruns')
+            for nodeid, count in sorted(self.reruns.items()):
+                terminalreporter.write_line('{} ran {} more time{}'.format(
+                    nodeid, count, 's' if count > 1 else ''
+                ))
+        if self.profiling():
+            terminalreporter.write_sep('-', 'pytest-parallel profile')
+            for line in self.profile.summary():
+                terminalreporter.write_line(line)
+
+    def pytest_sessionfinish(self, session):
+        self.stop_collectors()
+        # collection errors end the run before the workers were set up
+        worker = getattr(self._config, 'parallel_worker', False)
+        if self.impact is not None and not worker:
+            self.impact.save()
+        if self.shared_dir is not None:
+            shutil.rmtree(self.shared_dir, ignore_errors=True)
+        if self.profiling():
+            self.profile.finish()
+            self.profile.write()
+        cache = getattr(self._config, 'cache', None)
+        if cache is None or not self.durations:
+            return
+        recorded = cache.get(DURATIONS_KEY, {})
+        recorded.update(self.durations)
+        cache.set(DURATIONS_KEY, recorded)
+
+    def start_worker(self, units=None):
+        conn, worker_conn = self.context.Pipe()
+        args = (worker_conn,) + self.worker_args
+        if self.worker_target is process_with_threads:
+            args = (self._config, worker_conn) + self.worker_args[1:]
+        if units is not None:
+            settings = dict(args[-1], units=units, tests_per_worker=1,
+                            dynamic=False)
+            args = args[:-1] + (settings,)
+        process = self.context.Process(target=self.worker_target, args=args)
+        process.start()
+        # only the worker holds its end, so a dead worker reads as EOF
+        worker_conn.close()
+        self.processes[conn] = process
+        return conn
+
+    def start_isolated(self):
+        if self.isolated and not self.scheduler.cancelled:
+            unit = self.isolated.popleft()
+            self.isolated_workers[self.start_worker([unit])] = unit
+
+    def dispatch(self):
+        while self.processes or (
+            # without local workers, wait for agents to do the work
+            self.coordinator is not None and self.scheduler.has_work()
+        ):
+            waitables = list(self.processes)
+            if self.coordinator is not None:
+                waitables.append(self.coordinator.ready)
+            for conn in wait(waitables):
+                if self.coordinator is not None and (
+                    conn is self.coordinator.ready
+                ):
+                    self.on_agents()
+                    continue
+                try:
+                    event_name, kwargs = decode(conn.recv_bytes())
+                except (EOFError, OSError):
+                    self.on_exit(conn)
+                    continue
+                started = time.time()
+                getattr(self, 'on_' + event_name)(conn, **kwargs)
+                if self.profile is not None:
+                    self.profile.record(event_name, started)
+
+    def on_agents(self):
+        for conn, agent in self.coordinator.joined():
+            self.processes[conn] = agent
+        self.scheduler.workers = max(len(self.processes), 1)
+
+    def local_workers(self):
+        return [process for process in self.processes.values()
+                if not getattr(process, 'remote', False)]
+
+    def on_exit(self, conn):
+        conn.close()
+        process = self.processes.pop(conn)
+        process.join()
+        # a worker leaves with a bye, or without one after it failed to
+        # start, which raises the error at the end of the run
+        crashed = conn not in self.exited and getattr(
+            process, 'exitcode', None
+        ) not in (0, RETIRED_EXIT_CODE)
+        if crashed:
+            self.on_crash(conn, process)
+        elif conn in self.exited:
+            # units sent after the worker decided to leave were never started
+            self.scheduler.release(conn)
+        if conn in self.isolated_workers:
+            del self.isolated_workers[conn]
+            self.start_isolated()
+        if getattr(process, 'remote', False):
+            # agents replace their retired and crashed workers by
+            # connecting again
+            return
+        # reruns may be queued after the other workers were stopped
+        while len(self.local_workers()) < self.workers and (
+            self.scheduler.has_work() if conn in self.retired or crashed
+            else conn in self.exited and self.scheduler.has_pending()
+        ):
+            self.start_worker()
+
+    def on_crash(self, conn, process):
+        """Requeue what a dead worker did not finish.
+
+        Tests the worker was running are retried alone in fresh workers,
+        so the one that takes workers down is found without failing the
+        tests it ran next to. A test that takes down the worker it runs
+        alone in is retried once more and then reported as crashed. Tests
+        that were not known to run are queued again like any other, and
+        run alone when they are caught in a crash again.
+        """
+        exitcode = getattr(process, 'exitcode', None)
+        if exitcode is None:
+            reason = 'lost the connection to worker {}'.format(process.pid)
+        elif exitcode < 0:
+            reason = 'worker {} crashed with signal {}'.format(
+                process.pid, signal.Signals(-exitcode).name
+            )
+        else:
+            reason = 'worker {} crashed with exit code {}'.format(
+                process.pid, exitcode
+            )
+        running = self.running.pop(conn, set())
+        isolated = self.isolated_workers.get(conn)
+        units = [isolated] if isolated else self.scheduler.crashed(conn)
+        for unit, index in ((unit, index) for unit in units for index in unit):
+            if index in self.finished:
+                continue
+            if isolated:
+                self.crashes[index] += 1
+                if self.crashes[index] > 1:
+                    self.report_failure(index, reason, 'call')
+                    continue
+            # the reports of the interrupted run go with it
+            self.held.pop(self.session.items[index].nodeid, None)
+            if isolated or index in running or index in self.suspects:
+                self.isolated.append((index,))
+            else:
+                self.suspects.add(index)
+                self.scheduler.rerun(conn, (index,), self.estimates[index],
+                                     self.scheduler.needs.get(unit))
+        if not self.isolated_workers:
+            self.start_isolated()
+
+    def report_failure(self, index, longrepr, when='setup'):
+        """Report a test its worker cannot report anymore as failed.
+
+        The test fails in ``when``, or in the phase after the last one it
+        reported, if that is later.
+        """
+        item = self.session.items[index]
+        phases = ['setup', 'call', 'teardown']
+        # the reports of the interrupted run that arrived are still held
+        for report in self.held.pop(item.nodeid, []):
+            self.log_report(report)
+            # a test that did not pass its setup goes on with its teardown
+            after = 'call' if report.when == 'setup' and report.passed else (
+                'teardown'
+            )
+            when = max(when, after, key=phases.index)
+        reports = [(when, 'failed', longrepr)]
+        if when != 'teardown':
+            reports.append(('teardown', 'passed', None))
+        keywords = {name: 1 for name in item.keywords}
+        for when, outcome, longrepr in reports:
+            self.log_report(_pytest.reports.TestReport(
+                item.nodeid, item.location, keywords, outcome, longrepr, when
+            ))
+
+    def on_timeout(self, conn, unit, index, timeout, thread_name, stack):
+        # the abandoned thread may still get to report the test later
+        self.timed_out.add((conn, index))
+        self.running[conn].discard(index)
+        self.finished.add(index)
+        self.report_failure(index, (
+            'Timeout: {} ran longer than {:g}s and could not be stopped, its '
+            'worker {} retires\n\nStack of {}:\n{}'.format(
+                self.session.items[index].nodeid, timeout,
+                self.processes[conn].pid, thread_name, stack
+            )
+        ))
+        self.scheduler.finish(conn, [unit])
+        # the tests of the unit after the stuck one did not run
+        rest = unit[unit.index(index) + 1:]
+        if rest:
+            self.scheduler.rerun(conn, rest,
+                                 sum(self.estimates[i] for i in rest),
+                                 self.scheduler.needs.get(unit))
+
+    def send_to(self, conn, event_name, **arguments):
+        try:
+            conn.send_bytes(encode((event_name, arguments)))
+        except OSError:
+            # the worker already left; whatever it was sent is released
+            # back to the scheduler once its pipe reports EOF
+            pass
+
+    def on_request(self, conn, size, done):
+        self.scheduler.request(conn, size, done)
+
+    def on_released(self, conn, units):
+        self.scheduler.released(conn, units)
+
+    def on_returned(self, conn, units, done):
+        self.scheduler.returned(conn, units, done)
+
+    def on_retire(self, conn, units, done):
+        self.retired.add(conn)
+        self.scheduler.retire(conn, units, done)
+
+    def on_bye(self, conn, done):
+        self.exited.add(conn)
+        self.scheduler.finish(conn, done)
+
+    @pytest.mark.tryfirst
+    def pytest_fixture_setup(self, fixturedef, request):
+        event_loop = getattr(self._config, 'parallel_event_loop', None)
+        if event_loop is not None:
+            event_loop.wrap_fixture(fixturedef)
+
+    @pytest.mark.tryfirst
+    def pytest_pyfunc_call(self, pyfuncitem):
+        event_loop = getattr(self._config, 'parallel_event_loop', None)
+        if event_loop is None or not inspect.iscoroutinefunction(pyfuncitem.obj):
+            return None
+        outcome = getattr(pyfuncitem, 'parallel_outcome', None)
+        if outcome is not None:
+            # the coroutine already ran, see CoroutineRunner
+            outcome.result()
+            return True
+        funcargs = pyfuncitem.funcargs
+        testargs = {arg: funcargs[arg]
+                    for arg in pyfuncitem._fixtureinfo.argnames}
+        event_loop.run(pyfuncitem.obj(**testargs))
+        return True
+
+    @pytest.hookimpl(hookwrapper=True, trylast=True)
+    def pytest_runtest_call(self, item):
+        # the watchdog only interrupts the test itself, the reports and
+        # teardown around it always run
+        watchdog = getattr(self._config, 'parallel_watchdog', None)
+        if watchdog is None:
+            yield
+            return
+        with watchdog.interruptible():
+            yield
+
+    @pytest.hookimpl(hookwrapper=True)
+    def pytest_runtest_protocol(self, item, nextitem):
+        tracer = getattr(self._config, 'parallel_tracer', None)
+        if tracer is None:
+            yield
+            return
+        tracer.start()
+        try:
+            yield
+        finally:
+            tracer.stop()
 
     def pytest_runtest_logreport(self, report):
         # We want workers to report to it's master.
         # Without this "if", master will try to report to itself.
         if self._config.parallel_worker:
+            tracer = getattr(self._config, 'parallel_tracer', None)
+            if tracer is not None and report.when == 'teardown':
+                # the master keeps the files in the impact map
+                report.parallel_files = tracer.files()
             data = self._config.hook.pytest_report_to_serializable(
                 config=self._config, report=report
             )
-            self.send_response('testreport', report=data)
+            self._config.parallel_channel.report(data)
+            # reports only carry their start and stop since pytest 7.1
+            stop = getattr(report, 'stop', None) or time.time()
+            start = getattr(report, 'start', None) or stop - report.duration
+            self._config.parallel_channel.record(
+                report.nodeid, report.when, start, stop
+            )
 
-    def on_testreport(self, report):
+    def on_reports(self, conn, reports, spans=()):
+        if spans and self.profile is not None:
+            self.profile.add(self.processes[conn].pid, spans)
+        for report in reports:
+            try:
+                self.on_testreport(conn, report)
+            except BaseException:
+                self._log('Exception during calling callback', 'on_testreport')
+        now = time.time()
+        if self.progress_interval and (
+            now - self.progress_shown >= self.progress_interval
+        ):
+            self.progress_shown = now
+            reporter = self._config.pluginmanager.getplugin('terminalreporter')
+            if reporter is not None:
+                if reporter.currentfspath is None:
+                    # finish the line of progress letters first
+                    reporter.currentfspath = -2
+                reporter.write_line(self.progress.line())
+
+    def on_error(self, conn, thread_name, errinfo):
+        self.errors.append((thread_name, errinfo))
+
+    def on_testreport(self, conn, report):
         report = self._config.hook.pytest_report_from_serializable(
             config=self._config, data=report
         )
-        self._config.hook.pytest_runtest_logreport(report=report)
-
-    def process_responses(self, queue):
-        while True:
-            try:
-                event_name, kwargs = queue.get()
-                if event_name == 'quit':
-                    break
-            except ConnectionRefusedError:
-                time.sleep(.1)
-                continue
+        index = self.indices[report.nodeid]
+        if (conn, index) in self.timed_out:
+            return
+        if report.when == 'setup':
+            self.running[conn].add(index)
+        elif report.when == 'teardown':
+            self.running[conn].discard(index)
+            self.finished.add(index)
+        # hold the reports of a test until it is clear whether it reruns,
+        # or was cut short by a crash
+        held = self.held[report.nodeid]
+        held.append(report)
+        if report.when != 'teardown':
+            return
+        del self.held[report.nodeid]
+        if self.rerun(conn, held):
+            return
+        for report in held:
+            if report.when == 'call' and self.reruns[report.nodeid]:
+                report.user_properties.append(
+                    ('parallel_reruns', self.reruns[report.nodeid])
+                )
+            self.log_report(report)
+
+    def rerun(self, conn, reports):
+        nodeid = reports[0].nodeid
+        if self.scheduler.cancelled or self.reruns[nodeid] >= self.max_reruns or (
+            not any(report.failed for report in reports if report.when == 'call')
+        ):
+            return False
+        self.reruns[nodeid] += 1
+        reporter = self._config.pluginmanager.getplugin('terminalreporter')
+        if reporter is not None:
+            reporter.stats.setdefault('rerun', []).extend(
+                report for report in reports if report.when == 'call'
+            )
+        index = self.indices[nodeid]
+        self.finished.discard(index)
+        item = self.session.items[index]
+        if item.get_closest_marker('parallel_process_isolated'):
+            self.isolated.appendleft((index,))
+            return True
+        self.scheduler.rerun(conn, (index,),
+                             sum(report.duration for report in reports),
+                             resource_needs(item))
+        return True
 
-            callback_name = 'on_' + event_name
-            try:
-                callback = getattr(self, callback_name)
-                callback(**kwargs)
-            except BaseException:
-                self._log('Exception during calling callback', callback_name)
-            finally:
-                try:
-                    queue.task_done()
-                except ConnectionRefusedError:
-                    pass
+    def log_report(self, report):
+        self.durations[report.nodeid] += report.duration
+        self.progress.update(report)
+        if self.impact is not None:
+            self.impact.update(report)
+        self._config.hook.pytest_runtest_logreport(report=report)
+        if self.session.shouldfail or self.session.shouldstop:
+            # -x, --maxfail or a plugin ends the run: stop every worker
+            # instead of only the one whose test tripped it
+            self.scheduler.cancel()
@@ -0,0 +1,38 @@
+import sys
+
+USAGE = '''usage: pytest-parallel daemon [pytest args]   start a warm daemon here
+       pytest-parallel daemon --stop          stop the daemon serving here
+       pytest-parallel run [pytest args]      run tests on the daemon
+       pytest-parallel worker --connect HOST:PORT [--authkey KEY]
+                                              [--timeout SECONDS]
+                                              run tests for a coordinator
+'''
+
+
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else argv
+    command, args = (argv[0], argv[1:]) if argv else (None, [])
+
+    if command == 'daemon':
+        from . import daemon
+        return daemon.stop() if args == ['--stop'] else daemon.serve(args)
+    if command == 'run':
+        from . import daemon
+        return daemon.run(args)
+    if command == 'worker':
+        import argparse
+        from . import remote
+        parser = argparse.ArgumentParser(prog='pytest-parallel worker')
+        parser.add_argument('--connect', required=True, metavar='HOST:PORT')
+        parser.add_argument('--authkey')
+        parser.add_argument('--timeout', type=float, default=30,
+                            help='seconds to wait for the coordinator')
+        options = parser.parse_args(args)
+        return remote.serve(options.connect, options.authkey, options.timeout)
+
+    sys.stderr.write(USAGE)
+    return 2
+
+
+if __name__ == '__main__':
+    sys.exit(main())
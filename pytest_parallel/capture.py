@@ -0,0 +1,225 @@
+import io
+import sys
+import logging
+import contextlib
+
+import _pytest.capture
+import _pytest.logging
+
+
+class Buffers(object):
+    """The captured output of the test a thread runs."""
+
+    __slots__ = ('out', 'err', 'capturing')
+
+    def __init__(self):
+        self.out = io.StringIO()
+        self.err = io.StringIO()
+        self.capturing = False
+
+
+class CaptureStream(object):
+    """Writes to the buffers of the writing thread while it captures, and
+    to ``stream`` otherwise, or to both with ``tee``."""
+
+    def __init__(self, stream, buffers, name, tee=False):
+        self._stream = stream
+        self._buffers = buffers
+        self._name = name
+        self._tee = tee
+
+    def write(self, data):
+        buffers = self._buffers.get(None)
+        if buffers is None or not buffers.capturing:
+            return self._stream.write(data)
+        if self._tee:
+            self._stream.write(data)
+        return getattr(buffers, self._name).write(data)
+
+    def writelines(self, lines):
+        for line in lines:
+            self.write(line)
+
+    def flush(self):
+        self._stream.flush()
+
+    def isatty(self):
+        buffers = self._buffers.get(None)
+        if buffers is not None and buffers.capturing:
+            return False
+        return self._stream.isatty()
+
+    def __getattr__(self, name):
+        return getattr(self._stream, name)
+
+
+class ThreadCapture(object):
+    """Takes the place of pytest's global capture in a worker whose threads
+    run several tests at a time.
+
+    pytest captures by redirecting the process-wide file descriptors or
+    sys.stdout and sys.stderr, so concurrent tests would read each other's
+    output. Here sys.stdout and sys.stderr are replaced once, by streams
+    that write to buffers of the thread writing, and sys.stdin by one that
+    cannot be read. The buffers live in a
+    context variable, so the tasks an ``async def`` test runs on the event
+    loop thread write to the buffers of its thread as well. The capture
+    manager resumes, suspends and reads the buffers of the thread it runs
+    in, which puts every test's output in its own report sections.
+
+    Output written to the file descriptors directly, by subprocesses or C
+    extensions, is not captured.
+    """
+
+    def __init__(self, tee=False):
+        import contextvars
+        self._buffers = contextvars.ContextVar('pytest_parallel_capture')
+        self._tee = tee
+        self._streams = None
+
+    def _current(self):
+        buffers = self._buffers.get(None)
+        if buffers is None:
+            buffers = Buffers()
+            self._buffers.set(buffers)
+        return buffers
+
+    def start_capturing(self):
+        self._streams = sys.stdout, sys.stderr, sys.stdin
+        sys.stdout = CaptureStream(sys.stdout, self._buffers, 'out', self._tee)
+        sys.stderr = CaptureStream(sys.stderr, self._buffers, 'err', self._tee)
+        # reading stdin fails like it does while pytest captures
+        sys.stdin = _pytest.capture.DontReadFromInput()
+
+    def stop_capturing(self):
+        if self._streams is not None:
+            sys.stdout, sys.stderr, sys.stdin = self._streams
+            self._streams = None
+
+    def is_started(self):
+        return self._streams is not None
+
+    def resume_capturing(self):
+        self._current().capturing = True
+
+    def suspend_capturing(self, in_=False):
+        self._current().capturing = False
+
+    def readouterr(self):
+        buffers = self._current()
+        out, err = buffers.out.getvalue(), buffers.err.getvalue()
+        buffers.out, buffers.err = io.StringIO(), io.StringIO()
+        return _pytest.capture.CaptureResult(out, err)
+
+    def pop_outerr_to_orig(self):
+        out, err = self.readouterr()
+        if self._streams is not None:
+            self._streams[0].write(out)
+            self._streams[1].write(err)
+
+
+class ThreadLogCaptureHandler(_pytest.logging.LogCaptureHandler):
+    """A LogCaptureHandler that keeps records and text per thread, like
+    ThreadCapture does for the output."""
+
+    def __init__(self, handler):
+        import contextvars
+        self._state = contextvars.ContextVar('pytest_parallel_log')
+        super(ThreadLogCaptureHandler, self).__init__()
+        self.setFormatter(handler.formatter)
+        self.setLevel(handler.level)
+
+    def _current(self):
+        state = self._state.get(None)
+        if state is None:
+            state = [[], io.StringIO()]
+            self._state.set(state)
+        return state
+
+    @property
+    def records(self):
+        return self._current()[0]
+
+    @records.setter
+    def records(self, records):
+        self._current()[0] = records
+
+    @property
+    def stream(self):
+        return self._current()[1]
+
+    @stream.setter
+    def stream(self, stream):
+        self._current()[1] = stream
+
+
+def capture_per_thread(config):
+    """Make the output and logs every thread of this worker captures its
+    own, unless capturing is disabled.
+
+    Python 3.6 has no context variables, so the worker keeps capturing as
+    a whole there. Logs are kept per thread from pytest 6 on, whose
+    logging plugin attaches one capturing handler per test phase.
+    """
+    try:
+        import contextvars  # noqa: F401
+    except ImportError:
+        return
+    capman = config.pluginmanager.getplugin('capturemanager')
+    if capman is None or not capman.is_globally_capturing():
+        return
+    capman.stop_global_capturing()
+    capture = ThreadCapture(tee=config.getoption('capture') == 'tee-sys')
+    capture.start_capturing()
+    capman._global_capturing = capture
+    # a coroutine test runs on the event loop ahead of its call phase,
+    # which then reports what the test captured
+    config.parallel_start_call = lambda item: capman.resume_global_capture()
+
+    plugin = config.pluginmanager.getplugin('logging-plugin')
+    if plugin is None or not all(
+        hasattr(plugin, name) for name in ('caplog_handler', 'report_handler')
+    ):
+        return
+    # Every test phase attaches the plugin's handlers to the root logger
+    # and detaches them afterwards, which would detach them from the tests
+    # still running on other threads. These stay attached for good.
+    plugin.caplog_handler = ThreadLogCaptureHandler(plugin.caplog_handler)
+    plugin.report_handler = ThreadLogCaptureHandler(plugin.report_handler)
+    root = logging.getLogger()
+    for handler in (plugin.caplog_handler, plugin.report_handler):
+        if plugin.log_level is not None:
+            handler.setLevel(plugin.log_level)
+        root.addHandler(handler)
+    if plugin.log_level is not None:
+        root.setLevel(min(root.level, plugin.log_level))
+
+    def start_phase(item, when):
+        # the stash of an item is called _store before pytest 7
+        store = item.stash if hasattr(item, 'stash') else item._store
+        plugin.caplog_handler.reset()
+        plugin.report_handler.reset()
+        store[_pytest.logging.caplog_records_key][when] = (
+            plugin.caplog_handler.records
+        )
+        store[_pytest.logging.caplog_handler_key] = plugin.caplog_handler
+
+    def start_call(item):
+        capman.resume_global_capture()
+        start_phase(item, 'call')
+
+    def runtest_for(item, when):
+        # the call of a coroutine test keeps what it captured while it ran
+        if when != 'call' or getattr(item, 'parallel_outcome', None) is None:
+            start_phase(item, when)
+        try:
+            yield
+        finally:
+            log = plugin.report_handler.stream.getvalue().strip()
+            item.add_report_section(when, 'log', log)
+
+    # pytest 8 enters it as a context manager, older ones yield from it
+    if hasattr(type(plugin)._runtest_for, '__wrapped__'):
+        runtest_for = contextlib.contextmanager(runtest_for)
+    plugin._runtest_for = runtest_for
+    config.parallel_start_call = start_call
@@ -0,0 +1,258 @@
+import os
+import heapq
+import pathlib
+import collections
+
+import pytest
+
+# The markers the master schedules by, which stand-in items carry along.
+MARKERS = ('parallel_group', 'parallel_process_isolated', 'parallel_resources')
+
+# pytest 7 passes the collection hooks the pathlib paths partitions are
+# matched against, and creates nodes from them.
+PARTITIONS_SUPPORTED = int(pytest.__version__.split('.')[0]) >= 7
+
+
+def collection_roots(config, invocation_dir):
+    """Return the directories the collection arguments name, or None when
+    an argument is not a plain directory, which is collected as usual."""
+    if config.option.pyargs:
+        return None
+    roots = []
+    for arg in config.args:
+        path = os.path.abspath(os.path.join(invocation_dir, str(arg)))
+        if '::' in str(arg) or not os.path.isdir(path):
+            return None
+        roots.append(path)
+    if any(os.path.commonpath([root, other]) == other
+           for root in roots for other in roots if root != other):
+        # overlapping arguments are merged by pytest
+        return None
+    return roots
+
+
+def entries(config, directory):
+    """Return the paths in ``directory`` pytest would look at, in the
+    order it collects them."""
+    init = os.path.exists(os.path.join(directory, '__init__.py'))
+    names = sorted(os.listdir(directory),
+                   key=lambda name: (not init or name != '__init__.py', name))
+    paths = []
+    for name in names:
+        path = os.path.join(directory, name)
+        if not config.hook.pytest_ignore_collect(
+            collection_path=pathlib.Path(path), config=config
+        ):
+            paths.append(path)
+    return paths
+
+
+def partition(config, roots, parts):
+    """Split the directories ``roots`` into partitions for ``parts``
+    processes to collect.
+
+    A directory is split into its entries, the heaviest one first, as long
+    as it is heavier than half the share of a process, weighed by the
+    Python files in it. Returns the partitions in collection order, their
+    weights and the directories that were split.
+    """
+    weights = {}
+
+    def weigh(path):
+        if path not in weights:
+            weight = int(path.endswith('.py'))
+            if os.path.isdir(path) and not os.path.islink(path):
+                weight = 0
+                for entry in os.scandir(path):
+                    if not entry.is_dir():
+                        weight += entry.name.endswith('.py')
+                    elif not config.hook.pytest_ignore_collect(
+                        collection_path=pathlib.Path(entry.path), config=config
+                    ):
+                        weight += weigh(entry.path)
+            weights[path] = weight
+        return weights[path]
+
+    # the roots are split in any case, every process walks them
+    partitions = [path for root in roots for path in entries(config, root)]
+    split = set(roots)
+    share = sum(weigh(root) for root in roots) / (2 * parts)
+    while True:
+        directories = [path for path in partitions
+                       if os.path.isdir(path) and not os.path.islink(path)]
+        heaviest = max(directories, key=weigh, default=None)
+        if heaviest is None or weigh(heaviest) <= share:
+            break
+        position = partitions.index(heaviest)
+        partitions[position:position + 1] = entries(config, heaviest)
+        split.add(heaviest)
+    return partitions, [weigh(path) for path in partitions], split
+
+
+def assign(weights, parts):
+    """Spread the partitions with ``weights`` over ``parts`` processes,
+    the heaviest first, each to the least loaded process. Processes left
+    without partitions are dropped."""
+    loads = [(0, part) for part in range(parts)]
+    assigned = [[] for _ in range(parts)]
+    for index in sorted(range(len(weights)), key=lambda index: -weights[index]):
+        load, part = heapq.heappop(loads)
+        assigned[part].append(index)
+        heapq.heappush(loads, (load + weights[index], part))
+    return [sorted(indices) for indices in assigned if indices]
+
+
+def describe(item):
+    """What the master needs to know of a collected item to schedule it
+    and report it."""
+    markers = [(marker.name, marker.args, marker.kwargs)
+               for marker in item.iter_markers() if marker.name in MARKERS]
+    return (item.nodeid, item.location, list(item.keywords), markers)
+
+
+class CollectedItem(pytest.Item):
+    """Stands in for an item in the master while a worker collected it.
+
+    It carries the node ID, location, keywords and scheduling markers of
+    the item, and cannot run.
+    """
+
+    def __init__(self, *, location, keywords=(), markers=(), **kwargs):
+        super(CollectedItem, self).__init__(**kwargs)
+        self.location = tuple(location)
+        self.keywords.update(dict.fromkeys(keywords, 1))
+        for name, args, kwargs in markers:
+            self.add_marker(getattr(pytest.mark, name).with_args(
+                *args, **kwargs
+            ))
+
+    @classmethod
+    def from_description(cls, session, description):
+        nodeid, location, keywords, markers = description
+        return cls.from_parent(
+            session, name=nodeid.rsplit('::', 1)[-1], nodeid=nodeid,
+            path=session.config.rootpath / location[0], location=location,
+            keywords=keywords, markers=markers
+        )
+
+    def runtest(self):
+        pytest.fail('{} was collected by a worker and only runs in one, '
+                    'not in the master'.format(self.nodeid), pytrace=False)
+
+
+class PartitionCollector(object):
+    """Plugin that collects the tests of some partitions of the tree only.
+
+    The directories that were split into partitions are still collected,
+    but their entries are ignored unless they are, or lead to, one of the
+    allowed partitions. Every process collects with the arguments of the
+    run, so node IDs, conftest files and the initial paths stay what they
+    are in a single process.
+
+    A worker keeps the items it collected. ``attach`` lines them up with
+    the items of the master, and ``complete`` collects the partitions of
+    the tests it is handed but has not collected yet.
+    """
+
+    def __init__(self, partitions, split):
+        self.partitions = list(partitions)
+        self.index = {path: index for index, path in enumerate(self.partitions)}
+        self.split = frozenset(split)
+        self.allowed = frozenset()
+        self.leading = frozenset()
+        self.reports = []
+        self.deselected = []
+        self.nodeids = []
+        self.owners = []
+        self.members = {}
+        self.items = []
+        self.directories = {}
+
+    def collect(self, session, partitions):
+        """Collect the partitions with the indices ``partitions`` and
+        return their items, leaving ``session.items`` as it was."""
+        self.allowed = frozenset(self.partitions[index] for index in partitions
+                                 if index is not None)
+        self.leading = frozenset(
+            directory for directory in self.split
+            if any(path.startswith(directory + os.sep) for path in self.allowed)
+        )
+        items = session.items
+        try:
+            return list(session.perform_collect())
+        finally:
+            session.items = items
+
+    def partition_of(self, item):
+        path = item.path
+        for parent in (path,) + tuple(path.parents):
+            index = self.index.get(str(parent))
+            if index is not None:
+                return index
+        return None
+
+    def attach(self, session, nodeids, owners):
+        """Line up the items this worker collected with the items of the
+        master, those not collected yet being None.
+
+        The worker keeps them in ``items`` rather than ``session.items``,
+        which pytest replaces while a thread collects more of them.
+        """
+        self.nodeids = nodeids
+        self.owners = owners
+        self.members = collections.defaultdict(list)
+        for index, owner in enumerate(owners):
+            self.members[owner].append(index)
+        collected = {item.nodeid: item for item in session.items
+                     if not isinstance(item, CollectedItem)}
+        self.items = [collected.get(nodeid) for nodeid in nodeids]
+        session.items = list(self.items)
+
+    def lacks(self, unit):
+        return any(self.items[index] is None for index in unit)
+
+    def complete(self, session, unit):
+        """Collect the partitions the tests of ``unit`` come from, when this
+        worker has not collected them yet."""
+        items = self.items
+        missing = {self.owners[index] for index in unit if items[index] is None}
+        if missing:
+            collected = {item.nodeid: item
+                         for item in self.collect(session, missing)}
+            for owner in missing:
+                for index in self.members[owner]:
+                    if items[index] is None:
+                        items[index] = collected.get(self.nodeids[index])
+            session.items = list(items)
+        for index in unit:
+            if items[index] is None:
+                raise RuntimeError('worker did not collect {}, tests must be '
+                                   'collected in the same way by every '
+                                   'process'.format(self.nodeids[index]))
+
+    @pytest.hookimpl(tryfirst=True)
+    def pytest_ignore_collect(self, collection_path, config):
+        path = str(collection_path)
+        if os.path.dirname(path) in self.split and not (
+            path in self.allowed or path in self.leading
+        ):
+            return True
+        return None
+
+    @pytest.hookimpl(hookwrapper=True, optionalhook=True)
+    def pytest_collect_directory(self, path, parent):
+        # A directory collected again keeps its node, which the fixtures
+        # of its conftest file belong to from pytest 9 on.
+        node = self.directories.get(path)
+        outcome = yield
+        if node is not None and node.parent is parent:
+            outcome.force_result(node)
+        elif outcome.get_result() is not None:
+            self.directories[path] = outcome.get_result()
+
+    def pytest_collectreport(self, report):
+        if not report.passed:
+            self.reports.append(report)
+
+    def pytest_deselected(self, items):
+        self.deselected.extend(items)
@@ -0,0 +1,241 @@
+import os
+import sys
+import time
+import shutil
+import hashlib
+import tempfile
+import traceback
+import contextlib
+import pytest
+from multiprocessing import AuthenticationError
+from multiprocessing.connection import Client, Listener
+
+# Files that change how tests are collected without being imported.
+CONFIG_FILES = ('pytest.ini', 'tox.ini', 'setup.cfg', 'pyproject.toml')
+
+
+def socket_path(directory):
+    digest = hashlib.sha1(directory.encode('utf-8')).hexdigest()[:16]
+    return os.path.join(
+        tempfile.gettempdir(),
+        'pytest-parallel-{}-{}.sock'.format(os.getuid(), digest)
+    )
+
+
+def key_path(address):
+    return address + '.key'
+
+
+def connect(address):
+    with open(key_path(address), 'rb') as f:
+        authkey = f.read()
+    return Client(address, 'AF_UNIX', authkey=authkey)
+
+
+def find_daemon(directory):
+    """Return the address of a daemon serving ``directory`` or a parent."""
+    while True:
+        address = socket_path(directory)
+        if os.path.exists(address) and os.path.exists(key_path(address)):
+            return address
+        parent = os.path.dirname(directory)
+        if parent == directory:
+            return None
+        directory = parent
+
+
+class Daemon(object):
+    """Keeps a process with the project imported and forks a run per request.
+
+    The daemon imports everything once by collecting the tests, then waits
+    on a unix socket. Every request is served by a fork of that warm
+    process, which starts running pytest with all modules already in
+    ``sys.modules``. When a source file imported from the project (or a
+    pytest config file) changed, the daemon re-executes itself instead,
+    so a run never sees stale code.
+    """
+
+    def __init__(self, directory, args):
+        self.directory = directory
+        self.args = args
+        self.address = socket_path(directory)
+        self.watched = {}
+
+    def warm_up(self):
+        with open(os.devnull, 'w') as devnull:
+            with contextlib.redirect_stdout(devnull):
+                pytest.main(['--collect-only', '-q'] + self.args)
+        self.watched = self.snapshot()
+
+    def snapshot(self):
+        paths = [os.path.join(self.directory, name) for name in CONFIG_FILES]
+        for module in list(sys.modules.values()):
+            path = getattr(module, '__file__', None)
+            if path and os.path.abspath(path).startswith(self.directory + os.sep):
+                paths.append(path)
+        files = {}
+        for path in paths:
+            try:
+                files[path] = os.stat(path).st_mtime_ns
+            except OSError:
+                pass
+        return files
+
+    def stale(self):
+        for path, mtime in self.watched.items():
+            try:
+                if os.stat(path).st_mtime_ns != mtime:
+                    return True
+            except OSError:
+                return True
+        return False
+
+    def listen(self):
+        if os.path.exists(self.address):
+            try:
+                connect(self.address).close()
+            except (OSError, EOFError, AuthenticationError):
+                os.unlink(self.address)
+            else:
+                raise RuntimeError('a daemon is already serving ' + self.directory)
+        authkey = os.urandom(32)
+        fd = os.open(key_path(self.address),
+                     os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, 'wb') as f:
+            f.write(authkey)
+        return Listener(self.address, 'AF_UNIX', authkey=authkey)
+
+    def serve(self):
+        self.warm_up()
+        listener = self.listen()
+        print('pytest-parallel: daemon warmed up {} files, serving {}'
+              .format(len(self.watched), self.directory))
+        sys.stdout.flush()
+
+        restart = False
+        try:
+            while not restart:
+                try:
+                    conn = listener.accept()
+                except (OSError, EOFError, AuthenticationError):
+                    continue
+                with conn:
+                    try:
+                        event_name, kwargs = conn.recv()
+                    except (OSError, EOFError):
+                        continue
+                    if event_name == 'stop':
+                        conn.send(('stopped', {}))
+                        break
+                    if self.stale():
+                        conn.send(('restarting', {}))
+                        restart = True
+                    else:
+                        self.run(conn, **kwargs)
+        finally:
+            listener.close()
+            os.unlink(key_path(self.address))
+
+        if restart:
+            os.execv(sys.executable, [sys.executable, '-m', 'pytest_parallel',
+                                      'daemon'] + self.args)
+
+    def run(self, conn, args, cwd, environ):
+        sys.stdout.flush()
+        sys.stderr.flush()
+        read_fd, write_fd = os.pipe()
+        pid = os.fork()
+        if pid == 0:
+            os.close(read_fd)
+            os.dup2(write_fd, 1)
+            os.dup2(write_fd, 2)
+            os.close(write_fd)
+            code = 3
+            try:
+                os.chdir(cwd)
+                os.environ.clear()
+                os.environ.update(environ)
+                code = int(pytest.main(args))
+            except BaseException:
+                traceback.print_exc()
+            finally:
+                sys.stdout.flush()
+                sys.stderr.flush()
+                os._exit(code)
+
+        os.close(write_fd)
+        try:
+            while True:
+                data = os.read(read_fd, 65536)
+                if not data:
+                    break
+                conn.send(('output', {'data': data}))
+        except (OSError, EOFError):
+            # the client went away, so nobody wants the results anymore
+            os.kill(pid, 15)
+        finally:
+            os.close(read_fd)
+        _, status = os.waitpid(pid, 0)
+        code = os.WEXITSTATUS(status) if os.WIFEXITED(status) else 1
+        try:
+            conn.send(('exit', {'code': code}))
+        except (OSError, EOFError):
+            pass
+
+
+def wait_for_daemon(address, timeout):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            return connect(address)
+        except (OSError, EOFError, AuthenticationError):
+            time.sleep(.1)
+    raise RuntimeError('the pytest-parallel daemon did not come back')
+
+
+def run(args):
+    address = find_daemon(os.getcwd())
+    if address is None:
+        sys.stderr.write('pytest-parallel: no daemon running, '
+                         'running pytest directly\n')
+        return int(pytest.main(args))
+
+    environ = dict(os.environ)
+    if sys.stdout.isatty():
+        environ.setdefault('PY_COLORS', '1')
+        environ.setdefault('COLUMNS', str(shutil.get_terminal_size().columns))
+    request = ('run', {'args': args, 'cwd': os.getcwd(), 'environ': environ})
+
+    conn = wait_for_daemon(address, 5)
+    while True:
+        conn.send(request)
+        while True:
+            event_name, kwargs = conn.recv()
+            if event_name == 'output':
+                sys.stdout.buffer.write(kwargs['data'])
+                sys.stdout.flush()
+            elif event_name == 'exit':
+                conn.close()
+                return kwargs['code']
+            elif event_name == 'restarting':
+                conn.close()
+                sys.stderr.write('pytest-parallel: source files changed, '
+                                 'restarting the daemon\n')
+                conn = wait_for_daemon(address, 300)
+                break
+
+
+def stop():
+    address = find_daemon(os.getcwd())
+    if address is None:
+        sys.stderr.write('pytest-parallel: no daemon running\n')
+        return 1
+    with connect(address) as conn:
+        conn.send(('stop', {}))
+        conn.recv()
+    return 0
+
+
+def serve(args):
+    Daemon(os.getcwd(), args).serve()
+    return 0
@@ -0,0 +1,104 @@
+import asyncio
+import inspect
+import threading
+import traceback
+
+from .watchdog import Timeout
+
+
+def coroutine_stack(coro):
+    """Return the formatted stack of where ``coro`` awaits."""
+    frames = []
+    frame = getattr(coro, 'cr_frame', None)
+    while frame is not None:
+        frames.append((frame, frame.f_lineno))
+        coro = coro.cr_await
+        frame = getattr(coro, 'cr_frame', None)
+    return ''.join(traceback.format_list(
+        traceback.StackSummary.extract(frames)
+    ))
+
+
+class EventLoopThread(object):
+    """A single event loop per worker process for ``async def`` tests.
+
+    Coroutine tests and async fixtures from every worker thread are run as
+    tasks on this loop, at most ``concurrency`` of them at a time, so they
+    share one selector and any loop-bound connection pools. A ``tracer``
+    follows the tasks on behalf of the tests that started them. A thread
+    either waits for a coroutine with ``run`` or gets a future of it with
+    ``submit`` and carries on.
+    """
+
+    def __init__(self, concurrency, tracer=None):
+        self.concurrency = concurrency
+        self.tracer = tracer
+        self.loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._semaphore = None
+
+    def _run(self):
+        asyncio.set_event_loop(self.loop)
+        if self.tracer is not None:
+            self.tracer.follow()
+        self.loop.run_forever()
+
+    async def _create_semaphore(self):
+        self._semaphore = asyncio.Semaphore(self.concurrency)
+
+    async def _limited(self, coro):
+        async with self._semaphore:
+            return await coro
+
+    def start(self):
+        self._thread.start()
+        self.run(self._create_semaphore())
+
+    def stop(self):
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self._thread.join()
+
+    def run(self, coro):
+        """Run ``coro`` on the loop and block the calling thread until done."""
+        return asyncio.run_coroutine_threadsafe(
+            self._limited(coro) if self._semaphore else coro, self.loop
+        ).result()
+
+    def submit(self, coro, timeout=None):
+        """Start ``coro`` on the loop and return a future of its result,
+        which fails with Timeout once it ran ``timeout`` seconds."""
+        return asyncio.run_coroutine_threadsafe(
+            self._timed(coro, timeout), self.loop
+        )
+
+    async def _timed(self, coro, timeout):
+        if timeout is None:
+            return await self._limited(coro)
+        task = asyncio.ensure_future(self._limited(coro))
+        done, _ = await asyncio.wait([task], timeout=timeout)
+        if done:
+            return task.result()
+        stack = coroutine_stack(coro)
+        task.cancel()
+        raise Timeout('the test ran longer than its parallel timeout\n'
+                      + stack)
+
+    def wrap_fixture(self, fixturedef):
+        func = fixturedef.func
+        if inspect.isasyncgenfunction(func):
+            def setup_and_teardown(*args, **kwargs):
+                generator = func(*args, **kwargs)
+                yield self.run(generator.__anext__())
+                try:
+                    self.run(generator.__anext__())
+                except StopAsyncIteration:
+                    pass
+                else:
+                    raise ValueError('{} did not stop after its yield'
+                                     .format(func.__name__))
+            fixturedef.func = setup_and_teardown
+        elif inspect.iscoroutinefunction(func):
+            def setup(*args, **kwargs):
+                return self.run(func(*args, **kwargs))
+            fixturedef.func = setup
@@ -0,0 +1,158 @@
+import os
+import sys
+import hashlib
+
+from .isolation import context_variable
+
+IMPACT_KEY = 'pytest-parallel/impact'
+# bumped whenever the layout of the map changes
+IMPACT_VERSION = 1
+
+
+def project_files(filenames, root):
+    """Return the files below ``root`` that are not installed packages,
+    relative to ``root``."""
+    files = set()
+    prefix = os.path.join(root, '')
+    for filename in filenames:
+        if filename.startswith(prefix) and 'site-packages' not in filename:
+            files.add(os.path.relpath(filename, root))
+    return sorted(files)
+
+
+def fingerprint(path, known=None):
+    """Return the size, modification time and digest of ``path``.
+
+    The file is only read again when its size or modification time differ
+    from the ``known`` fingerprint.
+    """
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    if known and known[:2] == [stat.st_size, stat.st_mtime_ns]:
+        return known
+    with open(path, 'rb') as f:
+        digest = hashlib.sha1(f.read()).hexdigest()
+    return [stat.st_size, stat.st_mtime_ns, digest]
+
+
+class FileTracer(object):
+    """Collects the source files each test executes.
+
+    The files of a test are kept in a context variable, per thread or per
+    coroutine test, which the tasks the test runs on the event loop thread
+    inherit. Every thread installs a profile hook of its own, which only
+    looks at function calls, so tests running side by side in one worker
+    are told apart and line tracers like coverage.py keep working.
+    """
+
+    def __init__(self, root):
+        self.root = root
+        self._filenames = context_variable('parallel_filenames')
+
+    def follow(self):
+        """Trace the calls of the current thread, for whichever test it
+        runs."""
+        sys.setprofile(self._profile)
+
+    def start(self):
+        self._filenames.set(set())
+        self.follow()
+
+    def stop(self):
+        self._filenames.set(None)
+
+    def _profile(self, frame, event, arg):
+        if event == 'call':
+            filenames = self._filenames.get(None)
+            if filenames is not None:
+                filenames.add(frame.f_code.co_filename)
+
+    def files(self):
+        return project_files(self._filenames.get(None) or (), self.root)
+
+
+class ImpactMap(object):
+    """Maps every test to the project files it executed, in the pytest cache.
+
+    A test is selected when it is new, failed last time, or one of its
+    files changed since it was recorded. The whole map is stale, and all
+    tests run, when it was recorded with another interpreter or another
+    ini file.
+    """
+
+    def __init__(self, cache, root, environment):
+        self.cache = cache
+        self.root = root
+        self.environment = environment
+        data = cache.get(IMPACT_KEY, None) if cache is not None else None
+        self.stale = not data or data.get('environment') != environment
+        if self.stale:
+            data = {}
+        self.tests = data.get('tests', {})
+        self.failed = set(data.get('failed', ()))
+        self.recorded = data.get('files', {})
+        self.current = {}
+        self.failing = set()
+        self.ran = set()
+
+    def fingerprint(self, path):
+        if path not in self.current:
+            self.current[path] = fingerprint(
+                os.path.join(self.root, path), self.recorded.get(path)
+            )
+        return self.current[path]
+
+    def changed(self, path):
+        recorded = self.recorded.get(path)
+        current = self.fingerprint(path)
+        return recorded is None or current is None or current[2] != recorded[2]
+
+    def affected(self, nodeid):
+        if self.stale or nodeid not in self.tests or nodeid in self.failed:
+            return True
+        return any(self.changed(path) for path in self.tests[nodeid])
+
+    def select(self, items):
+        """Split ``items`` into the affected ones and the others."""
+        selected, deselected = [], []
+        for item in items:
+            (selected if self.affected(item.nodeid) else deselected).append(item)
+        return selected, deselected
+
+    def update(self, report):
+        if report.failed:
+            self.failing.add(report.nodeid)
+        files = getattr(report, 'parallel_files', None)
+        if report.when != 'teardown' or files is None:
+            return
+        self.tests[report.nodeid] = files
+        self.ran.add(report.nodeid)
+        if report.nodeid in self.failing:
+            self.failed.add(report.nodeid)
+        else:
+            self.failed.discard(report.nodeid)
+
+    def save(self):
+        if self.cache is None:
+            return
+        # the files are saved as they are now, so tests that did not run
+        # since their files changed would be missed next time
+        for nodeid, files in list(self.tests.items()):
+            if nodeid not in self.ran and any(map(self.changed, files)):
+                del self.tests[nodeid]
+        paths = {path for files in self.tests.values() for path in files}
+        self.cache.set(IMPACT_KEY, {
+            'environment': self.environment,
+            'tests': self.tests,
+            'failed': sorted(self.failed),
+            'files': {path: self.fingerprint(path) for path in sorted(paths)},
+        })
+
+
+def environment(config):
+    """Return what a recorded map is only valid for."""
+    inipath = getattr(config, 'inipath', None) or getattr(config, 'inifile', None)
+    ini = fingerprint(str(inipath)) if inipath else None
+    return [IMPACT_VERSION, sys.version, ini and ini[2]]
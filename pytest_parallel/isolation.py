@@ -0,0 +1,232 @@
+import os
+import sys
+import itertools
+import threading
+
+import _pytest.fixtures
+import _pytest.runner
+
+try:
+    import contextvars
+except ImportError:  # Python 3.6
+    contextvars = None
+
+CURRENT_TEST = 'PYTEST_CURRENT_TEST'
+
+# The attributes of a fixture definition that change while its fixture is
+# set up and torn down, with a factory of their initial value.
+FIXTURE_STATE = (
+    ('cached_result', lambda: None),
+    ('_finalizers', list),
+)
+
+
+class ThreadVariable(threading.local):
+    """A context variable for Python 3.6, which only has threads."""
+
+    def __init__(self, name):
+        self.name = name
+
+    def get(self, default=None):
+        return self.__dict__.get('value', default)
+
+    def set(self, value):
+        self.value = value
+
+
+def context_variable(name):
+    """Return a variable of the context running, which is the thread
+    running unless the run moved a coroutine test's context to it.
+
+    Every thread starts in a context of its own. The runner of coroutine
+    tests carries the context of each test between its threads, and the
+    tasks of the test on the event loop run in copies of it.
+    """
+    if contextvars is None:
+        return ThreadVariable(name)
+    return contextvars.ContextVar(name)
+
+
+class CurrentTest(object):
+    # the encoded value of PYTEST_CURRENT_TEST in this context
+
+    def __init__(self):
+        self._value = context_variable('parallel_current_test')
+
+    @property
+    def value(self):
+        return self._value.get(None)
+
+    @value.setter
+    def value(self, value):
+        self._value.set(value)
+
+
+class ThreadLocalEnviron(os._Environ):
+    """os.environ, except that every thread, or coroutine test, has its own
+    PYTEST_CURRENT_TEST.
+
+    pytest sets the variable to the test it runs, which would be whichever
+    test set it last while several run at once. Lookups of other keys cost
+    what they cost with os.environ, they go through the same dictionary
+    and only compare the key once. Iterating and ``len`` also check
+    whether the value of the thread adds the key.
+    """
+
+    def __init__(self, env):
+        if sys.version_info >= (3, 9):
+            super().__init__(
+                env._data,
+                env.encodekey,
+                env.decodekey,
+                env.encodevalue,
+                env.decodevalue,
+            )
+            self.putenv = os.putenv
+            self.unsetenv = os.unsetenv
+        else:
+            super().__init__(
+                env._data,
+                env.encodekey,
+                env.decodekey,
+                env.encodevalue,
+                env.decodevalue,
+                env.putenv,
+                env.unsetenv
+            )
+        self._current = getattr(env, '_current', None) or CurrentTest()
+        self._current_key = self.encodekey(CURRENT_TEST)
+
+    def __getitem__(self, key):
+        if key == CURRENT_TEST:
+            value = self._current.value
+            if value is not None:
+                return self.decodevalue(value)
+        try:
+            value = self._data[self.encodekey(key)]
+        except KeyError:
+            raise KeyError(key) from None
+        return self.decodevalue(value)
+
+    def __setitem__(self, key, value):
+        if key == CURRENT_TEST:
+            value = self.encodevalue(value)
+            self.putenv(self._current_key, value)
+            self._current.value = value
+        else:
+            super().__setitem__(key, value)
+
+    def __delitem__(self, key):
+        if key == CURRENT_TEST and self._current.value is not None:
+            self.unsetenv(self._current_key)
+            self._current.value = None
+        else:
+            super().__delitem__(key)
+
+    # this thread's value adds the key unless the process has it already
+
+    def __iter__(self):
+        if (self._current.value is not None
+                and self._current_key not in self._data):
+            return itertools.chain(super().__iter__(), (CURRENT_TEST,))
+        return super().__iter__()
+
+    def __len__(self):
+        if self._current.value is None:
+            return len(self._data)
+        return len(self._data) + (self._current_key not in self._data)
+
+
+class ContextLocalSetupState(object):
+    """The setup state of a session, with a stack of set up nodes per
+    thread, or coroutine test."""
+
+    def __init__(self):
+        self._state = context_variable('parallel_setup_state')
+
+    def _current(self):
+        state = self._state.get(None)
+        if state is None:
+            state = _pytest.runner.SetupState()
+            self._state.set(state)
+        return state
+
+    def __getattr__(self, name):
+        return getattr(self._current(), name)
+
+
+class ContextLocalAttribute(object):
+    """An instance attribute whose value every thread, or coroutine test,
+    sets on its own.
+
+    Values live in a context variable stored on the instance, so the class
+    keeps its other attributes shared and its subclasses inherit the
+    attribute without being replaced.
+    """
+
+    key = '_parallel_context_state'
+
+    def __init__(self, name, default):
+        self.name = name
+        self.default = default
+
+    def _state(self, instance):
+        variable = instance.__dict__.get(self.key)
+        if variable is None:
+            variable = instance.__dict__.setdefault(
+                self.key, context_variable(self.key)
+            )
+        state = variable.get(None)
+        if state is None:
+            state = {}
+            variable.set(state)
+        return state
+
+    def __get__(self, instance, owner=None):
+        if instance is None:
+            return self
+        state = self._state(instance)
+        try:
+            return state[self.name]
+        except KeyError:
+            value = state[self.name] = self.default()
+            return value
+
+    def __set__(self, instance, value):
+        self._state(instance)[self.name] = value
+
+    def __delete__(self, instance):
+        try:
+            del self._state(instance)[self.name]
+        except KeyError:
+            raise AttributeError(self.name) from None
+
+
+class ThreadIsolation(object):
+    """Keeps the state pytest holds while it runs a test apart per thread,
+    or per coroutine test.
+
+    That is the setup state of the session, the cached values and
+    finalizers of every fixture definition, parametrized ones included,
+    and PYTEST_CURRENT_TEST. ``uninstall`` puts everything back, for runs
+    that share the process with another session.
+    """
+
+    def __init__(self):
+        self._environ = None
+
+    def install(self, session):
+        session._setupstate = ContextLocalSetupState()
+        for name, default in FIXTURE_STATE:
+            setattr(_pytest.fixtures.FixtureDef, name,
+                    ContextLocalAttribute(name, default))
+        self._environ = os.environ
+        os.environ = ThreadLocalEnviron(os.environ)
+
+    def uninstall(self):
+        if self._environ is None:
+            return
+        for name, _ in FIXTURE_STATE:
+            delattr(_pytest.fixtures.FixtureDef, name)
+        os.environ = self._environ
+        self._environ = None
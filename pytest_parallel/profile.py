@@ -0,0 +1,121 @@
+import json
+import time
+import collections
+
+# Spans are (thread, name, category, start, stop) tuples with wall clock
+# times in seconds, so they travel through marshal like the reports do.
+IDLE = 'idle'
+
+
+class Profile(object):
+    """Collects the scheduling timeline of a run.
+
+    Workers record when their threads waited for work and when each test
+    phase ran, and ship the spans along with their reports. The master
+    adds the time it spent handling every event of the dispatch loop.
+    The result is written as a Chrome trace, which chrome://tracing and
+    ui.perfetto.dev open, and summarized as the utilization per worker.
+    """
+
+    MASTER = 'master'
+
+    def __init__(self, path):
+        self.path = path
+        self.spans = collections.defaultdict(list)
+        self.started = time.time()
+        self.finished = None
+
+    def start(self):
+        self.started = time.time()
+
+    def add(self, process, spans):
+        self.spans[process].extend(tuple(span) for span in spans)
+
+    def record(self, name, start, stop=None):
+        stop = time.time() if stop is None else stop
+        self.spans[self.MASTER].append(('dispatch', name, 'master', start, stop))
+
+    def finish(self):
+        self.finished = time.time()
+
+    def workers(self):
+        # local workers are known by pid, agents by their address
+        return sorted((p for p in self.spans if p != self.MASTER), key=str)
+
+    def trace(self):
+        events = []
+        pids = {}
+        tids = {}
+        for process in [self.MASTER] + self.workers():
+            pid = pids[process] = len(pids)
+            events.append({
+                'name': 'process_name', 'ph': 'M', 'pid': pid, 'tid': 0,
+                'args': {'name': process if process == self.MASTER
+                         else 'worker {}'.format(process)},
+            })
+            for thread, name, category, start, stop in self.spans[process]:
+                key = (process, thread)
+                if key not in tids:
+                    tids[key] = len(tids)
+                    events.append({
+                        'name': 'thread_name', 'ph': 'M', 'pid': pid,
+                        'tid': tids[key], 'args': {'name': thread},
+                    })
+                events.append({
+                    'name': name, 'cat': category, 'ph': 'X',
+                    'pid': pid, 'tid': tids[key],
+                    'ts': round((start - self.started) * 1e6, 3),
+                    'dur': round(max(stop - start, 0) * 1e6, 3),
+                })
+        # the start lets tools line the timestamps up with other clocks
+        return {'traceEvents': events, 'displayTimeUnit': 'ms',
+                'otherData': {'started': self.started}}
+
+    def write(self):
+        with open(self.path, 'w') as f:
+            json.dump(self.trace(), f)
+
+    def summary(self, slowest=5):
+        wall = max((self.finished or time.time()) - self.started, 1e-9)
+        lines = ['wall time {:.2f}s, trace written to {}'.format(wall, self.path)]
+
+        tests = collections.defaultdict(float)
+        last_busy = []
+        for process in self.workers():
+            busy = collections.defaultdict(float)
+            idle = 0.
+            for thread, name, category, start, stop in self.spans[process]:
+                if category == IDLE:
+                    idle += stop - start
+                    continue
+                busy[thread] += stop - start
+                tests[name] += stop - start
+            threads = {span[0] for span in self.spans[process]}
+            lines.append(
+                'worker {}: {} threads, {:.0%} busy, {:.2f}s waiting for work'
+                .format(process, len(threads),
+                        sum(busy.values()) / (wall * max(len(threads), 1)),
+                        idle)
+            )
+            for thread in threads:
+                stops = [span[4] for span in self.spans[process]
+                         if span[0] == thread and span[2] != IDLE]
+                if stops:
+                    last_busy.append(max(stops))
+
+        master = self.spans[self.MASTER]
+        lines.append('master: {} events handled, {:.0%} busy'.format(
+            len(master), sum(stop - start for *_, start, stop in master) / wall
+        ))
+        if len(last_busy) > 1:
+            lines.append(
+                'tail: {:.2f}s between the first and the last thread running '
+                'out of work'.format(max(last_busy) - min(last_busy))
+            )
+        if tests:
+            lines.append('slowest tests:')
+            for nodeid, duration in sorted(
+                tests.items(), key=lambda item: -item[1]
+            )[:slowest]:
+                lines.append('  {:.2f}s {}'.format(duration, nodeid))
+        return lines
@@ -0,0 +1,62 @@
+import time
+import collections
+
+
+def format_seconds(seconds):
+    minutes, seconds = divmod(int(round(seconds)), 60)
+    hours, minutes = divmod(minutes, 60)
+    if hours:
+        return '{}h{:02d}m'.format(hours, minutes)
+    if minutes:
+        return '{}m{:02d}s'.format(minutes, seconds)
+    return '{}s'.format(seconds)
+
+
+class Progress(object):
+    """Counts finished tests in the master as their reports come in.
+
+    The counters are fed from the report batches the workers send anyway,
+    so progress costs no extra messages. The time left is estimated from
+    the durations recorded by previous runs: the estimated cost of the
+    tests still to go, divided by the rate at which estimated cost got
+    done so far.
+    """
+
+    def __init__(self, estimates):
+        self.estimates = estimates
+        self.total = len(estimates)
+        self.total_cost = self.remaining_cost = sum(estimates.values())
+        self.finished = 0
+        self.outcomes = collections.Counter()
+        self.started = time.time()
+
+    def update(self, report):
+        if report.failed:
+            self.outcomes['failed' if report.when == 'call' else 'error'] += 1
+        elif report.skipped:
+            self.outcomes['skipped'] += 1
+        elif report.when == 'call':
+            self.outcomes['passed'] += 1
+        if report.when == 'teardown':
+            # the teardown report is the last one of every test
+            self.finished += 1
+            self.remaining_cost -= self.estimates.get(report.nodeid, 0)
+
+    def eta(self):
+        done_cost = self.total_cost - self.remaining_cost
+        if done_cost <= 0:
+            return None
+        elapsed = time.time() - self.started
+        return max(self.remaining_cost, 0) * elapsed / done_cost
+
+    def line(self):
+        parts = ['{} passed'.format(self.outcomes['passed'])] + [
+            '{} {}'.format(self.outcomes[outcome], outcome)
+            for outcome in ('failed', 'error', 'skipped')
+            if self.outcomes[outcome]
+        ]
+        eta = self.eta()
+        return 'pytest-parallel: {}/{} tests done ({:.0%}), {}, ETA {}'.format(
+            self.finished, self.total, self.finished / max(self.total, 1),
+            ', '.join(parts), 'unknown' if eta is None else format_seconds(eta)
+        )
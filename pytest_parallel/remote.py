@@ -0,0 +1,166 @@
+import os
+import sys
+import time
+import secrets
+import threading
+import multiprocessing
+from multiprocessing import AuthenticationError
+from multiprocessing.connection import Client, Listener
+
+AUTHKEY_ENV = 'PYTEST_PARALLEL_AUTHKEY'
+
+
+def parse_address(address):
+    host, _, port = address.rpartition(':')
+    if not host or not port.isdigit():
+        raise ValueError('expected an address like HOST:PORT, got ' + address)
+    return host.strip('[]'), int(port)
+
+
+def authkey_from(value=None):
+    value = value or os.environ.get(AUTHKEY_ENV)
+    return value.encode('utf-8') if value else None
+
+
+class Agent(object):
+    """Stands in for the process of a worker connected over TCP.
+
+    Agents replace themselves after retiring or crashing by connecting
+    again, so the master has nothing to join or restart.
+    """
+
+    remote = True
+
+    def __init__(self, address):
+        self.pid = '{}:{}'.format(*address)
+
+    def join(self):
+        pass
+
+
+class Coordinator(object):
+    """Accepts agents on a TCP socket for the master.
+
+    Every agent is authenticated with the shared key and told how to
+    collect the tests. Accepting happens on a thread; the connections are
+    handed to the master's dispatch loop through ``ready``, a pipe it
+    waits on together with the worker pipes.
+    """
+
+    def __init__(self, address, authkey, setup):
+        self.authkey = authkey or secrets.token_hex(16).encode('utf-8')
+        self.generated = authkey is None
+        self.listener = Listener(parse_address(address), 'AF_INET',
+                                 authkey=self.authkey)
+        self.setup = setup
+        self.ready, self._wakeup = multiprocessing.Pipe(duplex=False)
+        self._lock = threading.Lock()
+        self._joined = []
+        self._closed = False
+
+    @property
+    def address(self):
+        return '{}:{}'.format(*self.listener.address)
+
+    def start(self):
+        thread = threading.Thread(target=self._accept)
+        thread.daemon = True
+        thread.start()
+
+    def _accept(self):
+        while True:
+            try:
+                conn = self.listener.accept()
+            except AuthenticationError:
+                continue
+            except OSError:
+                # the listener was closed at the end of the run
+                return
+            with self._lock:
+                if self._closed:
+                    conn.close()
+                    return
+                address = self.listener.last_accepted
+            try:
+                conn.send_bytes(self.setup)
+            except OSError:
+                conn.close()
+                continue
+            with self._lock:
+                if self._closed:
+                    conn.close()
+                    return
+                self._joined.append((conn, address))
+            self._wakeup.send_bytes(b'')
+
+    def joined(self):
+        self.ready.recv_bytes()
+        with self._lock:
+            joined, self._joined = self._joined, []
+        return [(conn, Agent(address)) for conn, address in joined]
+
+    def close(self):
+        with self._lock:
+            self._closed = True
+            self.listener.close()
+            for conn, _ in self._joined:
+                conn.close()
+            self._joined = []
+
+
+def connect(address, authkey, timeout):
+    deadline = time.time() + timeout
+    while True:
+        try:
+            return Client(parse_address(address), 'AF_INET', authkey=authkey)
+        except (OSError, EOFError):
+            if time.time() >= deadline:
+                raise
+            time.sleep(.2)
+
+
+def serve(address, authkey=None, timeout=30):
+    """Run workers for the coordinator at ``address`` until it is done.
+
+    Each connection is served by a fresh process that collects the tests
+    with the coordinator's arguments from the current directory, like a
+    spawned worker does. A worker that retired or crashed is replaced by
+    connecting again; once the coordinator stops listening, the agent exits.
+    """
+    from . import decode, remote_worker
+
+    authkey = authkey_from(authkey)
+    if authkey is None:
+        sys.stderr.write('pytest-parallel: pass the key the coordinator printed '
+                         'with --authkey or ' + AUTHKEY_ENV + '\n')
+        return 2
+
+    context = multiprocessing.get_context()
+    served = 0
+    while True:
+        try:
+            conn = connect(address, authkey, timeout if not served else 1)
+        except (OSError, EOFError):
+            if served:
+                return 0
+            sys.stderr.write('pytest-parallel: cannot connect to {}\n'
+                             .format(address))
+            return 1
+        except AuthenticationError:
+            sys.stderr.write('pytest-parallel: {} rejected the key\n'
+                             .format(address))
+            return 1
+        try:
+            _, setup = decode(conn.recv_bytes())
+        except (OSError, EOFError):
+            conn.close()
+            return 0
+        process = context.Process(target=remote_worker, args=(
+            conn, setup['args'], os.getcwd(), setup['nodeids'], setup['settings']
+        ))
+        process.start()
+        conn.close()
+        process.join()
+        served += 1
+        if process.exitcode == 0:
+            return 0
@@ -0,0 +1,262 @@
+import os
+import time
+import threading
+import collections
+
+CGROUP_ROOT = '/sys/fs/cgroup'
+
+# Bounds and pace of the dynamic tests-per-worker mode.
+DYNAMIC_MAX_THREADS = 50
+DYNAMIC_INTERVAL = .5
+
+
+def parse_size(size):
+    units = {'K': 1 << 10, 'M': 1 << 20, 'G': 1 << 30}
+    size = str(size).strip().upper().rstrip('B')
+    if size[-1:] in units:
+        return int(float(size[:-1]) * units[size[-1]])
+    return int(float(size) * units['M'])
+
+
+def read_first_line(path):
+    try:
+        with open(path) as f:
+            return f.readline().strip()
+    except (OSError, ValueError):
+        return None
+
+
+def cgroup_dirs(root, controller):
+    """Yield the cgroup directories of this process for ``controller``.
+
+    Inside a container the process usually sits at the root of its cgroup
+    namespace, but a nested hierarchy is followed as well. Both the
+    unified (v2) and the per-controller (v1) layouts are covered.
+    """
+    seen = set()
+    try:
+        with open('/proc/self/cgroup') as f:
+            lines = f.read().splitlines()
+    except OSError:
+        lines = []
+    for line in lines:
+        _, controllers, path = line.split(':', 2)
+        path = path.lstrip('/')
+        if not controllers:
+            candidates = [os.path.join(root, path)]
+        elif controller in controllers.split(','):
+            candidates = [os.path.join(root, controllers, path),
+                          os.path.join(root, controller, path)]
+        else:
+            continue
+        for candidate in candidates:
+            if candidate not in seen:
+                seen.add(candidate)
+                yield candidate
+    for candidate in (root, os.path.join(root, controller)):
+        if candidate not in seen:
+            seen.add(candidate)
+            yield candidate
+
+
+def cgroup_cpu_limit(root=CGROUP_ROOT):
+    """Return the CPU quota of this process in cores, or None if unlimited."""
+    for directory in cgroup_dirs(root, 'cpu'):
+        line = read_first_line(os.path.join(directory, 'cpu.max'))
+        if line:
+            quota, _, period = line.partition(' ')
+            if quota == 'max':
+                return None
+            return int(quota) / int(period or 100000)
+        quota = read_first_line(os.path.join(directory, 'cpu.cfs_quota_us'))
+        period = read_first_line(os.path.join(directory, 'cpu.cfs_period_us'))
+        if quota and period:
+            return int(quota) / int(period) if int(quota) > 0 else None
+    return None
+
+
+def cgroup_memory_limit(root=CGROUP_ROOT):
+    """Return the memory limit of this process in bytes, or None."""
+    for directory in cgroup_dirs(root, 'memory'):
+        for name in ('memory.max', 'memory.limit_in_bytes'):
+            line = read_first_line(os.path.join(directory, name))
+            if not line:
+                continue
+            if line == 'max':
+                return None
+            limit = int(line)
+            # cgroup v1 reports "unlimited" as a huge page-aligned number
+            return limit if limit < 1 << 60 else None
+    return None
+
+
+def available_cpus(root=CGROUP_ROOT):
+    """Return the number of cores this process may actually use."""
+    try:
+        cpus = len(os.sched_getaffinity(0))
+    except AttributeError:
+        cpus = os.cpu_count() or 1
+    quota = cgroup_cpu_limit(root)
+    if quota is not None:
+        cpus = min(cpus, quota)
+    return max(1, int(cpus))
+
+
+def auto_workers(worker_memory=None, root=CGROUP_ROOT):
+    """Return how many workers fit into the CPU and memory of the cgroup.
+
+    ``worker_memory`` is the expected footprint of one worker in bytes.
+    """
+    workers = available_cpus(root)
+    limit = cgroup_memory_limit(root)
+    if limit and worker_memory:
+        workers = min(workers, limit // worker_memory)
+    return max(1, int(workers))
+
+
+def total_memory(root=CGROUP_ROOT):
+    limit = cgroup_memory_limit(root)
+    if limit:
+        return limit
+    try:
+        return os.sysconf('SC_PHYS_PAGES') * os.sysconf('SC_PAGE_SIZE')
+    except (AttributeError, ValueError, OSError):
+        return None
+
+
+def parse_resources(value):
+    """Parse capacities like ``db=8,selenium=4,memory=16G``."""
+    capacities = {}
+    for part in (value or '').split(','):
+        if not part.strip():
+            continue
+        name, _, amount = part.partition('=')
+        name = name.strip()
+        if not name or not amount.strip():
+            raise ValueError('parallel_resources expects NAME=AMOUNT pairs, '
+                             'got ' + part.strip())
+        capacities[name] = parse_amount(name, amount)
+    return capacities
+
+
+def parse_amount(name, amount):
+    return parse_size(amount) if name == 'memory' else float(amount)
+
+
+def resource_needs(item):
+    """Return what the parallel_resources markers of ``item`` ask for.
+
+    ``@pytest.mark.parallel_resources('db', selenium=2, memory='4G')``
+    needs one ``db``, two ``selenium`` and 4 GB of the ``memory`` budget.
+    """
+    needs = {}
+    for marker in item.iter_markers('parallel_resources'):
+        for name in marker.args:
+            needs.setdefault(name, 1.)
+        for name, amount in marker.kwargs.items():
+            needs.setdefault(name, parse_amount(name, amount))
+    return needs
+
+
+class ResourcePool(object):
+    """Counts what the dispatched tests hold of every named resource.
+
+    ``cpu`` defaults to the available cores and ``memory`` to the memory
+    limit of the machine or container. Any other name without a
+    configured capacity is a lock only one test holds at a time.
+    """
+
+    def __init__(self, capacities, root=CGROUP_ROOT):
+        self.capacities = {'cpu': float(available_cpus(root))}
+        memory = total_memory(root)
+        if memory:
+            self.capacities['memory'] = memory
+        self.capacities.update(capacities)
+        self.used = collections.Counter()
+
+    def capacity(self, name):
+        return self.capacities.get(name, 1.)
+
+    def check(self, nodeid, needs):
+        for name, amount in needs.items():
+            if amount > self.capacity(name):
+                raise ValueError(
+                    '{} needs {:g} of the resource "{}", but only {:g} is '
+                    'available'.format(nodeid, amount, name, self.capacity(name))
+                )
+
+    def acquire(self, needs):
+        if any(self.used[name] + amount > self.capacity(name)
+               for name, amount in needs.items()):
+            return False
+        self.used.update(needs)
+        return True
+
+    def release(self, needs):
+        self.used.subtract(needs)
+
+
+def iowait_ticks():
+    try:
+        with open('/proc/stat') as f:
+            fields = f.readline().split()
+    except OSError:
+        return None, None
+    if len(fields) < 6 or fields[0] != 'cpu':
+        return None, None
+    ticks = [int(field) for field in fields[1:]]
+    return ticks[4], sum(ticks)
+
+
+class AdaptiveConcurrency(object):
+    """Grows or shrinks the number of tests a worker runs at a time.
+
+    Every ``interval`` seconds the worker's CPU time is compared with the
+    wall time that passed. Threads that mostly wait (sleeping, network)
+    leave the process idle, so more tests are let in. When the process
+    keeps a core busy, more threads only fight for the GIL, and when the
+    machine is stuck in I/O wait, more threads only queue on the disk, so
+    the limit is halved in both cases. ``apply`` is called with every new
+    limit.
+    """
+
+    def __init__(self, apply, maximum, start=1, interval=DYNAMIC_INTERVAL):
+        self.apply = apply
+        self.maximum = maximum
+        self.limit = min(start, maximum)
+        self.interval = interval
+        self._stopped = threading.Event()
+
+    def start(self):
+        self.apply(self.limit)
+        thread = threading.Thread(target=self._run)
+        thread.daemon = True
+        thread.start()
+
+    def stop(self):
+        self._stopped.set()
+
+    def adjust(self, busy, iowait):
+        """Return the next limit for the share of a core this process used
+        and the share of time the machine spent waiting for I/O."""
+        if busy > .9 or iowait > .2:
+            return max(1, self.limit // 2)
+        if busy < .5:
+            return min(self.maximum, self.limit * 2)
+        return self.limit
+
+    def _run(self):
+        cpu, wall = time.process_time(), time.monotonic()
+        wait, total = iowait_ticks()
+        while not self._stopped.wait(self.interval):
+            new_cpu, new_wall = time.process_time(), time.monotonic()
+            new_wait, new_total = iowait_ticks()
+            busy = (new_cpu - cpu) / max(new_wall - wall, 1e-6)
+            iowait = 0.
+            if wait is not None and new_total > total:
+                iowait = (new_wait - wait) / (new_total - total)
+            cpu, wall, wait, total = new_cpu, new_wall, new_wait, new_total
+            limit = self.adjust(busy, iowait)
+            if limit != self.limit:
+                self.limit = limit
+                self.apply(limit)
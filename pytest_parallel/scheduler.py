@@ -0,0 +1,287 @@
+import collections
+
+
+def scope_key(item, dist):
+    if dist == 'loadfile':
+        return item.nodeid.split('::', 1)[0]
+    if dist == 'loadscope':
+        return item.nodeid.rsplit('::', 1)[0]
+    if dist == 'loadgroup':
+        marker = item.get_closest_marker('parallel_group')
+        if marker is not None:
+            return marker.kwargs.get('name', marker.args[0] if marker.args else '')
+    return None
+
+
+def group_units(items, dist):
+    """Split the item indices into units that always run on one thread.
+
+    With "load" every item is its own unit. The other modes keep items
+    sharing a file, a class (or module) or a ``parallel_group`` marker
+    together, in collection order, so their module and class fixtures are
+    set up once per unit.
+    """
+    units = collections.OrderedDict()
+    for index, item in enumerate(items):
+        key = scope_key(item, dist)
+        units.setdefault(index if key is None else ('scope', key), []).append(index)
+    return [tuple(indices) for indices in units.values()]
+
+
+def split_isolated(units, isolated):
+    """Take the ``isolated`` item indices out of their units.
+
+    Every isolated item becomes a unit of its own, returned separately
+    from the remaining units, which keep their order.
+    """
+    isolated = set(isolated)
+    remaining = []
+    for unit in units:
+        unit = tuple(index for index in unit if index not in isolated)
+        if unit:
+            remaining.append(unit)
+    return remaining, [(index,) for index in sorted(isolated)]
+
+
+class Scheduler(object):
+    """Master-side bookkeeping of which worker owns which unit of tests.
+
+    Units are handed out in chunks sized from the estimated cost still
+    pending, so chunks are large while plenty of work is left and shrink
+    to one unit per thread towards the end. A worker that asks for more
+    once nothing is pending makes the scheduler steal the unstarted back
+    half of the busiest worker's chunk instead of leaving it idle.
+
+    Units listed in ``needs`` hold resources of ``pool`` from the moment
+    they are handed out until they finished. They are only handed out
+    when their resources are free; until then the next units that fit
+    are picked instead, and a worker holds at most as many of them as it
+    runs at a time, so they do not wait in its queue.
+
+    Units of failed tests queued again for a rerun go to the front, once
+    the worker that ran them is done with them, and are only handed back
+    to that worker when no other one is left to take them.
+
+    Units listed in ``affinity`` go to the worker they name first: while
+    it has some of them left, the units of other workers are passed over,
+    and it takes those only once its own ones were handed out. A worker
+    that stopped has no claim on its units anymore.
+
+    A unit that cannot go to the worker asking is parked in a queue of
+    the units blocked for the same reason: the resources they need, the
+    worker they avoid or the worker they wait for. Those queues come
+    before the pending units, in order, and are only looked at up to their
+    first unit that is still blocked, so blocked units are not scanned
+    over and over again.
+
+    Once the run is cancelled, nothing is handed out anymore and units
+    coming back from workers are dropped.
+    """
+
+    def __init__(self, order, costs, send, workers, needs=None, pool=None,
+                 affinity=None):
+        self.pending = collections.deque(order)
+        self.costs = costs
+        self.pending_cost = sum(costs[unit] for unit in self.pending)
+        self.send = send
+        self.workers = workers
+        self.capacity = {}
+        self.assigned = collections.defaultdict(set)
+        self.hungry = collections.deque()
+        self.stealing = set()
+        self.stopped = set()
+        self.cancelled = False
+        self.needs = needs or {}
+        self.pool = pool
+        self.avoid = {}
+        # blocked units by why they are blocked, in the order they were
+        self.parked = collections.OrderedDict()
+        self.reruns = set()
+        self.affinity = affinity or {}
+        # the units of every worker that were not handed out yet
+        self.own = collections.defaultdict(set)
+        for unit, worker in self.affinity.items():
+            self.own[worker].add(unit)
+
+    def has_pending(self):
+        return bool(self.pending or self.parked)
+
+    def has_work(self):
+        return self.has_pending() or any(
+            units for worker, units in self.assigned.items()
+            if worker not in self.stopped
+        )
+
+    def finish(self, worker, done):
+        assigned = self.assigned[worker]
+        for unit in done:
+            if unit in assigned:
+                assigned.remove(unit)
+                if unit in self.needs:
+                    self.pool.release(self.needs[unit])
+                if unit in self.reruns:
+                    self.reruns.remove(unit)
+                    self.pending.appendleft(unit)
+                    self.pending_cost += self.costs[unit]
+
+    def released(self, worker, units):
+        self.finish(worker, units)
+        self.feed()
+
+    def request(self, worker, size, done):
+        self.finish(worker, done)
+        self.capacity[worker] = size
+        if worker not in self.hungry:
+            self.hungry.append(worker)
+        self.feed()
+
+    def returned(self, worker, units, done):
+        self.finish(worker, list(done) + list(units))
+        self.stealing.discard(worker)
+        if not self.cancelled:
+            self.pending.extendleft(reversed(units))
+            self.pending_cost += sum(self.costs[unit] for unit in units)
+        self.feed()
+
+    def retire(self, worker, units, done):
+        self.stopped.add(worker)
+        if worker in self.hungry:
+            self.hungry.remove(worker)
+        self.returned(worker, units, done)
+
+    def rerun(self, worker, unit, cost, needs=None):
+        """Queue ``unit`` again, preferably for another worker than the
+        one it failed on."""
+        if self.cancelled:
+            return
+        self.costs[unit] = cost
+        if needs:
+            self.needs[unit] = needs
+        self.avoid[unit] = worker
+        if unit in self.assigned[worker]:
+            # queued once the worker reports it done
+            self.reruns.add(unit)
+        else:
+            self.pending.appendleft(unit)
+            self.pending_cost += cost
+        self.feed()
+
+    def others(self, worker):
+        return any(other != worker and other not in self.stopped
+                   for other in self.capacity)
+
+    def crashed(self, worker):
+        """Forget ``worker`` and return the units it never finished."""
+        units = list(self.assigned.pop(worker, ()))
+        self.stopped.add(worker)
+        if worker in self.hungry:
+            self.hungry.remove(worker)
+        self.stealing.discard(worker)
+        self.reruns.difference_update(units)
+        for unit in units:
+            if unit in self.needs:
+                self.pool.release(self.needs[unit])
+        self.feed()
+        return units
+
+    def release(self, worker):
+        self.retire(worker, list(self.assigned.get(worker, ())), [])
+
+    def cancel(self):
+        """Drop the pending units and tell every worker to cancel its
+        queued ones, while the tests they are running finish."""
+        if self.cancelled:
+            return
+        self.cancelled = True
+        self.pending.clear()
+        self.parked.clear()
+        self.pending_cost = 0
+        self.reruns.clear()
+        self.hungry.clear()
+        self.stealing.clear()
+        for worker in list(self.capacity):
+            self.stopped.add(worker)
+            self.assigned.pop(worker, None)
+            self.send(worker, 'cancel')
+
+    def chunk(self, worker):
+        target = self.pending_cost / (2 * self.workers)
+        size = self.capacity[worker]
+        held = sum(unit in self.needs for unit in self.assigned[worker])
+        batch, cost = [], 0
+        queues = list(self.parked.items()) + [(None, self.pending)]
+        for reason, queue in queues:
+            while queue and (len(batch) < size or cost < target):
+                unit = queue.popleft()
+                blocked = self.blocked(unit, worker, held >= size)
+                if blocked is not None and blocked == reason:
+                    # and so is the rest of its queue
+                    queue.appendleft(unit)
+                    break
+                if blocked is not None:
+                    self.parked.setdefault(blocked, collections.deque()).append(unit)
+                    continue
+                held += unit in self.needs
+                batch.append(unit)
+                cost += self.costs[unit]
+                if unit in self.affinity:
+                    self.own[self.affinity[unit]].discard(unit)
+        for reason, queue in queues:
+            if reason is not None and not queue:
+                del self.parked[reason]
+        self.pending_cost = max(0, self.pending_cost - cost)
+        return batch
+
+    def blocked(self, unit, worker, full):
+        """Return why ``unit`` cannot go to ``worker`` yet, or None once its
+        resources are acquired for it."""
+        if self.avoid.get(unit) == worker and self.others(worker):
+            return ('avoid', worker)
+        if self.claimed(unit, worker):
+            return ('owner', self.affinity[unit])
+        if unit in self.needs:
+            needs = self.needs[unit]
+            if full or not self.pool.acquire(needs):
+                return ('needs', tuple(sorted(needs.items())))
+        return None
+
+    def claimed(self, unit, worker):
+        """Whether ``unit`` waits for another worker than ``worker``."""
+        if not self.own[worker]:
+            return False
+        owner = self.affinity.get(unit, worker)
+        return (owner != worker and owner not in self.stopped
+                and unit in self.own[owner])
+
+    def feed(self):
+        for worker in list(self.hungry):
+            batch = self.chunk(worker)
+            if batch:
+                self.hungry.remove(worker)
+                self.assigned[worker].update(batch)
+                self.send(worker, 'units', units=batch)
+        if not self.hungry or self.steal():
+            # the hungry workers wait for the stolen indices
+            return
+        if self.has_pending():
+            # the units left wait for their resources
+            return
+        while self.hungry:
+            worker = self.hungry.popleft()
+            self.stopped.add(worker)
+            self.send(worker, 'stop')
+
+    def steal(self):
+        if self.stealing:
+            return True
+        victims = [
+            worker for worker, units in self.assigned.items()
+            if worker not in self.hungry and worker not in self.stopped
+            and len(units) > self.capacity[worker]
+        ]
+        if not victims:
+            return False
+        victim = max(victims, key=lambda worker: len(self.assigned[worker]))
+        self.stealing.add(victim)
+        self.send(victim, 'steal')
+        return True
@@ -0,0 +1,144 @@
+import os
+import mmap
+import pickle
+import struct
+import inspect
+import threading
+
+import pytest
+
+# A shared value is stored as: the size of its pickle and the number of
+# its buffers, where every buffer sits in the file, the pickle, and then
+# the buffers themselves, each aligned for vectorized reads.
+HEADER = struct.Struct('<QQ')
+SPAN = struct.Struct('<QQ')
+ALIGNMENT = 64
+
+# Pickling data out-of-band needs Python 3.8, older ones unpickle a copy
+# per worker.
+OUT_OF_BAND = hasattr(pickle, 'PickleBuffer')
+
+_lock = threading.Lock()
+
+
+def parallel_shared_fixture(function=None, name=None):
+    """Declare a session fixture computed once for the whole run.
+
+    The master calls ``function`` before it starts the workers and writes
+    the value to a file every worker maps read-only. Bytes and objects
+    that pickle their data out-of-band, like numpy arrays, are returned
+    as read-only views of that mapping, so all workers share the same
+    pages. Other objects are unpickled once per worker and shared by its
+    threads. Bytes are returned as a read-only memoryview in any case.
+    The function cannot request other fixtures.
+    """
+    if function is None:
+        return lambda function: parallel_shared_fixture(function, name)
+    if inspect.signature(function).parameters:
+        raise TypeError('parallel_shared_fixture {} cannot request other '
+                        'fixtures'.format(function.__qualname__))
+    # conftest files outside of packages all are modules named conftest
+    key = '{}:{}'.format(function.__code__.co_filename, function.__qualname__)
+
+    def fixture(request):
+        return shared_value(request.config, key, function)
+
+    fixture.__name__ = function.__name__
+    fixture.__qualname__ = function.__qualname__
+    fixture.__module__ = function.__module__
+    fixture.__doc__ = function.__doc__
+    fixture.parallel_shared = (key, function)
+    return pytest.fixture(scope='session', name=name or function.__name__)(
+        fixture
+    )
+
+
+def shared_value(config, key, function):
+    with _lock:
+        if not hasattr(config, 'parallel_shared_values'):
+            config.parallel_shared_values = {}
+        values = config.parallel_shared_values
+        if key not in values:
+            path = getattr(config, 'parallel_shared', {}).get(key)
+            if path and os.path.exists(path):
+                values[key] = load(path)
+            else:
+                # not run by the master, or on an agent of another machine
+                values[key] = readonly_bytes(function())
+        return values[key]
+
+
+def shared_fixtures(items):
+    """Return the functions of the shared fixtures ``items`` use by key."""
+    functions = {}
+    for item in items:
+        info = getattr(item, '_fixtureinfo', None)
+        if info is None:
+            continue
+        for fixturedefs in info.name2fixturedefs.values():
+            shared = getattr(fixturedefs[-1].func, 'parallel_shared', None)
+            if shared is not None:
+                functions.setdefault(*shared)
+    return functions
+
+
+def dump_values(functions, paths):
+    """Write the value of every function by key to its path in ``paths``,
+    and return the paths of the values that were computed."""
+    written = {}
+    for key, function in functions.items():
+        try:
+            dump(function(), paths[key])
+        except Exception:
+            # every worker computes the value itself, and reports the
+            # error with the tests that use it
+            continue
+        written[key] = paths[key]
+    return written
+
+
+def readonly_bytes(value):
+    if isinstance(value, (bytes, bytearray)):
+        return memoryview(bytes(value))
+    return value
+
+
+def dump(value, path):
+    buffers = []
+    if OUT_OF_BAND:
+        if isinstance(value, (bytes, bytearray)):
+            value = pickle.PickleBuffer(value)
+        data = pickle.dumps(value, protocol=5, buffer_callback=buffers.append)
+    else:
+        data = pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL)
+    views = [buffer.raw() for buffer in buffers]
+    spans = []
+    offset = HEADER.size + SPAN.size * len(views) + len(data)
+    for view in views:
+        offset = -(-offset // ALIGNMENT) * ALIGNMENT
+        spans.append((offset, view.nbytes))
+        offset += view.nbytes
+    with open(path, 'wb') as f:
+        f.write(HEADER.pack(len(data), len(views)))
+        for span in spans:
+            f.write(SPAN.pack(*span))
+        f.write(data)
+        for (start, _), view in zip(spans, views):
+            f.seek(start)
+            f.write(view)
+
+
+def load(path):
+    with open(path, 'rb') as f:
+        view = memoryview(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ))
+    size, count = HEADER.unpack_from(view)
+    spans = [SPAN.unpack_from(view, HEADER.size + SPAN.size * index)
+             for index in range(count)]
+    start = HEADER.size + SPAN.size * count
+    data = view[start:start + size]
+    if not spans:
+        return readonly_bytes(pickle.loads(data))
+    # the views keep the mapping open for as long as the value lives
+    return pickle.loads(data, buffers=[
+        view[offset:offset + length] for offset, length in spans
+    ])
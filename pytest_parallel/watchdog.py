@@ -0,0 +1,136 @@
+import sys
+import time
+import ctypes
+import threading
+import traceback
+import contextlib
+
+# A test interrupted for running out of time gets this long to give up,
+# or its timeout if that is shorter, before its thread is abandoned.
+TIMEOUT_GRACE = 5.
+
+
+class Timeout(Exception):
+    """Raised in a test that ran longer than its timeout."""
+
+    def __init__(self, message='the test ran longer than its parallel timeout'):
+        super(Timeout, self).__init__(message)
+
+
+def item_timeout(item, default=None):
+    """Return the seconds ``item`` may run, None for no limit."""
+    marker = item.get_closest_marker('parallel_timeout')
+    if marker is None:
+        return default
+    seconds = marker.args[0] if marker.args else marker.kwargs.get('seconds')
+    return float(seconds) if seconds else None
+
+
+def interrupt(thread):
+    """Raise Timeout in ``thread`` once it runs Python code again."""
+    pythonapi = getattr(ctypes, 'pythonapi', None)
+    if pythonapi is None:
+        return False
+    return pythonapi.PyThreadState_SetAsyncExc(
+        ctypes.c_ulong(thread.ident), ctypes.py_object(Timeout)
+    ) == 1
+
+
+def clear_interrupt(thread):
+    pythonapi = getattr(ctypes, 'pythonapi', None)
+    if pythonapi is not None:
+        pythonapi.PyThreadState_SetAsyncExc(ctypes.c_ulong(thread.ident), None)
+
+
+def thread_stack(thread):
+    frame = sys._current_frames().get(thread.ident)
+    if frame is None:
+        return ''
+    return ''.join(traceback.format_stack(frame))
+
+
+class Watchdog(threading.Thread):
+    """Stops the tests of a worker that run longer than their timeout.
+
+    Threads tell the watchdog when they start and finish a test. Once a
+    test runs out of time, Timeout is raised in its thread, which fails
+    the test with a traceback of wherever it was stuck in Python code.
+    Threads are only interrupted while they run the test itself, within
+    ``interruptible``, as an exception anywhere else in pytest's runtest
+    protocol would lose the test and its teardown; a test still in its
+    setup when it runs out of time is interrupted as soon as it is called.
+    A thread that does not come back within the grace period is blocked in
+    a call that never returns, so it is given up on: ``abandon`` is called
+    with the thread, the index of its test, the timeout and its stack.
+    """
+
+    def __init__(self, abandon):
+        threading.Thread.__init__(self, name='watchdog')
+        self.daemon = True
+        self._abandon = abandon
+        self._cond = threading.Condition()
+        self._watched = {}
+
+    @contextlib.contextmanager
+    def watch(self, index, timeout):
+        if not timeout:
+            yield
+            return
+        thread = threading.current_thread()
+        with self._cond:
+            # index, deadline, timeout, whether it was interrupted, whether
+            # it may be and whether it ran out of time while it may not
+            self._watched[thread] = [index, time.time() + timeout, timeout,
+                                     False, False, False]
+            self._cond.notify()
+        try:
+            yield
+        finally:
+            with self._cond:
+                watched = self._watched.pop(thread, None)
+                if watched is not None and watched[3]:
+                    # the test finished just as it was interrupted
+                    clear_interrupt(thread)
+
+    @contextlib.contextmanager
+    def interruptible(self):
+        thread = threading.current_thread()
+        with self._cond:
+            watched = self._watched.get(thread)
+            if watched is not None and watched[5]:
+                # it ran out of time before it was called
+                raise Timeout()
+            if watched is not None:
+                watched[4] = True
+        try:
+            yield
+        finally:
+            with self._cond:
+                if watched is not None:
+                    watched[4] = False
+                    if watched[3]:
+                        # the test returned just as it was interrupted
+                        clear_interrupt(thread)
+
+    def run(self):
+        with self._cond:
+            while True:
+                now = time.time()
+                for thread, watched in list(self._watched.items()):
+                    index, deadline, timeout, interrupted, armed, overdue = watched
+                    if now < deadline:
+                        continue
+                    if not interrupted and armed and interrupt(thread):
+                        watched[1] = now + min(timeout, TIMEOUT_GRACE)
+                        watched[3] = True
+                        continue
+                    if not interrupted and not overdue:
+                        # waits for the test to be called, or to finish
+                        watched[1] = now + TIMEOUT_GRACE
+                        watched[5] = True
+                        continue
+                    del self._watched[thread]
+                    self._abandon(thread, index, timeout, thread_stack(thread))
+                deadlines = [watched[1] for watched in self._watched.values()]
+                self._cond.wait(max(min(deadlines) - now, 0) if deadlines
+                                else None)
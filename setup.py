@@ -36,7 +36,10 @@ setup(
     entry_points={
         'pytest11': [
             'parallel = pytest_parallel',
-        ]
+        ],
+        'console_scripts': [
+            'pytest-parallel = pytest_parallel.__main__:main',
+        ],
     },
 
     # For a list of valid classifiers, see https://pypi.org/classifiers/
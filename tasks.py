@@ -18,6 +18,11 @@ def lint(c):
     c.run('tox -e flake8')
 
 
+@task
+def bench(c):
+    c.run('python benchmarks/run.py')
+
+
 @task
 def build(c):
     shutil.rmtree('build', ignore_errors=True)
@@ -0,0 +1,44 @@
+import os
+import sys
+import json
+import subprocess
+
+BENCHMARKS = os.path.join(os.path.dirname(__file__), '..', 'benchmarks')
+
+
+def benchmark(*args, script='run.py'):
+    return subprocess.run([sys.executable, os.path.join(BENCHMARKS, script)] +
+                          list(args),
+                          stdout=subprocess.PIPE, universal_newlines=True,
+                          check=True).stdout
+
+
+def test_benchmark_writes_comparable_results(tmpdir):
+    output = str(tmpdir.join('results.json'))
+    benchmark('--suites', 'noop,sleep', '--workers', '2',
+              '--tests-per-worker', '2', '--scale', '.01', '--output', output)
+    with open(output) as f:
+        results = json.load(f)['results']
+    assert [(result['suite'], result['workers']) for result in results] == [
+        ('noop', None), ('noop', 2), ('sleep', None), ('sleep', 2),
+    ]
+    plain, parallel = results[2:]
+    assert plain['tests'] == parallel['tests'] == 4
+    assert plain['startup'] is None
+    for metric in ('wall', 'startup', 'report_throughput'):
+        assert parallel[metric] > 0
+    assert parallel['dispatch_latency'] >= 0
+    assert parallel['peak_rss'] > 1 << 20
+
+    lines = benchmark('--compare', output, output).splitlines()
+    assert lines[-1].startswith('sleep     2 workers x 2 tests    wall +0%')
+
+
+def test_environ_benchmark_times_both_environments():
+    lines = benchmark('--number', '100', '--repeat', '1',
+                      script='environ.py').splitlines()
+    assert lines[0].split() == ['os.environ', 'isolated', 'ratio']
+    assert [line.rsplit(None, 3)[0] for line in lines[1:]] == [
+        'getitem', 'get missing', 'contains', 'current test', 'setitem',
+        'iterate', 'len',
+    ]
@@ -1,3 +1,13 @@
+import re
+import sys
+import subprocess
+
+import pytest
+
+# the logging plugin keeps the logs of a test per thread from pytest 6 on
+LOGS_PER_THREAD = int(pytest.__version__.split('.')[0]) >= 6
+
+
 def test_concurrent_fixture(testdir):
     testdir.makepyfile("""
         import pytest
@@ -40,3 +50,231 @@ def test_concurrent_fixture(testdir):
     ])
     result.assert_outcomes(passed=2)
     assert result.ret == 0
+
+
+def test_asyncio_tests_share_one_event_loop(testdir):
+    testdir.makepyfile("""
+        import asyncio
+        import pytest
+
+        loops = set()
+
+        @pytest.fixture
+        async def connection():
+            await asyncio.sleep(0)
+            return 'connection'
+
+        @pytest.fixture
+        async def session(connection):
+            yield connection + ' session'
+            await asyncio.sleep(0)
+            loops.add(asyncio.get_running_loop())
+            assert len(loops) == 1
+
+        async def check(session):
+            assert session == 'connection session'
+            await asyncio.sleep(.5)
+    """ + ''.join("""
+        async def test_{}(session):
+            await check(session)
+    """.format(i) for i in range(20)))
+    result = testdir.runpytest('--parallel-asyncio=20')
+    result.stdout.fnmatch_lines([
+        'pytest-parallel: 1 worker (process), 1 test per worker (thread), '
+        'up to 20 coroutine tests at a time',
+    ])
+    result.assert_outcomes(passed=20)
+    assert result.ret == 0
+    assert result.duration < 5
+
+
+@pytest.mark.skipif(sys.version_info < (3, 7),
+                    reason='coroutine tests need context variables')
+def test_asyncio_tests_do_not_take_a_thread_each(testdir):
+    testdir.makepyfile("""
+        import asyncio
+        import threading
+
+        started = set()
+        threads = []
+
+        async def check(n):
+            started.add(n)
+            while len(started) < 100:
+                await asyncio.sleep(.01)
+            threads.append(threading.active_count())
+            assert max(threads) < 20
+    """ + ''.join("""
+        async def test_{0}():
+            await check({0})
+    """.format(i) for i in range(100)))
+    result = testdir.runpytest('--parallel-asyncio=100')
+    result.assert_outcomes(passed=100)
+    assert result.ret == 0
+
+
+def test_asyncio_concurrency_limit(testdir):
+    testdir.makepyfile("""
+        import asyncio
+
+        running = []
+
+        async def check(n):
+            running.append(n)
+            assert len(running) <= 2
+            await asyncio.sleep(.1)
+            running.remove(n)
+    """ + ''.join("""
+        async def test_{0}():
+            await check({0})
+    """.format(i) for i in range(6)))
+    result = testdir.runpytest('--parallel-asyncio=2', '--tests-per-worker=6')
+    result.assert_outcomes(passed=6)
+    assert result.ret == 0
+
+
+def test_asyncio_keeps_sync_tests_apart(testdir):
+    testdir.makepyfile("""
+        import time
+        import asyncio
+        import threading
+
+        running = []
+        lock = threading.Lock()
+
+        def check(n):
+            with lock:
+                running.append(n)
+                assert len(running) == 1
+            time.sleep(.05)
+            with lock:
+                running.remove(n)
+
+        async def test_async():
+            await asyncio.sleep(.1)
+    """ + ''.join("""
+        def test_{0}():
+            check({0})
+    """.format(i) for i in range(6)))
+    result = testdir.runpytest('--parallel-asyncio=4')
+    result.assert_outcomes(passed=7)
+    assert result.ret == 0
+
+
+@pytest.mark.parametrize('cli_args, check', [
+  (['--tests-per-worker=4'], """
+        barrier = threading.Barrier(4)
+
+        def check(name, caplog):
+            barrier.wait(5)
+            for i in range(20):
+                write(name, i)
+                time.sleep(.001)
+            assert_logged(name, caplog)
+  """),
+  (['--parallel-asyncio=4'], """
+        started = set()
+
+        async def check(name, caplog):
+            started.add(name)
+            while len(started) < 4:
+                await asyncio.sleep(.01)
+            for i in range(20):
+                write(name, i)
+                await asyncio.sleep(.001)
+            assert_logged(name, caplog)
+  """),
+])
+def test_output_is_captured_per_thread(testdir, cli_args, check):
+    testdir.makepyfile("""
+        import sys
+        import time
+        import asyncio
+        import logging
+        import threading
+
+        log = logging.getLogger('checks')
+
+        def write(name, i):
+            print(name, 'out', i)
+            sys.stderr.write(name + ' err\\n')
+            log.warning('%s log', name)
+
+        def assert_logged(name, caplog):
+            assert not {} or {{
+                record.getMessage() for record in caplog.records
+            }} == {{name + ' log'}}
+    """.format(LOGS_PER_THREAD) + check + ''.join("""
+        {1}def test_{0}(caplog):
+            {2}check('{0}', caplog)
+    """.format(name, *(('async ', 'await ') if 'async' in check else ('', '')))
+                  for name in 'abcd'))
+    result = testdir.runpytest('-rP', *cli_args)
+    result.assert_outcomes(passed=4)
+    captured = r'(out \d+|err|log)' if LOGS_PER_THREAD else r'(out \d+|err)'
+    sections = {}
+    for line in result.stdout.lines:
+        header = re.match(r'_+ test_(\w) _+$', line)
+        if header:
+            sections[header.group(1)] = lines = []
+        elif sections and re.search(r'\b{}$'.format(captured), line):
+            lines.append(line)
+    assert sorted(sections) == list('abcd')
+    for name, lines in sections.items():
+        assert len(lines) == (60 if LOGS_PER_THREAD else 40)
+        assert all(re.search(r'\b{} {}$'.format(name, captured), line)
+                   for line in lines)
+
+
+def test_tests_cannot_read_stdin(testdir):
+    testdir.makepyfile("""
+        import pytest
+
+        def test_a():
+            with pytest.raises((OSError, EOFError)):
+                input()
+
+        def test_b():
+            with pytest.raises((OSError, EOFError)):
+                input()
+    """)
+    # stdin stays open, reading it would block until the run is killed
+    process = subprocess.Popen(
+        [sys.executable, '-m', 'pytest', '-p', 'no:cacheprovider',
+         '--tests-per-worker=2'],
+        cwd=str(testdir.tmpdir), stdin=subprocess.PIPE,
+        stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+        universal_newlines=True
+    )
+    try:
+        process.wait(timeout=30)
+    finally:
+        process.kill()
+    assert '2 passed' in process.stdout.read()
+
+
+def test_threads_keep_their_own_test_state(testdir):
+    testdir.makepyfile("""
+        import os
+        import time
+        import pytest
+
+        @pytest.fixture
+        def doubled(n):
+            time.sleep(.01)
+            return n * 2
+
+        @pytest.mark.parametrize('n', range(20))
+        def test_double(n, doubled):
+            current = '[{}] (call)'.format(n)
+            assert os.environ['PYTEST_CURRENT_TEST'].endswith(current)
+            assert 'PYTEST_CURRENT_TEST' in os.environ
+            assert list(os.environ).count('PYTEST_CURRENT_TEST') == 1
+            assert len(os.environ) == len(list(os.environ))
+            time.sleep(.05)
+            assert doubled == n * 2
+            assert os.environ.get('PYTEST_CURRENT_TEST').endswith(current)
+    """)
+    result = testdir.runpytest('--tests-per-worker=10')
+    result.assert_outcomes(passed=20)
+    assert result.ret == 0
@@ -0,0 +1,66 @@
+import os
+import sys
+import time
+import subprocess
+
+import pytest
+
+from pytest_parallel.daemon import find_daemon
+
+pytestmark = pytest.mark.skipif(
+    sys.platform.startswith('win'), reason='the daemon needs fork'
+)
+
+
+def cli(*args):
+    return subprocess.run(
+        [sys.executable, '-m', 'pytest_parallel'] + list(args),
+        stdout=subprocess.PIPE, stderr=subprocess.STDOUT, timeout=60,
+        universal_newlines=True,
+    )
+
+
+@pytest.fixture
+def daemon(testdir):
+    process = subprocess.Popen(
+        [sys.executable, '-m', 'pytest_parallel', 'daemon'],
+        stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+    )
+    deadline = time.time() + 30
+    while find_daemon(os.getcwd()) is None:
+        assert process.poll() is None and time.time() < deadline
+        time.sleep(.1)
+    yield process
+    cli('daemon', '--stop')
+    process.wait(timeout=30)
+
+
+def test_run_on_warm_daemon(testdir):
+    testdir.makepyfile(helper="VALUE = 1")
+    testdir.makepyfile("""
+        from helper import VALUE
+
+        def test_value():
+            assert VALUE == 1
+    """)
+    testdir.request.getfixturevalue('daemon')
+
+    result = cli('run', '-q', '--workers=2')
+    assert '1 passed' in result.stdout
+    assert result.returncode == 0
+
+    helper = testdir.tmpdir.join('helper.py')
+    helper.write('VALUE = 2')
+    os.utime(str(helper), (time.time() + 5, time.time() + 5))
+    result = cli('run', '-q')
+    assert 'restarting the daemon' in result.stdout
+    assert '1 failed' in result.stdout
+    assert result.returncode == 1
+
+
+def test_run_without_daemon(testdir):
+    testdir.makepyfile("def test_value(): pass")
+    result = cli('run', '-q')
+    assert 'no daemon running' in result.stdout
+    assert '1 passed' in result.stdout
+    assert result.returncode == 0
@@ -1,6 +1,9 @@
 import pytest
+import os
 import re
 
+from pytest_parallel.collection import PARTITIONS_SUPPORTED
+
 
 def test_help(testdir):
     result = testdir.runpytest(
@@ -258,3 +261,412 @@ def test_collection_collectonly(testdir, cli_args):
     ])
     result.assert_outcomes()
     assert result.ret == 0
+
+
+@pytest.mark.parametrize('cli_args', [
+  ['--workers=2'],
+  ['--tests-per-worker=3'],
+  ['--workers=2', '--tests-per-worker=3']
+])
+def test_dispatch_runs_every_item_once(testdir, cli_args):
+    testdir.makepyfile("""
+        import pytest
+
+        @pytest.mark.parametrize('n', range(50))
+        def test_n(n):
+            assert n >= 0
+    """)
+    result = testdir.runpytest(*cli_args)
+    result.assert_outcomes(passed=50)
+    assert result.ret == 0
+
+
+def test_channel_encoding_roundtrip():
+    import decimal
+    from pytest_parallel import decode, encode
+
+    message = ('reports', {'reports': [{'nodeid': 'test.py::test', 'duration': .1}]})
+    assert encode(message)[:1] == b'm'
+    assert decode(encode(message)) == message
+
+    # objects marshal cannot handle fall back to pickle
+    amount = decimal.Decimal('1.5')
+    message = ('reports', {'reports': [{'user_properties': [('amount', amount)]}]})
+    assert encode(message)[:1] == b'p'
+    assert decode(encode(message)) == message
+
+
+@pytest.mark.parametrize('cli_args', [
+  ['--workers=2'],
+  ['--tests-per-worker=2']
+])
+def test_reports_forwarded_in_batches(testdir, cli_args):
+    testdir.makepyfile('import pytest\n' + '\n'.join(
+        'def test_{0}(): {0} % 7 or pytest.skip()'.format(i) for i in range(200)
+    ))
+    result = testdir.runpytest('--junitxml=junit.xml', *cli_args)
+    result.assert_outcomes(passed=171, skipped=29)
+    junit = testdir.tmpdir.join('junit.xml').read()
+    assert junit.count('<testcase ') == 200
+    assert junit.count('<skipped ') == 29
+
+
+@pytest.mark.parametrize('start_method', ['spawn', 'forkserver'])
+@pytest.mark.parametrize('cli_args', [
+  ['--workers=2'],
+  ['--workers=2', '--tests-per-worker=2']
+])
+def test_start_methods(testdir, start_method, cli_args):
+    testdir.makeconftest("""
+        import pytest
+
+        @pytest.fixture
+        def answer():
+            return 42
+    """)
+    testdir.makepyfile("""
+        import os
+
+        def test_env(answer):
+            assert answer == 42
+            os.environ['PYTEST_PARALLEL_SEEN'] = '1'
+
+        def test_fail():
+            assert 1 == 2
+    """)
+    result = testdir.runpytest(
+        '--parallel-start-method=' + start_method,
+        '--parallel-preload=json',
+        *cli_args
+    )
+    result.assert_outcomes(passed=1, failed=1)
+    assert result.ret == 1
+
+
+def test_spawned_worker_collects_different_tests(testdir):
+    testdir.makepyfile("""
+        import os
+        import pytest
+
+        @pytest.mark.parametrize('pid', [os.getpid()])
+        def test_pid(pid):
+            pass
+    """)
+    result = testdir.runpytest_subprocess(
+        '--workers=1', '--parallel-start-method=spawn'
+    )
+    result.stdout.fnmatch_lines(['*worker did not collect test_*::test_pid*'])
+    assert result.ret == 3
+
+
+@pytest.mark.parametrize('cli_args, min_pids', [
+  (['--max-tests-per-worker=2'], 5),
+  (['--max-tests-per-worker=3', '--tests-per-worker=2'], 3),
+  (['--max-worker-rss=1M'], 10),
+  (['--max-tests-per-worker=2', '--parallel-start-method=spawn'], 5),
+])
+def test_workers_are_recycled(testdir, cli_args, min_pids):
+    testdir.makepyfile('import os\n' + '\n'.join("""
+def test_{}():
+    with open('pids', 'a') as f:
+        f.write('{{}}\\n'.format(os.getpid()))
+""".format(i) for i in range(10)))
+    result = testdir.runpytest('--workers=2', *cli_args)
+    result.assert_outcomes(passed=10)
+    pids = testdir.tmpdir.join('pids').readlines()
+    assert len(pids) == 10
+    assert len(set(pids)) >= min_pids
+
+
+def test_parse_size():
+    from pytest_parallel import parse_size
+
+    assert parse_size('512') == 512 << 20
+    assert parse_size('64K') == 64 << 10
+    assert parse_size('1.5g') == 3 << 29
+    assert parse_size('2GB') == 2 << 30
+
+
+@pytest.mark.parametrize('cli_args, failed', [
+  (['--workers=2', '-x'], 1),
+  (['--workers=2', '--maxfail=2'], 2),
+  (['--workers=2', '--tests-per-worker=2', '--parallel-dist=loadfile', '-x'], 1),
+])
+def test_fail_fast_stops_every_worker(testdir, cli_args, failed):
+    test = """
+def test_{0}():
+    time.sleep(.1)
+    assert {1}
+"""
+    # only the first file fails, every fourth test
+    testdir.makepyfile(
+        test_first='import time\n' + '\n'.join(
+            test.format(i, i % 4) for i in range(1, 21)
+        ),
+        test_second='import time\n' + '\n'.join(
+            test.format(i, True) for i in range(1, 21)
+        ),
+    )
+    result = testdir.runpytest(*cli_args)
+    outcomes = result.parseoutcomes()
+    assert outcomes['failed'] == failed
+    # the other worker stops as well, instead of running the whole suite
+    assert outcomes['passed'] < 20
+
+
+@pytest.mark.parametrize('cli_args', [
+  ['--tests-per-worker=4'],
+  ['--workers=2', '--tests-per-worker=4'],
+  ['--tests-per-worker=4', '--parallel-start-method=spawn'],
+])
+def test_serial_tests_run_alone_in_their_worker(testdir, cli_args):
+    testdir.makepyfile("""
+        import threading
+        import pytest
+
+        alone = threading.Lock()
+        serial = []
+        regular = []
+        met = threading.Event()
+
+        def record(name, concurrent):
+            with open('concurrency', 'a') as f:
+                f.write('{} {}\\n'.format(name, concurrent))
+    """ + '\n'.join("""
+        def test_regular_{0}():
+            regular.append({0})
+            if len(regular) > 1:
+                met.set()
+            try:
+                # the other regular tests of the worker run alongside
+                met.wait(2)
+                assert not serial
+            finally:
+                regular.remove({0})
+            record('regular', met.is_set())
+    """.format(i) for i in range(6)) + '\n'.join("""
+        @pytest.mark.parallel_serial
+        def test_serial_{0}():
+            assert alone.acquire(False)
+            serial.append({0})
+            try:
+                assert not regular
+            finally:
+                serial.remove({0})
+                alone.release()
+            record('serial', False)
+    """.format(i) for i in range(6)))
+    result = testdir.runpytest(*cli_args)
+    result.assert_outcomes(passed=12)
+    seen = [line.split() for line in testdir.tmpdir.join('concurrency').readlines()]
+    assert sorted(name for name, _ in seen) == ['regular'] * 6 + ['serial'] * 6
+    assert any(concurrent == 'True' for name, concurrent in seen
+               if name == 'regular')
+
+
+@pytest.mark.parametrize('cli_args', [
+  ['--tests-per-worker=2'],
+  ['--workers=2', '--parallel-dist=loadfile'],
+  ['--workers=2', '--parallel-start-method=spawn'],
+])
+def test_isolated_tests_get_a_fresh_process(testdir, cli_args):
+    testdir.makepyfile("""
+        import os
+        import pytest
+
+        def record(name):
+            with open('pids', 'a') as f:
+                f.write('{} {}\\n'.format(name, os.getpid()))
+    """ + '\n'.join("""
+        def test_regular_{0}():
+            record('regular')
+
+        @pytest.mark.parallel_process_isolated
+        def test_isolated_{0}():
+            record('isolated')
+    """.format(i) for i in range(4)))
+    result = testdir.runpytest(*cli_args)
+    result.assert_outcomes(passed=8)
+    pids = [line.split() for line in testdir.tmpdir.join('pids').readlines()]
+    isolated = [pid for name, pid in pids if name == 'isolated']
+    regular = {pid for name, pid in pids if name == 'regular'}
+    assert len(isolated) == 4
+    assert len(set(isolated)) == 4
+    assert not regular & set(isolated)
+
+
+@pytest.mark.parametrize('cli_args', [
+  ['--workers=2'],
+  ['--workers=2', '--tests-per-worker=2'],
+  ['--workers=1', '--parallel-start-method=spawn'],
+])
+@pytest.mark.parametrize('crash, reason', [
+  ('os.kill(os.getpid(), signal.SIGKILL)', 'crashed with signal SIGKILL'),
+  ('os._exit(3)', 'crashed with exit code 3'),
+])
+def test_crashed_workers_are_replaced(testdir, cli_args, crash, reason):
+    testdir.makepyfile(test_crash="""
+        import os
+        import signal
+
+        def test_crash():
+            {}
+
+        def test_crash_once():
+            if not os.path.exists('crashed'):
+                open('crashed', 'w').close()
+                {}
+    """.format(crash, crash))
+    testdir.makepyfile(test_other='import time\n' + '\n'.join("""
+def test_{}():
+    time.sleep(.05)
+""".format(i) for i in range(10)))
+    result = testdir.runpytest(*cli_args)
+    result.assert_outcomes(passed=11, failed=1)
+    result.stdout.fnmatch_lines([
+        '*_ test_crash _*',
+        'worker * ' + reason,
+    ])
+
+
+@pytest.mark.parametrize('cli_args', [
+  ['--workers=2'],
+  ['--workers=2', '--tests-per-worker=2', '--parallel-dist=loadfile'],
+  ['--workers=1', '--parallel-start-method=spawn'],
+])
+def test_tests_past_their_timeout_fail(testdir, cli_args):
+    testdir.makepyfile(test_timeout="""
+        import time
+        import threading
+        import pytest
+
+        def test_spin():
+            while True:
+                pass
+
+        def test_hang():
+            threading.Event().wait()
+
+        @pytest.mark.parallel_timeout(0)
+        def test_slow():
+            time.sleep(.7)
+
+        def test_after_hang():
+            pass
+    """)
+    testdir.makepyfile(test_other='import time\n' + '\n'.join("""
+def test_{}():
+    time.sleep(.05)
+""".format(i) for i in range(6)))
+    result = testdir.runpytest('--parallel-timeout=.5', *cli_args)
+    result.assert_outcomes(passed=8, failed=2)
+    result.stdout.fnmatch_lines([
+        '*Timeout: the test ran longer than its parallel timeout',
+    ])
+    result.stdout.fnmatch_lines([
+        '*test_hang ran longer than 0.5s and could not be stopped*',
+        '*threading.Event().wait()*',
+    ])
+
+
+def test_timeout_only_interrupts_the_test_itself(testdir):
+    testdir.makeconftest("""
+        import time
+        import pytest
+
+        @pytest.hookimpl(hookwrapper=True)
+        def pytest_runtest_makereport(item, call):
+            if call.when == 'call' and item.name == 'test_slow_report':
+                end = time.time() + 1.5
+                while time.time() < end:
+                    pass
+            yield
+    """)
+    testdir.makepyfile(test_timeout="""
+        import time
+        import pytest
+
+        @pytest.fixture
+        def resource():
+            yield
+            time.sleep(.7)
+
+        @pytest.fixture
+        def slow_setup():
+            time.sleep(.7)
+
+        def test_slow_report(resource):
+            pass
+
+        def test_slow_setup(slow_setup):
+            pass
+
+        def test_after(resource):
+            pass
+    """)
+    result = testdir.runpytest('--workers=1', '--parallel-timeout=.5')
+    result.assert_outcomes(passed=2, failed=1)
+    result.stdout.fnmatch_lines([
+        '*_ test_slow_setup _*',
+        '*Timeout: the test ran longer than its parallel timeout',
+    ])
+
+
+@pytest.mark.skipif(not PARTITIONS_SUPPORTED,
+                    reason='older pytest collects in the master')
+@pytest.mark.parametrize('cli_args', [
+  ['--workers=3'],
+  ['--workers=3', '--tests-per-worker=2', '--max-tests-per-worker=1', '-k', 'x'],
+])
+def test_parallel_collection_spreads_the_imports(testdir, cli_args):
+    for package in 'abcd':
+        testdir.mkdir(package)
+        for i in range(3):
+            testdir.tmpdir.join(package, 'test_{}{}.py'.format(package, i)).write(
+                'import os\n'
+                'with open({!r}, "a") as f:\n'
+                '    f.write("{{}}\\n".format(os.getpid()))\n'
+                '\n'
+                'def test_x():\n'
+                '    pass\n'
+                '\n'
+                'def test_y():\n'
+                '    pass\n'.format(str(testdir.tmpdir.join('imports')))
+            )
+    result = testdir.runpytest('--parallel-collect', *cli_args)
+    selected = 24 if '-k' not in cli_args else 12
+    result.assert_outcomes(passed=selected)
+    pids = testdir.tmpdir.join('imports').read().split()
+    assert str(os.getpid()) not in pids
+    assert len(set(pids[:12])) == 3
+    if '--max-tests-per-worker=1' in cli_args:
+        # fresh workers collect the partitions of the tests they are handed
+        assert len(pids) > 12
+
+
+@pytest.mark.skipif(not PARTITIONS_SUPPORTED,
+                    reason='older pytest collects in the master')
+def test_stand_in_items_fail_to_run(testdir):
+    from pytest_parallel.collection import CollectedItem
+
+    config = testdir.parseconfigure()
+    session = pytest.Session.from_config(config)
+    item = CollectedItem.from_description(
+        session, ('test_a.py::test_a', ('test_a.py', 0, 'test_a'), [], [])
+    )
+    with pytest.raises(pytest.fail.Exception, match='collected by a worker'):
+        item.runtest()
+
+
+def test_parallel_collection_reports_errors(testdir):
+    for package in 'abc':
+        testdir.mkdir(package).join('test_{}.py'.format(package)).write(
+            'def test_ok():\n    pass\n'
+        )
+    testdir.tmpdir.join('b', 'test_broken.py').write('import missing_module\n')
+    result = testdir.runpytest('--workers=3', '--parallel-collect')
+    result.stdout.fnmatch_lines([
+        '*ERROR collecting b/test_broken.py*',
+        '*Interrupted: 1 error during collection*',
+    ])
+    assert result.ret == 2
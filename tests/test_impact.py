@@ -0,0 +1,123 @@
+import os
+
+import pytest
+
+from pytest_parallel.impact import fingerprint, project_files
+
+
+def test_project_files_skip_installed_packages(tmpdir):
+    root = str(tmpdir)
+    assert project_files([
+        os.path.join(root, 'app', 'models.py'),
+        os.path.join(root, 'venv', 'lib', 'site-packages', 'six.py'),
+        os.path.join(root + '-other', 'models.py'),
+        '<frozen importlib._bootstrap>',
+        os.path.join(root, 'tests', 'test_models.py'),
+    ], root) == [os.path.join('app', 'models.py'),
+                 os.path.join('tests', 'test_models.py')]
+
+
+def test_fingerprint_reads_changed_files_only(tmpdir):
+    path = tmpdir.join('module.py')
+    path.write('x = 1\n')
+    known = fingerprint(str(path))
+    assert fingerprint(str(path), known) is known
+    path.write('x = 22\n')
+    assert fingerprint(str(path), known)[2] != known[2]
+    assert fingerprint(str(tmpdir.join('missing.py'))) is None
+
+
+@pytest.mark.parametrize('cli_args', [
+  ['--workers=2'],
+  ['--workers=2', '--tests-per-worker=2'],
+])
+def test_only_affected_tests_run(testdir, cli_args):
+    testdir.makepyfile(lib_a='def a():\n    return 1\n',
+                       lib_b='def b():\n    return 2\n')
+    testdir.makepyfile(test_libs="""
+        import lib_a, lib_b
+
+        def test_a():
+            assert lib_a.a() == 1
+
+        def test_b():
+            assert lib_b.b() == 2
+
+        def test_neither():
+            pass
+    """)
+    args = ['--parallel-impact=select'] + cli_args
+
+    result = testdir.runpytest(*args)
+    result.assert_outcomes(passed=3)
+    result.stdout.fnmatch_lines(['pytest-parallel: no valid test impact map*'])
+
+    result = testdir.runpytest(*args)
+    result.assert_outcomes()
+    result.stdout.fnmatch_lines(['*3 deselected*'])
+
+    testdir.makepyfile(lib_a='def a():\n    return 11\n')
+    result = testdir.runpytest(*args)
+    result.assert_outcomes(failed=1)
+    result.stdout.fnmatch_lines(['*2 deselected*'])
+
+    # a failed test runs until it passes again
+    testdir.makepyfile(lib_b='def b():\n    return 2  # unrelated\n')
+    result = testdir.runpytest(*args)
+    result.assert_outcomes(passed=1, failed=1)
+    result.stdout.fnmatch_lines(['*1 deselected*'])
+
+    # a new ini file makes the whole map stale
+    testdir.makeini('[pytest]\n')
+    result = testdir.runpytest(*args)
+    result.assert_outcomes(passed=2, failed=1)
+
+
+def test_record_keeps_tests_that_missed_a_change(testdir):
+    testdir.makepyfile(lib_a='def a():\n    return 1\n')
+    testdir.makepyfile(test_libs="""
+        import lib_a
+
+        def test_a():
+            assert lib_a.a() == 1
+
+        def test_also_a():
+            assert lib_a.a() == 1
+    """)
+    testdir.runpytest('--workers=2', '--parallel-impact=record')
+    testdir.makepyfile(lib_a='def a():\n    return 1  # changed\n')
+    # only one of the affected tests runs, the other one stays due
+    testdir.runpytest('--workers=2', '--parallel-impact=record', '-k', 'not also')
+    result = testdir.runpytest('--workers=2', '--parallel-impact=select')
+    result.assert_outcomes(passed=1)
+    result.stdout.fnmatch_lines(['*1 deselected*'])
+
+
+def test_collection_errors_end_the_run(testdir):
+    testdir.makepyfile(test_ok='def test_ok():\n    pass\n',
+                       test_broken='import missing_module\n')
+    result = testdir.runpytest('--workers=2', '--parallel-impact=record')
+    result.stdout.fnmatch_lines(['*Interrupted: 1 error during collection*'])
+    assert 'INTERNALERROR' not in result.stdout.str()
+    assert result.ret == 2
+
+
+def test_coroutine_tests_record_their_files(testdir):
+    testdir.makepyfile(lib_a='def a():\n    return 1\n')
+    testdir.makepyfile(test_libs="""
+        import asyncio
+        import lib_a
+
+        async def test_a():
+            await asyncio.sleep(0)
+            assert lib_a.a() == 1
+
+        async def test_neither():
+            await asyncio.sleep(0)
+    """)
+    args = ['--workers=2', '--parallel-asyncio=2', '--parallel-impact=select']
+    testdir.runpytest(*args)
+    testdir.makepyfile(lib_a='def a():\n    return 11\n')
+    result = testdir.runpytest(*args)
+    result.assert_outcomes(failed=1)
+    result.stdout.fnmatch_lines(['*1 deselected*'])
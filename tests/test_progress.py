@@ -0,0 +1,62 @@
+from types import SimpleNamespace
+
+import pytest
+
+from pytest_parallel.progress import Progress, format_seconds
+
+
+def report(nodeid, when, outcome='passed'):
+    return SimpleNamespace(
+        nodeid=nodeid, when=when, outcome=outcome,
+        passed=outcome == 'passed', failed=outcome == 'failed',
+        skipped=outcome == 'skipped',
+    )
+
+
+def test_progress_counts_outcomes_and_estimates_time_left(monkeypatch):
+    now = [100.]
+    monkeypatch.setattr('pytest_parallel.progress.time.time', lambda: now[0])
+    progress = Progress({'a': 1., 'b': 3., 'c': 4., 'd': 2.})
+    assert progress.line() == ('pytest-parallel: 0/4 tests done (0%), '
+                               '0 passed, ETA unknown')
+
+    for nodeid, outcomes in (('a', ('passed', 'passed', 'passed')),
+                             ('b', ('passed', 'failed', 'passed')),
+                             ('c', ('failed', None, 'failed'))):
+        for when, outcome in zip(('setup', 'call', 'teardown'), outcomes):
+            if outcome is not None:
+                progress.update(report(nodeid, when, outcome))
+    now[0] += 8.
+    progress.update(report('d', 'setup', 'skipped'))
+
+    # 8 seconds of estimated cost were done in 8 seconds, 2 are left
+    assert progress.line() == ('pytest-parallel: 3/4 tests done (75%), '
+                               '1 passed, 1 failed, 2 error, 1 skipped, ETA 2s')
+
+
+@pytest.mark.parametrize('seconds, formatted', [
+    (4.4, '4s'),
+    (75, '1m15s'),
+    (3 * 3600 + 5 * 60 + 59, '3h05m'),
+])
+def test_format_seconds(seconds, formatted):
+    assert format_seconds(seconds) == formatted
+
+
+@pytest.mark.parametrize('cli_args', [
+  ['--workers=2'],
+  ['--workers=2', '--tests-per-worker=2'],
+])
+def test_progress_rendered_by_master(testdir, cli_args):
+    testdir.makepyfile('import time\n' + '\n'.join("""
+def test_{}():
+    time.sleep(.05)
+""".format(i) for i in range(10)))
+    result = testdir.runpytest('--parallel-progress=.01', *cli_args)
+    result.assert_outcomes(passed=10)
+    result.stdout.fnmatch_lines([
+        'pytest-parallel: */10 tests done (*%), * passed, ETA *',
+    ])
+    # workers stay quiet, every test shows up once
+    dots = ''.join(line for line in result.outlines if set(line) == {'.'})
+    assert len(dots) == 10
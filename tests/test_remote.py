@@ -0,0 +1,86 @@
+import sys
+import subprocess
+
+import pytest
+
+from pytest_parallel.remote import parse_address
+
+
+def spawn(*args, **kwargs):
+    return subprocess.Popen(
+        [sys.executable, '-m'] + list(args),
+        stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+        universal_newlines=True, **kwargs
+    )
+
+
+@pytest.fixture
+def coordinator(testdir):
+    def start(*args):
+        master = spawn('pytest', '-p', 'no:cacheprovider', '--workers=0',
+                       '--parallel-listen=127.0.0.1:0', *args)
+        output = []
+        for line in master.stdout:
+            output.append(line)
+            if line.startswith('pytest-parallel: accepting agents on '):
+                return master, line.split()[-1], output
+        pytest.fail('coordinator did not start:\n' + ''.join(output))
+    return start
+
+
+def agent(address, authkey='secret'):
+    return spawn('pytest_parallel', 'worker', '--connect', address,
+                 '--authkey', authkey)
+
+
+def test_parse_address():
+    assert parse_address('127.0.0.1:8000') == ('127.0.0.1', 8000)
+    assert parse_address('[::1]:0') == ('::1', 0)
+    with pytest.raises(ValueError):
+        parse_address('localhost')
+
+
+def test_no_workers_needs_agents(testdir):
+    testdir.makepyfile('def test_a(): pass')
+    result = testdir.runpytest('--workers=0')
+    assert result.ret != 0
+    assert 'workers can only be 0 with parallel_listen' in result.stdout.str()
+
+
+@pytest.mark.parametrize('cli_args', [
+  [],
+  ['--tests-per-worker=2'],
+  ['--max-tests-per-worker=3'],
+])
+def test_agents_run_the_tests(testdir, coordinator, cli_args):
+    testdir.makepyfile('import os, time\n' + '\n'.join("""
+def test_{}():
+    time.sleep(.1)
+    with open('pids', 'a') as f:
+        f.write('{{}}\\n'.format(os.getpid()))
+""".format(i) for i in range(20)))
+    master, address, _ = coordinator('--parallel-authkey=secret', *cli_args)
+    agents = [agent(address), agent(address)]
+
+    output, _ = master.communicate(timeout=60)
+    assert '20 passed' in output
+    assert master.returncode == 0
+    for process in agents:
+        process.communicate(timeout=30)
+        assert process.returncode == 0
+    pids = testdir.tmpdir.join('pids').readlines()
+    assert len(pids) == 20
+    assert len(set(pids)) >= 2
+
+
+def test_agent_needs_the_key(testdir, coordinator):
+    testdir.makepyfile('def test_a(): pass')
+    master, address, output = coordinator()
+    assert '--authkey' in output[-1] or '--authkey' in master.stdout.readline()
+
+    rejected = agent(address, authkey='wrong')
+    assert 'rejected the key' in rejected.communicate(timeout=30)[0]
+    assert rejected.returncode == 1
+
+    master.kill()
+    master.wait()
@@ -0,0 +1,71 @@
+import pytest
+
+from pytest_parallel import resources
+
+
+@pytest.fixture
+def cgroup(tmpdir, monkeypatch):
+    monkeypatch.setattr(resources.os, 'sched_getaffinity',
+                        lambda pid: set(range(8)), raising=False)
+    return tmpdir
+
+
+def test_cgroup_v2_limits(cgroup):
+    cgroup.join('cpu.max').write('150000 100000\n')
+    cgroup.join('memory.max').write('{}\n'.format(1 << 30))
+    assert resources.cgroup_cpu_limit(str(cgroup)) == 1.5
+    assert resources.cgroup_memory_limit(str(cgroup)) == 1 << 30
+    assert resources.available_cpus(str(cgroup)) == 1
+    assert resources.auto_workers(256 << 20, str(cgroup)) == 1
+
+    cgroup.join('cpu.max').write('400000 100000\n')
+    assert resources.auto_workers(None, str(cgroup)) == 4
+    assert resources.auto_workers(512 << 20, str(cgroup)) == 2
+
+
+def test_cgroup_v1_limits(cgroup):
+    cpu = cgroup.mkdir('cpu')
+    cpu.join('cpu.cfs_quota_us').write('300000\n')
+    cpu.join('cpu.cfs_period_us').write('100000\n')
+    cgroup.mkdir('memory').join('memory.limit_in_bytes').write(
+        '9223372036854771712\n'
+    )
+    assert resources.cgroup_cpu_limit(str(cgroup)) == 3
+    assert resources.cgroup_memory_limit(str(cgroup)) is None
+    assert resources.auto_workers(1 << 30, str(cgroup)) == 3
+
+
+def test_unlimited_cgroup_uses_affinity(cgroup):
+    cgroup.join('cpu.max').write('max 100000\n')
+    cgroup.join('memory.max').write('max\n')
+    assert resources.cgroup_cpu_limit(str(cgroup)) is None
+    assert resources.cgroup_memory_limit(str(cgroup)) is None
+    assert resources.auto_workers(1 << 30, str(cgroup)) == 8
+
+
+def test_adaptive_concurrency_follows_load():
+    limits = []
+    concurrency = resources.AdaptiveConcurrency(limits.append, 50, start=2)
+    assert concurrency.adjust(busy=.1, iowait=0) == 4
+    concurrency.limit = 32
+    assert concurrency.adjust(busy=.1, iowait=0) == 50
+    assert concurrency.adjust(busy=.7, iowait=0) == 32
+    assert concurrency.adjust(busy=1., iowait=0) == 16
+    assert concurrency.adjust(busy=.1, iowait=.5) == 16
+    concurrency.limit = 1
+    assert concurrency.adjust(busy=1., iowait=0) == 1
+
+
+def test_dynamic_tests_per_worker(testdir):
+    testdir.makepyfile('\n'.join("""
+import time
+
+def test_{}():
+    time.sleep(.1)
+""".format(i) for i in range(20)))
+    result = testdir.runpytest('--workers=2', '--tests-per-worker=dynamic')
+    result.stdout.fnmatch_lines([
+        'pytest-parallel: 2 workers (processes), up to 10 tests per worker '
+        '(threads)',
+    ])
+    result.assert_outcomes(passed=20)
@@ -0,0 +1,399 @@
+import json
+
+import pytest
+
+from pytest_parallel.scheduler import Scheduler, group_units, split_isolated
+
+
+def test_durations_recorded_in_cache(testdir):
+    testdir.makepyfile("""
+        import time
+
+        def test_fast():
+            pass
+
+        def test_slow():
+            time.sleep(.2)
+    """)
+    result = testdir.runpytest('--workers=1')
+    result.assert_outcomes(passed=2)
+    cached = testdir.tmpdir.join('.pytest_cache', 'v', 'pytest-parallel', 'durations')
+    durations = json.loads(cached.read())
+    assert sorted(durations) == [
+        'test_durations_recorded_in_cache.py::test_fast',
+        'test_durations_recorded_in_cache.py::test_slow',
+    ]
+    assert durations['test_durations_recorded_in_cache.py::test_slow'] >= .2
+
+
+def test_longest_recorded_duration_runs_first(testdir):
+    testdir.makepyfile("""
+        import time
+
+        def test_fast():
+            pass
+
+        def test_slow():
+            time.sleep(.2)
+    """)
+    testdir.runpytest('--workers=1').assert_outcomes(passed=2)
+
+    result = testdir.runpytest('--workers=1', '-v')
+    result.assert_outcomes(passed=2)
+    result.stdout.fnmatch_lines([
+        '*::test_slow PASSED*',
+        '*::test_fast PASSED*',
+    ])
+
+    result = testdir.runpytest('--workers=1', '-v', '--parallel-order=collection')
+    result.assert_outcomes(passed=2)
+    result.stdout.fnmatch_lines([
+        '*::test_fast PASSED*',
+        '*::test_slow PASSED*',
+    ])
+
+
+def make_scheduler(count, workers):
+    sent = []
+    scheduler = Scheduler(
+        range(count), dict.fromkeys(range(count), 1.0),
+        lambda worker, event, **kwargs: sent.append((worker, event, kwargs)),
+        workers
+    )
+    return scheduler, sent
+
+
+def test_chunks_shrink_as_pending_work_drains():
+    scheduler, sent = make_scheduler(100, 2)
+    sizes = []
+    while scheduler.pending:
+        scheduler.request('w0', 1, [])
+        sizes.append(len(sent.pop()[2]['units']))
+    assert sizes[0] == 25
+    assert sizes == sorted(sizes, reverse=True)
+    assert sizes[-1] == 1
+    assert sum(sizes) == 100
+
+
+def test_idle_worker_steals_from_busy_worker():
+    scheduler, sent = make_scheduler(100, 2)
+    scheduler.request('w0', 1, [])
+    chunk = sent[-1][2]['units']
+    assert len(chunk) == 25
+    while scheduler.pending:
+        scheduler.request('w1', 1, [])
+    del sent[:]
+
+    scheduler.request('w1', 1, [])
+    assert sent == [('w0', 'steal', {})]
+
+    # w0 finished one index and gives back the unstarted back half
+    scheduler.returned('w0', chunk[13:], chunk[:1])
+    assert sent[-1] == ('w1', 'units', {'units': chunk[13:16]})
+    assert scheduler.assigned['w0'] == set(chunk[1:13])
+
+
+def test_workers_stop_once_nothing_is_left_to_steal():
+    scheduler, sent = make_scheduler(2, 2)
+    scheduler.request('w0', 1, [])
+    scheduler.request('w1', 1, [])
+    scheduler.request('w0', 1, [0])
+    assert sent[-1] == ('w0', 'stop', {})
+    scheduler.request('w1', 1, [1])
+    assert sent[-1] == ('w1', 'stop', {})
+
+
+@pytest.mark.parametrize('cli_args', [
+  ['--tests-per-worker=2'],
+  ['--workers=2', '--tests-per-worker=2']
+])
+@pytest.mark.parametrize('dist, setups', [
+  ('loadfile', 2),
+  ('loadscope', 3),
+])
+def test_dist_keeps_scopes_on_one_thread(testdir, cli_args, dist, setups):
+    testdir.makeconftest("""
+        import os
+        import pytest
+
+        @pytest.fixture(scope='module')
+        def module_resource(request):
+            with open(os.path.join(str(request.config.rootdir), 'setups'), 'a') as f:
+                f.write(request.node.nodeid + '\\n')
+
+        @pytest.fixture(scope='class')
+        def class_resource(module_resource):
+            pass
+    """)
+    body = '\n'.join(
+        'def test_{}(module_resource): pass'.format(i) for i in range(4)
+    ) + '\nclass TestClass(object):\n' + '\n'.join(
+        '    def test_{}(self, class_resource): pass'.format(i) for i in range(4)
+    )
+    testdir.makepyfile(test_first=body, test_second='\n'.join(
+        'def test_{}(module_resource): pass'.format(i) for i in range(4)
+    ))
+    result = testdir.runpytest('--parallel-dist=' + dist, *cli_args)
+    result.assert_outcomes(passed=12)
+    assert len(testdir.tmpdir.join('setups').readlines()) == setups
+
+
+def test_loadgroup_units_follow_the_marker(testdir):
+    testdir.makepyfile("""
+        import pytest
+
+        @pytest.mark.parallel_group('db')
+        def test_a(): pass
+
+        def test_b(): pass
+
+        @pytest.mark.parallel_group(name='db')
+        def test_c(): pass
+    """)
+    items, _ = testdir.inline_genitems()
+    assert group_units(items, 'loadgroup') == [(0, 2), (1,)]
+    assert group_units(items, 'load') == [(0,), (1,), (2,)]
+    assert group_units(items, 'loadfile') == [(0, 1, 2)]
+
+
+def test_profile_writes_chrome_trace(testdir):
+    testdir.makepyfile('\n'.join(
+        'def test_{}(): pass'.format(i) for i in range(6)
+    ))
+    trace = testdir.tmpdir.join('trace.json')
+    result = testdir.runpytest('--workers=2', '--tests-per-worker=2',
+                               '--parallel-profile', str(trace))
+    result.assert_outcomes(passed=6)
+    result.stdout.fnmatch_lines([
+        '*pytest-parallel profile*',
+        'wall time *s, trace written to *trace.json',
+        'worker *: 2 threads, *% busy, *s waiting for work',
+        'worker *: 2 threads, *% busy, *s waiting for work',
+        'master: * events handled, *% busy',
+        'slowest tests:',
+    ])
+
+    events = json.loads(trace.read())['traceEvents']
+    processes = [e['args']['name'] for e in events if e['name'] == 'process_name']
+    assert processes[0] == 'master'
+    assert len(processes) == 3
+    spans = [e for e in events if e['ph'] == 'X']
+    calls = sorted(e['name'] for e in spans if e['cat'] == 'call')
+    assert calls == sorted(
+        'test_profile_writes_chrome_trace.py::test_{}'.format(i)
+        for i in range(6)
+    )
+    assert {e['cat'] for e in spans} >= {'setup', 'call', 'teardown', 'idle',
+                                         'master'}
+    assert all(e['ts'] >= 0 and e['dur'] >= 0 for e in spans)
+
+
+def test_cancel_drops_pending_and_returned_units():
+    scheduler, sent = make_scheduler(100, 2)
+    scheduler.request('w0', 1, [])
+    chunk = sent[-1][2]['units']
+    scheduler.request('w1', 1, [])
+    del sent[:]
+
+    scheduler.cancel()
+    assert sorted(sent) == [('w0', 'cancel', {}), ('w1', 'cancel', {})]
+    assert not scheduler.pending
+    assert not scheduler.has_work()
+
+    scheduler.returned('w0', chunk[1:], chunk[:1])
+    scheduler.request('w2', 1, [])
+    assert sent[-1] == ('w2', 'stop', {})
+    assert not scheduler.has_work()
+
+
+def test_reruns_prefer_another_worker():
+    scheduler, sent = make_scheduler(4, 2)
+    scheduler.request('w0', 1, [])
+    scheduler.request('w1', 1, [])
+    assert sent[-2:] == [('w0', 'units', {'units': [0]}),
+                         ('w1', 'units', {'units': [1]})]
+
+    # 0 failed on w0, it is queued again once w0 is done with it
+    scheduler.rerun('w0', 0, 1.)
+    assert list(scheduler.pending) == [2, 3]
+    scheduler.request('w0', 1, [0])
+    assert sent[-1] == ('w0', 'units', {'units': [2]})
+    scheduler.request('w1', 1, [1])
+    assert sent[-1] == ('w1', 'units', {'units': [0]})
+
+    # without another worker left, the same worker runs it again
+    scheduler.request('w1', 1, [0])
+    assert sent[-1] == ('w1', 'units', {'units': [3]})
+    scheduler.rerun('w1', 3, 1.)
+    scheduler.request('w0', 1, [2])
+    assert sent[-1] == ('w0', 'stop', {})
+    scheduler.request('w1', 1, [3])
+    assert sent[-1] == ('w1', 'units', {'units': [3]})
+
+
+def test_units_prefer_the_worker_that_collected_them():
+    sent = []
+    scheduler = Scheduler(
+        range(8), dict.fromkeys(range(8), 1.0),
+        lambda worker, event, **kwargs: sent.append((worker, event, kwargs)),
+        2, affinity={unit: 'w{}'.format(unit % 2) for unit in range(6)}
+    )
+    scheduler.request('w0', 1, [])
+    scheduler.request('w1', 1, [])
+    assert sent[-2:] == [('w0', 'units', {'units': [0, 2]}),
+                         ('w1', 'units', {'units': [1, 3]})]
+
+    # w0 is out of its own units and takes those of w1 as well
+    scheduler.request('w0', 1, [0, 2])
+    assert sent[-1] == ('w0', 'units', {'units': [4]})
+    scheduler.request('w0', 1, [4])
+    assert sent[-1] == ('w0', 'units', {'units': [5]})
+
+
+def test_failed_tests_rerun_within_the_session(testdir):
+    testdir.makepyfile(test_flaky="""
+        import os
+
+        def attempt(name):
+            with open(name, 'a') as f:
+                f.write('{}\\n'.format(os.getpid()))
+            with open(name) as f:
+                return len(f.readlines())
+
+        def test_flaky():
+            assert attempt('flaky') > 1
+
+        def test_broken():
+            assert attempt('broken') > 5
+    """)
+    testdir.makepyfile('import time\n' + '\n'.join("""
+def test_{}():
+    time.sleep(.1)
+""".format(i) for i in range(6)))
+    result = testdir.runpytest('--workers=2', '--parallel-reruns=2')
+    result.assert_outcomes(passed=7, failed=1)
+    result.stdout.fnmatch_lines([
+        '*pytest-parallel reruns*',
+        'test_flaky.py::test_broken ran 2 more times',
+        'test_flaky.py::test_flaky ran 1 more time',
+        '*1 failed, 7 passed, 3 rerun*',
+    ])
+    assert len(testdir.tmpdir.join('flaky').readlines()) == 2
+    assert len(testdir.tmpdir.join('broken').readlines()) == 3
+
+
+def test_isolated_items_leave_their_units():
+    units, isolated = split_isolated([(0, 1, 2), (3,), (4, 5)], [3, 1])
+    assert units == [(0, 2), (4, 5)]
+    assert isolated == [(1,), (3,)]
+
+
+def test_units_wait_for_their_resources():
+    from pytest_parallel.resources import ResourcePool
+
+    sent = []
+    pool = ResourcePool({'db': 2})
+    needs = {0: {'db': 1}, 1: {'db': 1}, 2: {'db': 2}}
+    scheduler = Scheduler(
+        range(4), dict.fromkeys(range(4), 1.0),
+        lambda worker, event, **kwargs: sent.append((worker, event, kwargs)),
+        2, needs, pool
+    )
+    scheduler.request('w0', 4, [])
+    # unit 2 needs both db slots, so the free unit 3 goes along instead
+    assert sent[-1] == ('w0', 'units', {'units': [0, 1, 3]})
+    scheduler.request('w1', 4, [])
+    assert len(sent) == 1 and scheduler.has_work()
+
+    scheduler.released('w0', [0])
+    assert len(sent) == 1
+    scheduler.released('w0', [1])
+    assert sent[-1] == ('w1', 'units', {'units': [2]})
+    assert pool.used['db'] == 2
+
+
+def test_blocked_units_are_not_scanned_again():
+    from pytest_parallel.resources import ResourcePool
+
+    class CountingPool(ResourcePool):
+        calls = 0
+
+        def acquire(self, needs):
+            CountingPool.calls += 1
+            return super(CountingPool, self).acquire(needs)
+
+    sent = []
+    pool = CountingPool({'db': 1})
+    count = 2000
+    scheduler = Scheduler(
+        range(count), dict.fromkeys(range(count), 1.0),
+        lambda worker, event, **kwargs: sent.append((worker, event, kwargs)),
+        2, dict.fromkeys(range(count), {'db': 1}), pool
+    )
+    scheduler.request('w0', 1, [])
+    scheduler.request('w1', 1, [])
+    for unit in range(count - 1):
+        worker = sent[-1][0]
+        scheduler.released(worker, [unit])
+        scheduler.request(worker, 1, [])
+    assert [units for _, event, units in sent if event == 'units'] == [
+        {'units': [unit]} for unit in range(count)
+    ]
+    # every release looks at the first waiting unit only
+    assert CountingPool.calls < 3 * count
+
+
+@pytest.mark.parametrize('cli_args', [
+  ['--workers=2', '--tests-per-worker=3'],
+  ['--tests-per-worker=4', '--parallel-dist=loadscope'],
+])
+def test_resources_limit_concurrency_across_workers(testdir, cli_args):
+    testdir.makepyfile("""
+        import os
+        import time
+        import uuid
+        import pytest
+
+        def hold(kind):
+            os.makedirs(kind, exist_ok=True)
+            path = os.path.join(kind, uuid.uuid4().hex)
+            open(path, 'w').close()
+            seen = len(os.listdir(kind))
+            time.sleep(.1)
+            seen = max(seen, len(os.listdir(kind)))
+            os.remove(path)
+            with open(kind + '.seen', 'a') as f:
+                f.write('{}\\n'.format(seen))
+    """ + '\n'.join("""
+        @pytest.mark.parallel_resources('db')
+        def test_db_{0}():
+            hold('db')
+
+        @pytest.mark.parallel_resources(memory='3G')
+        def test_memory_{0}():
+            hold('memory')
+
+        def test_free_{0}():
+            time.sleep(.05)
+    """.format(i) for i in range(5)))
+    result = testdir.runpytest('--parallel-resources=db=2,memory=4G', *cli_args)
+    result.assert_outcomes(passed=15)
+    db = [int(n) for n in testdir.tmpdir.join('db.seen').readlines()]
+    memory = [int(n) for n in testdir.tmpdir.join('memory.seen').readlines()]
+    assert len(db) == len(memory) == 5
+    assert max(db) <= 2
+    assert max(memory) == 1
+
+
+def test_resource_need_larger_than_capacity(testdir):
+    testdir.makepyfile("""
+        import pytest
+
+        @pytest.mark.parallel_resources(gpu=2)
+        def test_a():
+            pass
+    """)
+    result = testdir.runpytest('--workers=1', '--parallel-resources=gpu=1')
+    result.stdout.fnmatch_lines([
+        '*test_a needs 2 of the resource "gpu", but only 1 is available*',
+    ])
@@ -0,0 +1,127 @@
+import os
+
+import pytest
+
+from pytest_parallel.collection import PARTITIONS_SUPPORTED
+from pytest_parallel.shared import dump, load, parallel_shared_fixture
+
+
+def test_values_round_trip_through_the_mapping(tmpdir):
+    path = str(tmpdir.join('value'))
+    dump({'rows': [1, 2, 3], 'name': 'reference'}, path)
+    assert load(path) == {'rows': [1, 2, 3], 'name': 'reference'}
+
+    dump(b'x' * 100000, path)
+    value = load(path)
+    # bytes come back as a view of the shared pages, not as a copy from
+    # Python 3.8 on
+    assert isinstance(value, memoryview)
+    assert value.readonly
+    assert value.tobytes() == b'x' * 100000
+
+
+def test_shared_fixtures_cannot_request_fixtures():
+    with pytest.raises(TypeError):
+        @parallel_shared_fixture
+        def dataset(tmpdir):
+            pass
+
+
+@pytest.mark.parametrize('cli_args', [
+  ['--workers=2'],
+  ['--workers=2', '--tests-per-worker=2'],
+  ['--workers=2', '--parallel-start-method=spawn'],
+  [],
+])
+def test_shared_fixture_is_computed_once(testdir, cli_args):
+    testdir.makeconftest("""
+        import os
+        from pytest_parallel import parallel_shared_fixture
+
+        @parallel_shared_fixture
+        def dataset():
+            with open('computed', 'a') as f:
+                f.write('{}\\n'.format(os.getpid()))
+            return b'reference' * 1000
+
+        @parallel_shared_fixture(name='table')
+        def build_table():
+            return {'answer': 42}
+    """)
+    testdir.makepyfile('import os, time\n' + '\n'.join("""
+def test_{}(dataset, table):
+    time.sleep(.05)
+    assert isinstance(dataset, memoryview)
+    assert bytes(dataset[:9]) == b'reference'
+    assert table == {{'answer': 42}}
+    with open('pids', 'a') as f:
+        f.write('{{}}\\n'.format(os.getpid()))
+""".format(i) for i in range(8)))
+    result = testdir.runpytest(*cli_args)
+    result.assert_outcomes(passed=8)
+    assert len(testdir.tmpdir.join('computed').readlines()) == 1
+    if cli_args:
+        assert len(set(testdir.tmpdir.join('pids').readlines())) == 2
+
+
+@pytest.mark.skipif(not PARTITIONS_SUPPORTED,
+                    reason='older pytest collects in the master')
+def test_shared_fixture_is_computed_once_when_workers_collect(testdir):
+    testdir.makeconftest("""
+        import os
+        from pytest_parallel import parallel_shared_fixture
+
+        @parallel_shared_fixture
+        def dataset():
+            with open('computed', 'a') as f:
+                f.write('{}\\n'.format(os.getpid()))
+            return b'reference'
+    """)
+    for package in 'abcd':
+        testdir.mkdir(package).join('test_{}.py'.format(package)).write(
+            'def test_dataset(dataset):\n'
+            '    assert bytes(dataset) == b"reference"\n'
+        )
+    result = testdir.runpytest('--workers=2', '--parallel-collect')
+    result.assert_outcomes(passed=4)
+    computed = testdir.tmpdir.join('computed').readlines()
+    assert len(computed) == 1
+    assert computed[0].strip() != str(os.getpid())
+
+
+def test_shared_fixtures_of_conftest_files_stay_apart(testdir):
+    for name in 'ab':
+        directory = testdir.mkdir(name)
+        directory.join('conftest.py').write(
+            'from pytest_parallel import parallel_shared_fixture\n'
+            '\n'
+            '@parallel_shared_fixture\n'
+            'def value():\n'
+            '    return {!r}\n'.format(name)
+        )
+        directory.join('test_{}.py'.format(name)).write(
+            'def test_value(value):\n'
+            '    assert value == {!r}\n'.format(name)
+        )
+    for cli_args in ([], ['--workers=2']):
+        result = testdir.runpytest(*cli_args)
+        result.assert_outcomes(passed=2)
+
+
+def test_shared_fixture_errors_are_reported_by_the_tests(testdir):
+    testdir.makeconftest("""
+        from pytest_parallel import parallel_shared_fixture
+
+        @parallel_shared_fixture
+        def dataset():
+            raise ValueError('no data')
+    """)
+    testdir.makepyfile("""
+        def test_a(dataset):
+            pass
+
+        def test_b():
+            pass
+    """)
+    result = testdir.runpytest('--workers=2')
+    result.stdout.fnmatch_lines(['*1 passed, 1 error*'])